@@ -0,0 +1,16 @@
+import pytest
+from jupyter_server.serverapp import ServerApp
+
+from jupyterlab_code_formatter import load_jupyter_server_extension
+
+
+@pytest.fixture
+def jp_server_config(jp_server_config):
+    # measure formatting rather than cache lookups
+    return {**jp_server_config, "FormatCache": {"enabled": False}}
+
+
+@pytest.fixture(autouse=True)
+def jcf_serverapp(jp_serverapp: ServerApp) -> ServerApp:
+    load_jupyter_server_extension(jp_serverapp)
+    return jp_serverapp
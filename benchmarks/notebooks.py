@@ -0,0 +1,35 @@
+from typing import Dict, List
+
+NOTEBOOK_SIZES = (10, 100, 1000)
+
+# Unformatted cells, with magics and shell commands that have to be escaped
+PYTHON_CELLS = [
+    "%matplotlib inline\nimport sys,os\nvalues=[1,2 ,3]",
+    "!pip list\ndef add(a,b):\n  return a+b;",
+    "%%time\nfor i in range(10):print(i)",
+    "frame = load()\nframe.head?\nresult={'a':1,'b':2}",
+]
+CELLS: Dict[str, List[str]] = {
+    "python": PYTHON_CELLS,
+    "r": ["x<-c(1,2,3)\nf<-function(a){a+1}"],
+    "rust": ['fn main(){let x=1;println!("{}",x);}'],
+    "cpp": ["int main(){int x=1;return x;}"],
+    "scala": ["object A{def f(x:Int)=x+1}"],
+}
+LANGUAGES = {
+    "formatR": "r",
+    "styler": "r",
+    "rustfmt": "rust",
+    "astyle": "cpp",
+    "scalafmt": "scala",
+}
+
+
+def make_cells(count: int, language: str = "python") -> List[str]:
+    """A synthetic notebook of ``count`` distinct cells, so that none is cached."""
+    comment = "//" if language in ("rust", "cpp", "scala") else "#"
+    templates = CELLS[language]
+    return [
+        f"{comment} cell {index}\n{templates[index % len(templates)]}"
+        for index in range(count)
+    ]
@@ -0,0 +1,89 @@
+import pytest
+
+from benchmarks.notebooks import LANGUAGES, NOTEBOOK_SIZES, make_cells
+from jupyterlab_code_formatter.formatters import (
+    SERVER_FORMATTERS,
+    BaseFormatter,
+    CommandLineFormatter,
+    handle_line_ending_and_magic,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+
+class IdentityFormatter(BaseFormatter):
+    label = "Apply Identity Formatter"
+    importable = True
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code
+
+
+class EscapingIdentityFormatter(IdentityFormatter):
+    @handle_line_ending_and_magic
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code
+
+
+def format_cells(formatter: BaseFormatter, cells):
+    return [formatter.format_code(cell, True) for cell in cells]
+
+
+@pytest.mark.parametrize("size", NOTEBOOK_SIZES)
+def test_without_escaping(benchmark, size):
+    """Baseline of ``test_escaping``."""
+    benchmark.group = f"escaping-{size}"
+    benchmark(format_cells, IdentityFormatter(), make_cells(size))
+
+
+@pytest.mark.parametrize("size", NOTEBOOK_SIZES)
+def test_escaping(benchmark, size):
+    """Overhead of escaping magics and restoring them around a formatter."""
+    benchmark.group = f"escaping-{size}"
+    cells = make_cells(size)
+    results = benchmark(format_cells, EscapingIdentityFormatter(), cells)
+    assert results == cells
+
+
+@pytest.mark.parametrize("size", NOTEBOOK_SIZES)
+@pytest.mark.parametrize("name", SERVER_FORMATTERS)
+def test_formatter(benchmark, name, size):
+    """Formatting a notebook with one formatter, the way the executor does."""
+    formatter = SERVER_FORMATTERS[name]
+    if not formatter.importable:
+        pytest.skip(f"{name} is not installed")
+    cells = make_cells(size, LANGUAGES.get(name, "python"))
+    # also loads the formatter, which is not what is measured
+    if isinstance(formatter.format_batch(cells[:1], True)[0], Exception):
+        pytest.skip(f"{name} is not working")
+
+    benchmark.group = f"formatters-{size}"
+    results = benchmark.pedantic(
+        formatter.format_batch, (cells, True), rounds=3 if size >= 1000 else 5
+    )
+    assert not any(isinstance(result, Exception) for result in results)
+
+
+@pytest.mark.parametrize("size", NOTEBOOK_SIZES[:2])
+@pytest.mark.parametrize("batch", [False, True], ids=["one_shot", "batch"])
+@pytest.mark.parametrize("name", ["ruffformat", "rustfmt", "astyle"])
+def test_subprocess_per_cell_overhead(benchmark, name, batch, size):
+    """Formatters starting a process per cell, or once for all the cells.
+
+    ruff, rustfmt and astyle have no Python API to call in-process, a batch is what
+    amortizes the cost of starting them.
+    """
+    formatter = SERVER_FORMATTERS[name]
+    if not formatter.importable:
+        pytest.skip(f"{name} is not installed")
+    assert isinstance(formatter, CommandLineFormatter)
+    cells = make_cells(size, LANGUAGES.get(name, "python"))
+    # BaseFormatter.format_batch formats the cells one by one
+    format_batch = type(formatter).format_batch if batch else BaseFormatter.format_batch
+    if isinstance(format_batch(formatter, cells[:2], True)[0], Exception):
+        pytest.skip(f"{name} is not working")
+
+    benchmark.group = f"subprocess-{name}-{size}"
+    benchmark.extra_info["cells"] = size
+    results = benchmark.pedantic(format_batch, (formatter, cells, True), rounds=3)
+    assert not any(isinstance(result, Exception) for result in results)
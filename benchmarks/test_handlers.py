@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+import pytest
+
+from benchmarks.notebooks import NOTEBOOK_SIZES, make_cells
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+
+pytest.importorskip("pytest_benchmark")
+
+
+@pytest.mark.parametrize("size", NOTEBOOK_SIZES)
+async def test_format(jp_fetch, benchmark, size):  # type: ignore[no-untyped-def]
+    """Latency of formatting a notebook with ``/format``, as seen by the client."""
+    if not SERVER_FORMATTERS["black"].importable:
+        pytest.skip("black is not installed")
+    body = json.dumps({
+        "code": make_cells(size),
+        "notebook": True,
+        "formatters": [{"formatter": "isort"}, {"formatter": "black"}],
+    })
+    loop = asyncio.get_running_loop()
+
+    async def fetch():
+        return await jp_fetch(
+            "jupyterlab_code_formatter", "format", method="POST", body=body
+        )
+
+    def request():
+        # the server runs on this test's event loop, the benchmark in a thread
+        return asyncio.run_coroutine_threadsafe(fetch(), loop).result()
+
+    benchmark.group = f"format-handler-{size}"
+    response = await loop.run_in_executor(
+        None,
+        lambda: benchmark.pedantic(request, rounds=3 if size >= 1000 else 5),
+    )
+    results = json.loads(response.body)["code"]
+    assert all("code" in result for result in results)
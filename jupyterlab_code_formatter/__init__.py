@@ -1,5 +1,14 @@
 from ._version import __version__
-from .handlers import setup_handlers
+
+
+def __getattr__(name):
+    # importing the handlers, and the formatters with them, is left to the server
+    # loading the extension rather than to anything looking up the version
+    if name == "setup_handlers":
+        from .handlers import setup_handlers
+
+        return setup_handlers
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def _jupyter_labextension_paths():
@@ -18,10 +27,48 @@ def _load_jupyter_server_extension(server_app):
     server_app: jupyterlab.labapp.LabApp
         JupyterLab application instance
     """
-    setup_handlers(server_app.web_app)
+    from tornado.ioloop import IOLoop
+
+    from .availability import FormatterRegistry
+    from .cache import FormatCache
+    from .executor import FormatExecutor
+    from .formatters import SERVER_FORMATTERS
+    from .handlers import setup_handlers
+    from .jobs import FormatJobManager
+    from .preload import FormatterPreloader
+
+    # plugins are imported when their formatter is first used
+    SERVER_FORMATTERS.load_entry_points()
+    executor = FormatExecutor(cache=FormatCache(parent=server_app), parent=server_app)
+    registry = FormatterRegistry(parent=server_app)
+    registry.start()
+    jobs = FormatJobManager(root_dir=server_app.root_dir, parent=server_app)
+    # jobs left running when the server stopped, once it runs
+    IOLoop.current().add_callback(jobs.resume)
+    setup_handlers(server_app.web_app, executor, registry, jobs)
+    # shut down by _unload_jupyter_server_extension
+    server_app.web_app.settings["jupyterlab_code_formatter"] = {
+        "executor": executor,
+        "registry": registry,
+        "jobs": jobs,
+    }
+    FormatterPreloader(parent=server_app).start(executor)
     name = "jupyterlab_code_formatter"
     server_app.log.info(f"Registered {name} server extension")
 
 
+def _unload_jupyter_server_extension(server_app):
+    """Stops the workers of the server extension, as the server stops.
+
+    Jobs still running are saved, to be resumed by the next server.
+    """
+    state = server_app.web_app.settings.pop("jupyterlab_code_formatter", None)
+    if state is None:
+        return
+    state["jobs"].shutdown()
+    state["executor"].shutdown()
+    state["registry"].stop()
+
+
 # For backward compatibility with notebook server - useful for Binder/JupyterHub
 load_jupyter_server_extension = _load_jupyter_server_extension
@@ -0,0 +1,125 @@
+import importlib
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from traitlets import Float
+from traitlets.config import LoggingConfigurable
+
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+
+
+def search_path_signature() -> Tuple[Tuple[str, Optional[int]], ...]:
+    """Modification times of the directories where formatters get installed.
+
+    Installing or removing a Python package touches a directory of ``sys.path`` and
+    installing a command line tool touches a directory of ``PATH``, so a change in
+    this signature means availability of the formatters may have changed.
+    """
+    directories = list(sys.path) + os.environ.get("PATH", "").split(os.pathsep)
+    signature = []
+    for directory in dict.fromkeys(directories):
+        try:
+            signature.append((directory, os.stat(directory or ".").st_mtime_ns))
+        except OSError:
+            signature.append((directory, None))
+    return tuple(signature)
+
+
+class FormatterRegistry(LoggingConfigurable):
+    """Availability of the server formatters, served without probing on each request.
+
+    Formatters are probed, without creating them, once in a background thread as
+    the server starts; the thread then probes them again whenever a directory of
+    ``sys.path`` or ``PATH`` changes, and at the latest every ``refresh_interval``
+    seconds.
+    """
+
+    refresh_interval = Float(
+        600.0,
+        config=True,
+        help="Seconds after which formatters are probed again in any case.",
+    )
+
+    watch_interval = Float(
+        10.0,
+        config=True,
+        help=(
+            "Seconds between two checks of sys.path and PATH for newly installed "
+            "or removed formatters. Set to 0 to only rely on refresh_interval."
+        ),
+    )
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._available: Dict[str, bool] = {}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._signature: Optional[Tuple[Tuple[str, Optional[int]], ...]] = None
+        self._refreshed_at = 0.0
+
+    def is_available(self, name: str) -> bool:
+        if name not in SERVER_FORMATTERS:
+            return False
+        available = self._available.get(name)
+        if available is None:
+            # not probed yet, e.g. the startup probe is still running
+            available = self._probe(name)
+        return available
+
+    @property
+    def available(self) -> Dict[str, bool]:
+        return {name: self.is_available(name) for name in list(SERVER_FORMATTERS)}
+
+    def refresh(self, names: Optional[Iterable[str]] = None) -> None:
+        """Probe the formatters again, all of them by default."""
+        # packages installed since the server started are invisible to find_spec
+        importlib.invalidate_caches()
+        self._signature = search_path_signature()
+        self._refreshed_at = time.monotonic()
+        for name in list(SERVER_FORMATTERS) if names is None else names:
+            self._probe(name)
+
+    def _probe(self, name: str) -> bool:
+        try:
+            available = SERVER_FORMATTERS.available(name)
+        except KeyError:
+            self._available.pop(name, None)
+            return False
+        except Exception as e:
+            self.log.warning("Unable to check if %s is available: %s", name, e)
+            available = False
+        if available is None:
+            # a plugin not loaded yet, the first request using it loads it and
+            # reports its error if it fails to; probed again from then on
+            self._available.pop(name, None)
+            return True
+        self._available[name] = available
+        return available
+
+    def start(self) -> None:
+        """Probe the formatters in the background, then keep watching for changes."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._watch,
+            name="jupyterlab_code_formatter_registry",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread = None
+
+    def _watch(self) -> None:
+        self.refresh()
+        interval = self.watch_interval or self.refresh_interval
+        while not self._stopped.wait(interval):
+            expired = time.monotonic() - self._refreshed_at >= self.refresh_interval
+            if expired or search_path_signature() != self._signature:
+                self.log.debug("Probing formatters availability again")
+                self.refresh()
@@ -0,0 +1,245 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from jupyter_core.paths import jupyter_runtime_dir
+from traitlets import Bool, Float, Integer, Unicode, default
+from traitlets.config import LoggingConfigurable
+
+from jupyterlab_code_formatter.formatters import canonical_options
+
+
+def make_cache_key(
+    formatter_name: str,
+    formatter_version: str,
+    options: Any,
+    notebook: bool,
+    code: str,
+) -> str:
+    """Content address of a formatting result."""
+    digest = hashlib.sha256()
+    for part in (
+        formatter_name,
+        formatter_version,
+        canonical_options(options),
+        "notebook" if notebook else "file",
+        code,
+    ):
+        digest.update(part.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskFormatCache(LoggingConfigurable):
+    """Persistent second tier of the format cache, stored in a sqlite database.
+
+    The database is opened in WAL mode so several Jupyter servers of one machine can
+    share it; any database error is logged and treated as a cache miss.
+    """
+
+    enabled = Bool(
+        False,
+        config=True,
+        help="Persist formatting results on disk, across server restarts.",
+    )
+
+    path = Unicode(
+        config=True,
+        help=(
+            "Location of the sqlite database. Point several servers of one machine "
+            "at the same file to share results between them."
+        ),
+    )
+
+    @default("path")
+    def _default_path(self) -> str:
+        return os.path.join(
+            jupyter_runtime_dir(), "jupyterlab_code_formatter", "format_cache.sqlite"
+        )
+
+    max_bytes = Integer(
+        256 * 1024 * 1024,
+        config=True,
+        help="Maximum total size (in characters) of formatted cells kept on disk.",
+    )
+
+    timeout = Float(
+        5.0,
+        config=True,
+        help="Seconds to wait for another server holding a lock on the database.",
+    )
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        if not self.enabled or not keys:
+            return {}
+        found: Dict[str, str] = {}
+        try:
+            connection = self._connection()
+            # stay well below SQLITE_MAX_VARIABLE_NUMBER
+            for start in range(0, len(keys), 500):
+                batch = keys[start : start + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(
+                    connection.execute(
+                        f"SELECT key, value FROM results WHERE key IN ({placeholders})",
+                        batch,
+                    ).fetchall()
+                )
+            if found:
+                now = time.time()
+                connection.executemany(
+                    "UPDATE results SET accessed = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+        except sqlite3.Error as e:
+            self.log.warning("Unable to read format cache %s: %s", self.path, e)
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, str]]) -> None:
+        if not self.enabled:
+            return
+        now = time.time()
+        rows = [
+            (key, value, len(key) + len(value), now)
+            for key, value in items
+            if len(key) + len(value) <= self.max_bytes
+        ]
+        if not rows:
+            return
+        try:
+            connection = self._connection()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.executemany(
+                    "INSERT OR REPLACE INTO results (key, value, size, accessed) "
+                    "VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._evict(connection)
+        except sqlite3.Error as e:
+            self.log.warning("Unable to write format cache %s: %s", self.path, e)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        (total,) = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        # make some room so that eviction doesn't run on every write
+        excess = total - int(self.max_bytes * 0.9)
+        cursor = connection.execute("SELECT key, size FROM results ORDER BY accessed")
+        evicted = []
+        for key, size in cursor:
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def clear(self) -> None:
+        try:
+            self._connection().execute("DELETE FROM results")
+        except sqlite3.Error as e:
+            self.log.warning("Unable to clear format cache %s: %s", self.path, e)
+
+
+class FormatCache(LoggingConfigurable):
+    """In-memory LRU cache of formatted cells.
+
+    Keys include the formatter version, so upgrading a formatter package naturally
+    stops old results from being served; they are evicted as the cache fills up.
+    Misses may be looked up in the optional on-disk tier, see ``DiskFormatCache``.
+    """
+
+    enabled = Bool(True, config=True, help="Cache formatting results in memory.")
+
+    max_entries = Integer(
+        4096, config=True, help="Maximum number of formatted cells kept in memory."
+    )
+
+    max_bytes = Integer(
+        32 * 1024 * 1024,
+        config=True,
+        help="Maximum total size (in characters) of formatted cells kept in memory.",
+    )
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.disk = DiskFormatCache(parent=self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(key) + len(previous)
+            self._entries[key] = value
+            self._size += entry_size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes
+            ):
+                old_key, old_value = self._entries.popitem(last=False)
+                self._size -= len(old_key) + len(old_value)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
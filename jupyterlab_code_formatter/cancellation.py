@@ -0,0 +1,108 @@
+import subprocess
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional
+
+from jupyterlab_code_formatter.phases import timed_phase
+
+
+class FormatCancelled(Exception):
+    def __init__(self) -> None:
+        super().__init__("Format request cancelled")
+
+
+class CancelScope:
+    """Cancellation of a format request, shared with the workers running it.
+
+    Formatters look at the scope of the request they run for with
+    ``current_cancel_scope``, to stop before formatting another cell and to have
+    their subprocesses killed as soon as the request is cancelled.
+    """
+
+    def __init__(self) -> None:
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[], Any]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        with self._lock:
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise FormatCancelled()
+
+    def add_callback(self, callback: Callable[[], Any]) -> None:
+        """Call ``callback`` on cancellation, right away if already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], Any]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+_local = threading.local()
+
+
+def current_cancel_scope() -> Optional[CancelScope]:
+    return getattr(_local, "scope", None)
+
+
+@contextmanager
+def cancel_scope(scope: Optional[CancelScope]) -> Iterator[None]:
+    """Make ``scope`` the cancellation scope of the formatters run by this thread."""
+    previous = current_cancel_scope()
+    _local.scope = scope
+    try:
+        yield
+    finally:
+        _local.scope = previous
+
+
+def run_in_scope(scope: Optional[CancelScope], func: Callable, *args: Any) -> Any:
+    with cancel_scope(scope):
+        return func(*args)
+
+
+def check_cancelled() -> None:
+    scope = current_cancel_scope()
+    if scope is not None:
+        scope.check()
+
+
+def run_process(
+    args: List[str], input: Optional[str] = None
+) -> "subprocess.CompletedProcess[str]":
+    """Run a command like ``subprocess.run``, killing it if the request is cancelled."""
+    check_cancelled()
+    scope = current_cancel_scope()
+    with timed_phase("spawn"):
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+    with process:
+        if scope is not None:
+            scope.add_callback(process.kill)
+        try:
+            stdout, _ = process.communicate(input)
+        finally:
+            if scope is not None:
+                scope.remove_callback(process.kill)
+    check_cancelled()
+    return subprocess.CompletedProcess(args, process.returncode, stdout)
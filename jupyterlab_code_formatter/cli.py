@@ -0,0 +1,170 @@
+import asyncio
+import os
+from typing import Any, Dict, Iterator, List, Optional
+
+import nbformat
+from jupyter_core.application import JupyterApp, base_aliases, base_flags
+from jupyter_server.services.contents.fileio import atomic_writing
+from traitlets import Bool, Unicode
+from traitlets import List as ListTrait
+
+from jupyterlab_code_formatter._version import __version__
+from jupyterlab_code_formatter.cache import FormatCache
+from jupyterlab_code_formatter.executor import FormatExecutor, Stage
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+from jupyterlab_code_formatter.notebooks import format_notebook, notebook_stages
+from jupyterlab_code_formatter.settings import (
+    formatter_stages,
+    read_user_settings,
+    user_settings_path,
+)
+
+aliases = {
+    **base_aliases,
+    "formatter": "CodeFormatApp.formatters",
+    "settings": "CodeFormatApp.settings_path",
+    "mode": "FormatExecutor.mode",
+    "max-workers": "FormatExecutor.max_workers",
+}
+flags = {
+    **base_flags,
+    "check": (
+        {"CodeFormatApp": {"check": True}},
+        "Don't write notebooks, exit with status 1 if any would be changed.",
+    ),
+}
+
+
+def notebook_paths(paths: List[str]) -> Iterator[str]:
+    """Notebooks given, and those found in the directories given."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            # e.g. .ipynb_checkpoints
+            subdirectories[:] = sorted(
+                d for d in subdirectories if not d.startswith(".")
+            )
+            for name in sorted(files):
+                if name.endswith(".ipynb"):
+                    yield os.path.join(directory, name)
+
+
+class CodeFormatApp(JupyterApp):
+    """Format the code cells of notebooks with the server formatters."""
+
+    name = "jupyter-codeformat"
+    version = __version__
+    description = """Format the code cells of notebooks in place.
+
+    Notebooks are formatted with the default formatters of the language of their
+    kernel, taken from the JupyterLab settings of jupyterlab_code_formatter, unless
+    formatters are given. Directories are searched for notebooks.
+    """
+    examples = """
+    jupyter codeformat notebooks/
+    jupyter codeformat --formatter=isort --formatter=black analysis.ipynb
+    jupyter codeformat --check --mode=process notebooks/
+    """
+    aliases = aliases
+    flags = flags
+    classes = [FormatExecutor, FormatCache]
+
+    formatters = ListTrait(
+        Unicode(),
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help="Formatters to apply in order, rather than those of the settings.",
+    )
+
+    settings_path = Unicode(
+        config=True,
+        help="JupyterLab settings of the extension, with the default formatters.",
+    )
+
+    check = Bool(
+        False,
+        config=True,
+        help="Don't write notebooks, exit with status 1 if any would be changed.",
+    )
+
+    def start(self) -> None:
+        paths = list(notebook_paths(self.extra_args))
+        if not paths:
+            self.print_help()
+            self.exit(2)
+        SERVER_FORMATTERS.load_entry_points()
+        self.exit(0 if asyncio.run(self.format_notebooks(paths)) else 1)
+
+    async def format_notebooks(self, paths: List[str]) -> bool:
+        """Format notebooks concurrently, whether all went well."""
+        settings = read_user_settings(self.settings_path or user_settings_path())
+        executor = FormatExecutor(cache=FormatCache(parent=self), parent=self)
+        # formatting cells of a notebook is already spread over the workers
+        semaphore = asyncio.Semaphore(executor.max_workers)
+
+        async def format_one(path: str) -> bool:
+            async with semaphore:
+                return await self.format_path(executor, settings, path)
+
+        try:
+            results = await asyncio.gather(*(format_one(path) for path in paths))
+        finally:
+            executor.shutdown()
+        return all(results)
+
+    async def format_path(
+        self, executor: FormatExecutor, settings: Dict[str, Any], path: str
+    ) -> bool:
+        try:
+            with open(path, encoding="utf-8") as f:
+                notebook = nbformat.read(f, as_version=nbformat.NO_CONVERT)
+        except Exception as e:
+            self.log.error("Unable to read %s: %s", path, e)
+            return False
+
+        stages = self.stages(notebook, settings)
+        if stages is None:
+            self.log.warning("Skipping %s, its language is unknown", path)
+            return True
+        for name, _ in stages:
+            formatter = SERVER_FORMATTERS.get(name)
+            if formatter is None or not formatter.importable:
+                self.log.error(
+                    "Unable to format %s: formatter %s not found", path, name
+                )
+                return False
+
+        summary = await format_notebook(executor, notebook, stages)
+        for error in summary["errors"]:
+            self.log.error("%s, cell %d: %s", path, error["cell"], error["error"])
+        if self.check:
+            if summary["changed"]:
+                self.log.warning("%s would be reformatted", path)
+            return not summary["changed"] and not summary["errors"]
+        if summary["changed"]:
+            with atomic_writing(path, encoding="utf-8") as f:
+                nbformat.write(notebook, f, version=nbformat.NO_CONVERT)
+            self.log.info(
+                "Formatted %s, %d of %d code cells changed",
+                path,
+                summary["changed"],
+                summary["cells"],
+            )
+        return not summary["errors"]
+
+    def stages(
+        self, notebook: Dict[str, Any], settings: Dict[str, Any]
+    ) -> Optional[List[Stage]]:
+        if self.formatters is not None:
+            return formatter_stages(settings, self.formatters)
+        return notebook_stages(notebook, settings)
+
+
+main = launch_new_instance = CodeFormatApp.launch_instance
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Sequence, Tuple, Union
+
+# First and last line (1-based, inclusive) of a region of code
+LineRange = Tuple[int, int]
+
+
+def split_lines(code: str) -> List[str]:
+    """Lines of ``code`` with their line ending, split on ``\\n`` only like editors do."""
+    lines = [line + "\n" for line in code.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def line_edits(before: str, after: str) -> List[Dict[str, Union[int, str]]]:
+    """Smallest line based edits turning ``before`` into ``after``.
+
+    Each edit replaces lines ``start`` (included) to ``end`` (excluded) of ``before``,
+    counted from 0, by ``text``. Edits are sorted and don't overlap.
+    """
+    old_lines = split_lines(before)
+    new_lines = split_lines(after)
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    return [
+        {"start": i1, "end": i2, "text": "".join(new_lines[j1:j2])}
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def cell_edits(code: str, result: Dict[str, str]) -> Dict[str, Any]:
+    """Replace the formatted code of a cell by the edits to apply, if any."""
+    if "code" not in result:
+        return result
+    if result["code"] == code:
+        return {"unchanged": True}
+    return {"edits": line_edits(code, result["code"])}
+
+
+def shift_line_ranges(
+    before: str, after: str, line_ranges: Sequence[LineRange]
+) -> List[LineRange]:
+    """Where the given lines of ``before`` ended up in ``after``."""
+    old_lines = split_lines(before)
+    new_lines = split_lines(after)
+    opcodes = SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+
+    def shift(line: int, first: bool) -> int:
+        # 0-based index of the line in ``after``
+        index = line - 1
+        for tag, i1, i2, j1, j2 in opcodes:
+            if i1 <= index < i2:
+                if tag == "equal":
+                    return j1 + index - i1
+                return j1 if first else max(j1, j2 - 1)
+        return len(new_lines) - 1
+
+    shifted = []
+    for start, end in line_ranges:
+        new_start = shift(start, first=True) + 1
+        new_end = shift(end, first=False) + 1
+        shifted.append((max(1, new_start), max(1, new_start, new_end)))
+    return shifted
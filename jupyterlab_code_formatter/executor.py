@@ -0,0 +1,621 @@
+import asyncio
+import multiprocessing
+import pickle
+import time
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import partial
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from traitlets import Enum, Integer
+from traitlets.config import LoggingConfigurable
+
+from jupyterlab_code_formatter.cache import FormatCache, make_cache_key
+from jupyterlab_code_formatter.cancellation import (
+    CancelScope,
+    FormatCancelled,
+    run_in_scope,
+)
+from jupyterlab_code_formatter.edits import (
+    LineRange,
+    cell_edits,
+    line_edits,
+    split_lines,
+)
+from jupyterlab_code_formatter.formatters import (
+    SERVER_FORMATTERS,
+    BaseFormatter,
+    format_batch_with_pipeline,
+    format_range_with_pipeline,
+    format_with_pipeline,
+    is_importable,
+)
+from jupyterlab_code_formatter.metrics import FormatMetrics
+from jupyterlab_code_formatter.phases import collect_phases
+
+# A formatter name and the options to run it with
+Stage = Tuple[str, Dict[str, Any]]
+
+# Pure Python formatters imported by every worker process as it starts, so the first
+# cells sent to a fresh worker don't pay for the import.
+PRELOADED_MODULES = ["black", "isort", "yapf", "autopep8"]
+
+
+def _warm_up_worker() -> None:
+    for module in PRELOADED_MODULES:
+        if is_importable(module):
+            try:
+                __import__(module)
+            except Exception:
+                pass
+
+
+def _warm_up_formatter(name: str, code: str, options: Dict[str, Any]) -> bool:
+    formatter = SERVER_FORMATTERS[name]
+    if not formatter.importable:
+        return False
+    formatter.format_code(code, True, **options)
+    return True
+
+
+def stages_name(stages: List[Stage]) -> str:
+    """Name of a chain of formatters, e.g. in metrics."""
+    return ",".join(name for name, _ in stages)
+
+
+def format_cells(
+    stages: List[Stage], code: List[str], notebook: bool
+) -> List[Dict[str, str]]:
+    """Format every cell with the named formatters, keeping errors per cell."""
+    return format_cells_with(
+        [(SERVER_FORMATTERS[name], options) for name, options in stages],
+        code,
+        notebook,
+    )
+
+
+def format_cells_with(
+    stages: List[Tuple[BaseFormatter, Dict[str, Any]]],
+    code: List[str],
+    notebook: bool,
+) -> List[Dict[str, str]]:
+    try:
+        results = format_batch_with_pipeline(stages, code, notebook)
+    except Exception as e:
+        return [{"error": str(e)} for _ in code]
+    return [
+        {"error": str(result)} if isinstance(result, Exception) else {"code": result}
+        for result in results
+    ]
+
+
+def format_range(
+    stages: List[Stage], code: str, line_ranges: Optional[List[LineRange]]
+) -> Dict[str, Any]:
+    """Format some lines of a file, or all of it, returning the edits to apply to it."""
+    formatters = [(SERVER_FORMATTERS[name], options) for name, options in stages]
+    if line_ranges is not None:
+        # formatters may reject lines past the end of the file
+        line_count = max(1, len(split_lines(code)))
+        line_ranges = [
+            (min(start, line_count), min(end, line_count))
+            for start, end in line_ranges
+            if start <= line_count
+        ]
+        if not line_ranges:
+            return {"code": code, "edits": []}
+    try:
+        if line_ranges is None:
+            formatted_code = format_with_pipeline(formatters, code, False)
+        else:
+            formatted_code = format_range_with_pipeline(
+                formatters, code, False, line_ranges
+            )
+    except Exception as e:
+        return {"error": str(e)}
+    return {"code": formatted_code, "edits": line_edits(code, formatted_code)}
+
+
+class ExecutorBusyError(Exception):
+    pass
+
+
+class FormatExecutor(LoggingConfigurable):
+    """Runs formatters in a worker pool so they never block the server's event loop.
+
+    In ``thread`` mode each format request is a single job in the pool, so a huge
+    notebook occupies one worker while other requests keep being served by the
+    remaining ones. In ``process`` mode the cells of a request are split in chunks
+    that are formatted in parallel by worker processes, sidestepping the GIL for pure
+    Python formatters.
+
+    Formatters declaring an ``execution`` mode are run where they ask regardless of
+    the mode, e.g. ``in_process`` ones on the event loop itself and ``serial`` ones
+    from a single dedicated thread.
+    """
+
+    mode = Enum(
+        ["thread", "process"],
+        default_value="thread",
+        config=True,
+        help="Run formatters in a pool of worker threads or of worker processes.",
+    )
+
+    max_workers = Integer(
+        4,
+        config=True,
+        help="Number of worker threads or processes used to run formatters.",
+    )
+
+    cells_per_task = Integer(
+        8,
+        config=True,
+        help="Number of cells of a request handed to a worker process at once.",
+    )
+
+    max_pending_requests = Integer(
+        32,
+        config=True,
+        help=(
+            "Maximum number of format requests running or waiting for a worker. "
+            "Requests beyond this limit are rejected with HTTP 503 until a slot "
+            "frees up."
+        ),
+    )
+
+    def __init__(
+        self,
+        cache: Optional[FormatCache] = None,
+        metrics: Optional[FormatMetrics] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else FormatMetrics(parent=self)
+        self._thread_pool: Optional[Executor] = None
+        self._serial_pool: Optional[Executor] = None
+        self._process_pool: Optional[Executor] = None
+        self._pending = 0
+        self._scopes: Dict[str, CancelScope] = {}
+        self._picklable: Dict[str, bool] = {}
+        # version of each formatter, looked up once
+        self._versions: Dict[str, Tuple[Any, Optional[str]]] = {}
+
+    @property
+    def thread_pool(self) -> Executor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="jupyterlab_code_formatter",
+            )
+        return self._thread_pool
+
+    @property
+    def serial_pool(self) -> Executor:
+        """Single thread running the formatters which are not thread safe."""
+        if self._serial_pool is None:
+            self._serial_pool = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="jupyterlab_code_formatter_serial"
+            )
+        return self._serial_pool
+
+    @property
+    def process_pool(self) -> Executor:
+        if self._process_pool is None:
+            # forking a server process that already runs threads is unsafe
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up_worker,
+            )
+        return self._process_pool
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def format(
+        self,
+        formatter_name: str,
+        code: List[str],
+        notebook: bool,
+        options: Dict[str, Any],
+    ) -> List[Dict[str, str]]:
+        return await self.format_pipeline([(formatter_name, options)], code, notebook)
+
+    async def format_pipeline(
+        self,
+        stages: List[Stage],
+        code: List[str],
+        notebook: bool,
+        request_id: Optional[str] = None,
+    ) -> List[Dict[str, str]]:
+        """Run each cell through the formatters one after the other.
+
+        A ``request_id`` allows cancelling the request with ``cancel``, cells not
+        formatted yet then get an error.
+        """
+        with self._pending_request(request_id) as scope:
+            return await self._format_pipeline(stages, code, notebook, scope)
+
+    async def format_pipeline_stream(
+        self,
+        stages: List[Stage],
+        code: List[str],
+        notebook: bool,
+        request_id: Optional[str] = None,
+    ) -> AsyncIterator[Tuple[int, List[Dict[str, str]]]]:
+        """Same as ``format_pipeline``, yielding results chunk by chunk.
+
+        Each chunk comes with the index of its first cell, as soon as it's formatted;
+        cells of the chunks not yet started are never formatted if the iteration is
+        stopped early or the request is cancelled. Chains with a formatter formatting
+        cells in batches, e.g. with a single command line invocation, get all of them
+        at once, each formatter of the chain formatting every cell in turn.
+        """
+        with self._pending_request(request_id) as scope:
+            size = max(1, self.cells_per_task)
+            if any(SERVER_FORMATTERS[name].supports_batch for name, _ in stages):
+                size = max(1, len(code))
+            elif self.mode == "process":
+                # a chunk is spread over all the worker processes
+                size *= max(1, self.max_workers)
+            for start in range(0, len(code), size):
+                if scope.cancelled:
+                    return
+                yield (
+                    start,
+                    await self._format_pipeline(
+                        stages, code[start : start + size], notebook, scope
+                    ),
+                )
+
+    def cancel(self, request_id: str) -> bool:
+        """Stop formatting the cells of a request, killing its subprocesses."""
+        scope = self._scopes.get(request_id)
+        if scope is None:
+            return False
+        scope.cancel()
+        return True
+
+    async def _format_pipeline(
+        self,
+        stages: List[Stage],
+        code: List[str],
+        notebook: bool,
+        scope: CancelScope,
+    ) -> List[Dict[str, str]]:
+        loop = asyncio.get_running_loop()
+        cache_key = None
+        if self.cache is not None and self.cache.enabled:
+            cache_key = await loop.run_in_executor(
+                self.thread_pool, self._cache_key_factory, stages, notebook
+            )
+        if cache_key is None:
+            return await self._run(stages, code, notebook, scope)
+
+        keys = [cache_key(cell) for cell in code]
+        results: List[Optional[Dict[str, str]]] = []
+        for key in keys:
+            cached = self.cache.get(key)
+            results.append(None if cached is None else {"code": cached})
+        missing = [index for index, result in enumerate(results) if result is None]
+        formatter = stages_name(stages)
+        self.metrics.observe_cache(
+            formatter, "memory", len(code) - len(missing), len(missing)
+        )
+
+        if missing and self.cache.disk.enabled:
+            stored = await loop.run_in_executor(
+                self.thread_pool,
+                self.cache.disk.get_many,
+                [keys[index] for index in missing],
+            )
+            for index in missing:
+                if keys[index] in stored:
+                    self.cache.put(keys[index], stored[keys[index]])
+                    results[index] = {"code": stored[keys[index]]}
+            self.metrics.observe_cache(
+                formatter, "disk", len(stored), len(missing) - len(stored)
+            )
+            missing = [index for index in missing if results[index] is None]
+
+        if missing:
+            formatted_code = await self._run(
+                stages, [code[index] for index in missing], notebook, scope
+            )
+            new_entries = []
+            for index, result in zip(missing, formatted_code):
+                results[index] = result
+                if "code" in result:
+                    new_entries.append((keys[index], result["code"]))
+                    # formatted code is expected to be left alone when formatted again
+                    new_entries.append((cache_key(result["code"]), result["code"]))
+            for key, value in new_entries:
+                self.cache.put(key, value)
+            if new_entries and self.cache.disk.enabled:
+                # nobody needs to wait for the write to hit the disk
+                loop.run_in_executor(
+                    self.thread_pool, self.cache.disk.put_many, new_entries
+                )
+        return results
+
+    async def as_edits(
+        self, code: List[str], results: List[Dict[str, str]]
+    ) -> List[Dict[str, Any]]:
+        """Replace formatted cells by the edits turning ``code`` into them."""
+        edits: List[Dict[str, Any]] = []
+        changed = []
+        for index, (cell, result) in enumerate(zip(code, results)):
+            if "code" in result and result["code"] != cell:
+                changed.append(index)
+                edits.append({})
+            else:
+                edits.append(cell_edits(cell, result))
+        if changed:
+            # diffing is left to a worker, there may be many large cells
+            loop = asyncio.get_running_loop()
+            changed_edits = await loop.run_in_executor(
+                self.thread_pool,
+                lambda: [cell_edits(code[index], results[index]) for index in changed],
+            )
+            for index, cell_edit in zip(changed, changed_edits):
+                edits[index] = cell_edit
+        return edits
+
+    async def format_range(
+        self,
+        stages: List[Stage],
+        code: str,
+        line_ranges: Optional[List[LineRange]],
+        request_id: Optional[str] = None,
+    ) -> Dict[str, Union[str, List[Dict[str, Any]]]]:
+        """Format the given lines (1-based, inclusive) of a file, or all of it.
+
+        Formatters which can't format only part of a file format all of it, either way
+        the result comes with the line edits turning ``code`` into it.
+        """
+        with self._pending_request(request_id) as scope:
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            result, phases = await loop.run_in_executor(
+                self._thread_pool_for(stages),
+                run_in_scope,
+                scope,
+                collect_phases,
+                format_range,
+                stages,
+                code,
+                line_ranges,
+            )
+            name = stages_name(stages)
+            self.metrics.observe_format(
+                name, [code], [result], time.perf_counter() - start
+            )
+            self.metrics.observe_phases(name, phases)
+            return result
+
+    @contextmanager
+    def _pending_request(self, request_id: Optional[str]) -> Iterator[CancelScope]:
+        if self._pending >= self.max_pending_requests:
+            raise ExecutorBusyError(
+                f"Too many format requests in flight ({self._pending}), "
+                "try again later."
+            )
+        scope = CancelScope()
+        if request_id is not None:
+            self._scopes[request_id] = scope
+        self._pending += 1
+        try:
+            yield scope
+        finally:
+            self._pending -= 1
+            if request_id is not None and self._scopes.get(request_id) is scope:
+                del self._scopes[request_id]
+
+    def _execution(self, name: str) -> str:
+        """Where to run a formatter, one of ``EXECUTION_MODES``."""
+        execution = SERVER_FORMATTERS[name].execution or self.mode
+        if execution == "process" and not self._can_send_to_process(name):
+            return "thread"
+        return execution
+
+    def _execution_of(self, stages: List[Stage]) -> str:
+        """Where to run a pipeline, worker threads unless all its formatters agree."""
+        executions = {self._execution(name) for name, _ in stages}
+        if "serial" in executions:
+            return "serial"
+        if len(executions) == 1:
+            return executions.pop()
+        return "thread"
+
+    def _thread_pool_for(self, stages: List[Stage]) -> Executor:
+        if self._execution_of(stages) == "serial":
+            return self.serial_pool
+        return self.thread_pool
+
+    def _version(self, name: str) -> Optional[str]:
+        formatter = SERVER_FORMATTERS[name]
+        known = self._versions.get(name)
+        if known is None or known[0] is not formatter:
+            known = self._versions[name] = (formatter, formatter.version)
+        return known[1]
+
+    def _cache_key_factory(
+        self, stages: List[Stage], notebook: bool
+    ) -> Optional[Callable[[str], str]]:
+        """Cache key of cells, or None when results can't be cached.
+
+        Looks for configuration files on the disk, it is run in a worker thread.
+        """
+        versions = []
+        for name, options in stages:
+            version = self._version(name)
+            if version is None:
+                return None
+            config = SERVER_FORMATTERS[name].config_state(options)
+            versions.append(f"{version}+{config}" if config else version)
+        if len(stages) == 1:
+            ((name, options),) = stages
+            return partial(make_cache_key, name, versions[0], options, notebook)
+        return partial(
+            make_cache_key,
+            stages_name(stages),
+            ",".join(versions),
+            [options for _, options in stages],
+            notebook,
+        )
+
+    async def _run(
+        self,
+        stages: List[Stage],
+        code: List[str],
+        notebook: bool,
+        scope: CancelScope,
+    ) -> List[Dict[str, str]]:
+        loop = asyncio.get_running_loop()
+        execution = self._execution_of(stages)
+        start = time.perf_counter()
+        if execution == "process":
+            results, phases = await self._format_in_processes(
+                stages, code, notebook, scope
+            )
+        elif execution == "in_process":
+            results, phases = run_in_scope(
+                scope, collect_phases, format_cells, stages, code, notebook
+            )
+        else:
+            pool = self.serial_pool if execution == "serial" else self.thread_pool
+            results, phases = await loop.run_in_executor(
+                pool,
+                run_in_scope,
+                scope,
+                collect_phases,
+                format_cells,
+                stages,
+                code,
+                notebook,
+            )
+        name = stages_name(stages)
+        self.metrics.observe_format(name, code, results, time.perf_counter() - start)
+        self.metrics.observe_phases(name, phases)
+        return results
+
+    async def _format_in_processes(
+        self,
+        stages: List[Stage],
+        code: List[str],
+        notebook: bool,
+        scope: CancelScope,
+    ) -> Tuple[List[Dict[str, str]], Dict[str, float]]:
+        task = partial(
+            collect_phases,
+            format_cells_with,
+            [(SERVER_FORMATTERS[name], options) for name, options in stages],
+            notebook=notebook,
+        )
+        size = max(1, self.cells_per_task)
+        chunks = [code[start : start + size] for start in range(0, len(code), size)]
+        pool = self.process_pool
+        try:
+            futures = [pool.submit(task, chunk) for chunk in chunks]
+        except BrokenProcessPool:
+            # a worker died since the last request, e.g. killed by the OOM killer
+            self._drop_process_pool(pool)
+            pool = self.process_pool
+            futures = [pool.submit(task, chunk) for chunk in chunks]
+
+        # chunks already running in a worker process are left to complete
+        def cancel_futures() -> None:
+            for future in futures:
+                future.cancel()
+
+        scope.add_callback(cancel_futures)
+        try:
+            if futures:
+                await asyncio.wait([asyncio.wrap_future(future) for future in futures])
+        finally:
+            scope.remove_callback(cancel_futures)
+        results: List[Dict[str, str]] = []
+        phases: Dict[str, float] = {}
+        for future, chunk in zip(futures, chunks):
+            if future.cancelled():
+                results.extend({"error": str(FormatCancelled())} for _ in chunk)
+            elif isinstance(future.exception(), BrokenProcessPool):
+                # the next request gets a new pool
+                self._drop_process_pool(pool)
+                error = "A formatter worker process died unexpectedly"
+                results.extend({"error": error} for _ in chunk)
+            else:
+                chunk_results, chunk_phases = future.result()
+                results.extend(chunk_results)
+                for phase, duration in chunk_phases.items():
+                    phases[phase] = phases.get(phase, 0.0) + duration
+        return results, phases
+
+    def _drop_process_pool(self, pool: Executor) -> None:
+        if self._process_pool is pool:
+            self.log.warning("Worker process pool is broken, starting a new one")
+            self._process_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def warm_up(self, stages: List[Stage], code: str) -> Dict[str, "Future[bool]"]:
+        """Load formatters in the background by having them format ``code``.
+
+        Each formatter is run by the workers which will run it for requests, so that
+        e.g. the embedded R interpreter is started on the thread it must be used
+        from. The futures tell whether the formatter was available.
+        """
+        futures = {}
+        for name, options in stages:
+            pool = self._thread_pool_for([(name, options)])
+            futures[name] = pool.submit(_warm_up_formatter, name, code, options)
+        if self.mode == "process" or any(
+            self._execution(name) == "process" for name, _ in stages
+        ):
+            # worker processes import the common formatters as they start
+            pool = self.process_pool
+            try:
+                for _ in range(self.max_workers):
+                    pool.submit(_warm_up_worker)
+            except BrokenProcessPool:
+                self._drop_process_pool(pool)
+        return futures
+
+    def _can_send_to_process(self, formatter_name: str) -> bool:
+        """Formatters defined in a config file can't be pickled, they stay in-process."""
+        if formatter_name not in self._picklable:
+            try:
+                pickle.dumps(SERVER_FORMATTERS[formatter_name])
+            except Exception:
+                self.log.debug(
+                    "Formatter %s cannot be sent to a worker process", formatter_name
+                )
+                self._picklable[formatter_name] = False
+            else:
+                self._picklable[formatter_name] = True
+        return self._picklable[formatter_name]
+
+    def shutdown(self) -> None:
+        for pool in (self._thread_pool, self._serial_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = None
+        self._serial_pool = None
+        self._process_pool = None
@@ -1,24 +1,49 @@
 import abc
 import copy
 import importlib
+import importlib.metadata
+import json
 import logging
+import multiprocessing
+import os
 import re
 import shutil
 import subprocess
-import sys
-from functools import wraps
-from typing import List, Type
+import tempfile
+import threading
+from collections.abc import MutableMapping
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache, partial, wraps
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+
+from jupyterlab_code_formatter.cancellation import (
+    check_cancelled,
+    current_cancel_scope,
+    run_process,
+)
+from jupyterlab_code_formatter.edits import LineRange, shift_line_ranges
+from jupyterlab_code_formatter.phases import timed_phase
 
-if sys.version_info >= (3, 9):
-    from functools import cache
-else:
-    from functools import lru_cache
-
-    cache = lru_cache(maxsize=None)
+logger = logging.getLogger(__name__)
 
-from packaging import version
+# Entry point group of the formatters provided by other packages
+ENTRY_POINT_GROUP = "jupyterlab_code_formatter.formatters"
 
-logger = logging.getLogger(__name__)
+EXECUTION_MODES = ("in_process", "thread", "serial", "process")
 
 
 INCOMPATIBLE_MAGIC_LANGUAGES = [
@@ -45,179 +70,468 @@ INCOMPATIBLE_MAGIC_LANGUAGES = [
 
 
 class BaseFormatter(abc.ABC):
+    # Where the executor runs the formatter, one of EXECUTION_MODES: "in_process"
+    # on the server's event loop, for formatters too quick to be worth a thread hop,
+    # "thread" in its worker threads, e.g. for formatters starting processes of their
+    # own, "serial" in a single dedicated thread, for formatters that can't run
+    # concurrently from several threads (e.g. embedded interpreters), or "process"
+    # in its worker processes. Formatters leaving it to None follow the mode of the
+    # executor.
+    execution: Optional[str] = None
+    # Languages of the code formatted, lowercase, as named by kernels.
+    languages: Sequence[str] = ()
+    # Whether format_code is decorated with handle_line_ending_and_magic: chains of
+    # such formatters escape magics once, around all of them.
+    handles_magics = False
+    # Configuration files the formatter looks for from the working directory up.
+    config_files: Sequence[str] = ()
+    # Python package the formatter needs, checked without importing it.
+    package: Optional[str] = None
+
     @property
     @abc.abstractmethod
     def label(self) -> str:
         pass
 
     @property
-    @abc.abstractmethod
     def importable(self) -> bool:
-        pass
+        return self.package is not None and is_importable(self.package)
+
+    @classmethod
+    def available(cls, **kwargs: Any) -> bool:
+        """Whether the formatter created with ``kwargs`` could be used.
+
+        Checked without creating the formatter where possible, availability is
+        reported for every formatter and most are never used.
+        """
+        if cls.package is not None:
+            return is_importable(cls.package)
+        return bool(cls(**kwargs).importable)
+
+    @classmethod
+    def describe(cls, **kwargs: Any) -> Dict[str, Any]:
+        """What the server reports of the formatter created with ``kwargs``.
+
+        Read from the class when its attributes are plain values, formatters
+        computing them, e.g. with properties, are created to be described.
+        """
+        if (
+            isinstance(cls.label, str)
+            and isinstance(cls.languages, (list, tuple))
+            and (cls.execution is None or isinstance(cls.execution, str))
+        ):
+            return {
+                "label": cls.label,
+                "languages": list(cls.languages),
+                "batch": cls.format_batch is not BaseFormatter.format_batch,
+                "execution": cls.execution,
+            }
+        return _describe(cls(**kwargs))
 
     @abc.abstractmethod
     def format_code(self, code: str, notebook: bool, **options) -> str:
         pass
 
+    def format_escaped(self, code: str, notebook: bool, **options) -> str:
+        """Format ``code`` whose magics are escaped already, see ``handles_magics``."""
+        format_code = type(self).format_code
+        return format_code.format_escaped(self, code, notebook, **options)
+
+    @property
+    def version(self) -> Optional[str]:
+        """Version of the underlying tool, formatting results are only cached when known."""
+        return None
+
+    def config_state(self, options: Dict[str, Any]) -> str:
+        """State of the configuration files used with ``options``.
+
+        Part of the cache keys, along with the version: cached results must not
+        outlive a change of configuration.
+        """
+        return files_state(self.config_files, os.getcwd())
+
     @property
-    @cache
-    def cached_importable(self) -> bool:
-        return self.importable
+    def supports_batch(self) -> bool:
+        """Whether formatting several cells at once is cheaper than one by one."""
+        return type(self).format_batch is not BaseFormatter.format_batch
+
+    def format_range(
+        self, code: str, notebook: bool, line_ranges: List[LineRange], **options
+    ) -> str:
+        """Format ``code``, leaving lines outside of ``line_ranges`` alone if possible.
+
+        Formatters unable to format only some lines format the whole code.
+        """
+        return self.format_code(code, notebook, **options)
+
+    def format_batch(
+        self, code: List[str], notebook: bool, **options
+    ) -> List[Union[str, Exception]]:
+        """Format several cells, returning the formatted code or the error of each.
+
+        Formatters able to process many inputs at once more cheaply override this.
+        """
+        results: List[Union[str, Exception]] = []
+        for cell in code:
+            try:
+                check_cancelled()
+                results.append(self.format_code(cell, notebook, **options))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def format_escaped_batch(
+        self, code: List[str], notebook: bool, **options
+    ) -> List[Union[str, Exception]]:
+        """Same as ``format_batch``, for cells whose magics are escaped already."""
+        results: List[Union[str, Exception]] = []
+        for cell in code:
+            try:
+                check_cancelled()
+                results.append(self.format_escaped(cell, notebook, **options))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+def _describe(formatter: BaseFormatter) -> Dict[str, Any]:
+    return {
+        "label": formatter.label,
+        "languages": list(formatter.languages),
+        "batch": formatter.supports_batch,
+        "execution": formatter.execution,
+    }
+
+
+def _generic_description(name: str) -> Dict[str, Any]:
+    return {
+        "label": f"Apply {name} Formatter",
+        "languages": [],
+        "batch": False,
+        "execution": None,
+    }
 
 
 class BaseLineEscaper(abc.ABC):
-    """A base class for defining how to escape certain sequence of text to avoid formatting."""
+    """A base class for defining how to escape certain sequence of text to avoid formatting.
+
+    Escapers don't look at lines themselves, their ``pattern`` joins the single regular
+    expression of ``LineEscaperRegistry`` which escapes all of them in one pass.
+    """
 
-    def __init__(self, code: str) -> None:
-        self.code = code
+    escaped_line_start = "# \x01 "
 
     @property
     @abc.abstractmethod
     def langs(self) -> List[str]:
         pass
 
+    @property
     @abc.abstractmethod
-    def escape(self, line: str) -> str:
-        pass
-
-    @abc.abstractmethod
-    def unescape(self, line: str) -> str:
+    def pattern(self) -> str:
+        """Regular expression matching the start of lines to escape."""
         pass
 
 
 class MagicCommandEscaper(BaseLineEscaper):
     langs = ["python"]
-    escaped_line_start = "# \x01 "
-    unesacpe_start = len(escaped_line_start)
-
-    def escape(self, line: str) -> str:
-        if line.lstrip().startswith("%"):
-            line = f"{self.escaped_line_start}{line}"
-        return line
-
-    def unescape(self, line: str) -> str:
-        if line.lstrip().startswith(self.escaped_line_start):
-            line = line[self.unesacpe_start :]
-        return line
+    pattern = r"\s*%"
 
 
 class RunScriptEscaper(BaseLineEscaper):
     langs = ["python"]
-    escaped_line_start = "# \x01 "
-    unesacpe_start = len(escaped_line_start)
-
-    def escape(self, line: str) -> str:
-        if re.match(pattern=r"run\s+\w+", string=line.lstrip()):
-            line = f"{self.escaped_line_start}{line}"
-        return line
-
-    def unescape(self, line: str) -> str:
-        if line.lstrip().startswith(self.escaped_line_start):
-            line = line[self.unesacpe_start :]
-        return line
+    pattern = r"\s*run\s+\w+"
 
 
 class HelpEscaper(BaseLineEscaper):
     langs = ["python"]
-    escaped_line_start = "# \x01 "
-    unesacpe_start = len(escaped_line_start)
-
-    def escape(self, line: str) -> str:
-        lstripped = line.lstrip()
-        if (
-            line.endswith("??")
-            or line.endswith("?")
-            or lstripped.startswith("?")
-            or lstripped.startswith("??")
-        ) and "#" not in line:
-            line = f"{self.escaped_line_start}{line}"
-        return line
-
-    def unescape(self, line: str) -> str:
-        if line.lstrip().startswith(self.escaped_line_start):
-            line = line[self.unesacpe_start :]
-        return line
+    # starts or ends with ? (or ??), unless there's a comment on the line
+    pattern = r"(?=[^#]*\Z)(?:\s*\?|.*\?\Z)"
 
 
 class CommandEscaper(BaseLineEscaper):
     langs = ["python"]
-    escaped_line_start = "# \x01 "
-    unesacpe_start = len(escaped_line_start)
-
-    def escape(self, line: str) -> str:
-        if line.lstrip().startswith("!"):
-            line = f"{self.escaped_line_start}{line}"
-        return line
-
-    def unescape(self, line: str) -> str:
-        if line.lstrip().startswith(self.escaped_line_start):
-            line = line[self.unesacpe_start :]
-        return line
+    pattern = r"\s*!"
 
 
 class QuartoCommentEscaper(BaseLineEscaper):
     langs = ["python"]
-    escaped_line_start = "# \x01 "
-    unesacpe_start = len(escaped_line_start)
-
-    def escape(self, line: str) -> str:
-        if line.lstrip().startswith("#| "):
-            line = f"{self.escaped_line_start}{line}"
-        return line
-
-    def unescape(self, line: str) -> str:
-        if line.lstrip().startswith(self.escaped_line_start):
-            line = line[self.unesacpe_start :]
-        return line
+    pattern = r"\s*#\| "
+
+
+class LineEscaperRegistry:
+    """Escapes the lines matched by any of the registered escapers.
+
+    Patterns of all escapers are compiled into one regular expression, so each line
+    is classified once however many escapers are registered. Register new escapers
+    with ``ESCAPERS.register``, which can also be used as a class decorator.
+    """
+
+    def __init__(self, escapers: Iterable[Type[BaseLineEscaper]] = ()) -> None:
+        self._escapers: List[Type[BaseLineEscaper]] = list(escapers)
+        self._compile()
+
+    def __iter__(self) -> Iterator[Type[BaseLineEscaper]]:
+        return iter(self._escapers)
+
+    def register(self, escaper_cls: Type[BaseLineEscaper]) -> Type[BaseLineEscaper]:
+        self._escapers.append(escaper_cls)
+        self._compile()
+        return escaper_cls
+
+    def _compile(self) -> None:
+        groups = {
+            f"_escaper{index}": escaper_cls
+            for index, escaper_cls in enumerate(self._escapers)
+        }
+        self._escaped_line_starts = {
+            group: escaper_cls.escaped_line_start
+            for group, escaper_cls in groups.items()
+        }
+        # an empty alternation would match every line
+        self._escape_match = re.compile(
+            "|".join(
+                f"(?P<{group}>{escaper_cls.pattern})"
+                for group, escaper_cls in groups.items()
+            )
+            or "(?!)"
+        ).match
+        line_starts = sorted(set(self._escaped_line_starts.values()), reverse=True)
+        self._unescape_match = re.compile(
+            r"\s*(%s)" % "|".join(map(re.escape, line_starts))
+            if line_starts
+            else "(?!)"
+        ).match
+
+    def escape(self, code: str) -> str:
+        match = self._escape_match
+        escaped_line_starts = self._escaped_line_starts
+        lines = code.splitlines()
+        for index, line in enumerate(lines):
+            matched = match(line)
+            if matched is not None:
+                lines[index] = escaped_line_starts[matched.lastgroup] + line
+        return "\n".join(lines)
+
+    def unescape(self, code: str) -> str:
+        match = self._unescape_match
+        lines = code.splitlines()
+        for index, line in enumerate(lines):
+            matched = match(line)
+            if matched is not None:
+                # the formatter may have indented the marker, the original line
+                # with its own indentation follows it
+                lines[index] = line[matched.end(1) :]
+        lines.append("")
+        return "\n".join(lines)
 
 
-ESCAPER_CLASSES: List[Type[BaseLineEscaper]] = [
+ESCAPERS = LineEscaperRegistry([
     MagicCommandEscaper,
     HelpEscaper,
     CommandEscaper,
     QuartoCommentEscaper,
     RunScriptEscaper,
-]
+])
+
+
+def _has_incompatible_magic(code: str) -> bool:
+    if any(
+        code.startswith((f"%{lang}", f"%%{lang}"))
+        for lang in INCOMPATIBLE_MAGIC_LANGUAGES
+    ):
+        logger.info("Non compatible magic language cell block detected, ignoring.")
+        return True
+    return False
+
+
+def _restore(code: str, notebook: bool, has_semicolon: bool) -> str:
+    code = ESCAPERS.unescape(code)
+
+    if notebook:
+        code = code.rstrip()
+
+    if has_semicolon and notebook and not code.endswith(";"):
+        code += ";"
+    return code
+
+
+def _format_escaped(
+    code: str, notebook: bool, format_func: Callable[[str], str]
+) -> str:
+    """Escape magics and the like from ``code``, format it, then restore them."""
+    if _has_incompatible_magic(code):
+        return code
+
+    has_semicolon = code.strip().endswith(";")
+    with timed_phase("escape"):
+        escaped = ESCAPERS.escape(code)
+    code = format_func(escaped)
+    with timed_phase("escape"):
+        return _restore(code, notebook, has_semicolon)
+
+
+def _format_escaped_batch(
+    code: List[str],
+    notebook: bool,
+    format_func: Callable[[List[str]], List[Union[str, Exception]]],
+) -> List[Union[str, Exception]]:
+    """Same as ``_format_escaped``, for formatters processing many cells at once."""
+    results: List[Union[str, Exception]] = list(code)
+    to_format = [
+        index for index, cell in enumerate(code) if not _has_incompatible_magic(cell)
+    ]
+    with timed_phase("escape"):
+        escaped = [ESCAPERS.escape(code[index]) for index in to_format]
+    formatted = format_func(escaped)
+    with timed_phase("escape"):
+        for index, result in zip(to_format, formatted):
+            if isinstance(result, Exception):
+                results[index] = result
+            else:
+                has_semicolon = code[index].strip().endswith(";")
+                results[index] = _restore(result, notebook, has_semicolon)
+    return results
 
 
 def handle_line_ending_and_magic(func):
     @wraps(func)
     def wrapped(self, code: str, notebook: bool, **options) -> str:
-        if any(
-            code.startswith((f"%{lang}", f"%%{lang}"))
-            for lang in INCOMPATIBLE_MAGIC_LANGUAGES
-        ):
-            logger.info("Non compatible magic language cell block detected, ignoring.")
-            return code
+        return _format_escaped(
+            code, notebook, lambda escaped: func(self, escaped, notebook, **options)
+        )
 
-        has_semicolon = code.strip().endswith(";")
+    # called by BaseFormatter.format_escaped
+    wrapped.format_escaped = func
+    return wrapped
 
-        escapers = [escaper_cls(code) for escaper_cls in ESCAPER_CLASSES]
 
-        lines = code.splitlines()
-        for escaper in escapers:
-            lines = map(escaper.escape, lines)
-        code = "\n".join(lines)
+def format_with_pipeline(
+    stages: Sequence[Tuple[BaseFormatter, Dict[str, Any]]],
+    code: str,
+    notebook: bool,
+) -> str:
+    """Apply formatters one after the other.
 
-        code = func(self, code, notebook, **options)
+    When every formatter ``handles_magics``, magics are escaped once around the
+    whole chain rather than around each formatter.
+    """
+    if len(stages) == 1 or not all(formatter.handles_magics for formatter, _ in stages):
+        for formatter, options in stages:
+            code = formatter.format_code(code, notebook, **options)
+        return code
 
-        lines = code.splitlines()
-        lines.append("")
+    def format_func(escaped: str) -> str:
+        for formatter, options in stages:
+            escaped = formatter.format_escaped(escaped, notebook, **options)
+        return escaped
+
+    return _format_escaped(code, notebook, format_func)
+
+
+def format_range_with_pipeline(
+    stages: Sequence[Tuple[BaseFormatter, Dict[str, Any]]],
+    code: str,
+    notebook: bool,
+    line_ranges: List[LineRange],
+) -> str:
+    """Apply formatters one after the other to some lines of the code."""
+    for formatter, options in stages:
+        formatted = formatter.format_range(code, notebook, line_ranges, **options)
+        # the next formatter must look at the same lines, wherever they moved
+        line_ranges = shift_line_ranges(code, formatted, line_ranges)
+        code = formatted
+    return code
+
+
+def format_batch_with_pipeline(
+    stages: Sequence[Tuple[BaseFormatter, Dict[str, Any]]],
+    code: List[str],
+    notebook: bool,
+) -> List[Union[str, Exception]]:
+    """Apply formatters one after the other to several cells.
+
+    Each formatter is given all the cells at once, so that formatters processing
+    many inputs at once do so in a chain too. When every formatter
+    ``handles_magics``, magics are escaped once around the whole chain.
+    """
+    if len(stages) == 1:
+        ((formatter, options),) = stages
+        return formatter.format_batch(code, notebook, **options)
+    if all(formatter.handles_magics for formatter, _ in stages):
+        return _format_escaped_batch(
+            code,
+            notebook,
+            lambda escaped: _format_stage_by_stage(
+                stages, escaped, notebook, escaped=True
+            ),
+        )
+    return _format_stage_by_stage(stages, code, notebook)
+
+
+def _format_stage_by_stage(
+    stages: Sequence[Tuple[BaseFormatter, Dict[str, Any]]],
+    code: List[str],
+    notebook: bool,
+    escaped: bool = False,
+) -> List[Union[str, Exception]]:
+    """Run each formatter on all the cells, but those a previous formatter failed."""
+    results: List[Union[str, Exception]] = list(code)
+    for formatter, options in stages:
+        check_cancelled()
+        to_format = [
+            index
+            for index, result in enumerate(results)
+            if not isinstance(result, Exception)
+        ]
+        if not to_format:
+            break
+        cells = [results[index] for index in to_format]
+        try:
+            if escaped:
+                formatted = formatter.format_escaped_batch(cells, notebook, **options)
+            else:
+                formatted = formatter.format_batch(cells, notebook, **options)
+        except Exception as e:
+            formatted = [e] * len(cells)
+        for index, result in zip(to_format, formatted):
+            results[index] = result
+    return results
 
-        for escaper in escapers:
-            lines = map(escaper.unescape, lines)
-        code = "\n".join(lines)
 
-        if notebook:
-            code = code.rstrip()
+def canonical_options(options: Any) -> str:
+    """Same string for equal options, whatever the order of their keys."""
+    return json.dumps(options, sort_keys=True, default=str)
 
-        if has_semicolon and notebook and not code.endswith(";"):
-            code += ";"
-        return code
+
+def memoize_options(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Cache what ``func(**options)`` returns for each distinct ``options``.
+
+    For building the objects formatters derive from their options (e.g. black's
+    ``FileMode``) once rather than for every cell. Results must not be modified.
+    """
+    results: Dict[str, Any] = {}
+
+    @wraps(func)
+    def wrapped(**options: Any) -> Any:
+        key = canonical_options(options)
+        if key not in results:
+            if len(results) >= 128:
+                results.clear()
+            results[key] = func(**options)
+        return results[key]
 
     return wrapped
 
 
+@lru_cache(maxsize=None)
+def black_version_at_least(minimum: str) -> bool:
+    """Whether the loaded black, which can't change until a restart, is recent enough."""
+    from packaging import version
+
+    return version.parse(import_black().__version__) >= version.parse(minimum)
+
+
 BLUE_MONKEY_PATCHED = False
 
 
@@ -231,25 +545,82 @@ def command_exist(name: str) -> bool:
     return shutil.which(name) is not None
 
 
-def import_black():
-    global BLUE_MONKEY_PATCHED
-    if BLUE_MONKEY_PATCHED:
-        for module in list(sys.modules):
-            if module.startswith("black."):
-                importlib.reload(sys.modules[module])
+def package_version(pkg_name: str) -> Optional[str]:
+    try:
+        return importlib.metadata.version(pkg_name)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def file_state(path: str) -> Optional[str]:
+    """Identify a file by its location, size and modification time."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def files_state(names: Sequence[str], start: str) -> str:
+    """Identify the files named ``names`` in ``start`` and its parent directories.
 
-        import black
+    All of them count, a file added closer to ``start`` may take precedence.
+    """
+    states = []
+    directory = os.path.abspath(start)
+    while names:
+        for name in names:
+            state = file_state(os.path.join(directory, name))
+            if state is not None:
+                states.append(state)
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    return ";".join(states)
 
-        black = importlib.reload(black)
-        BLUE_MONKEY_PATCHED = False
-    else:
-        import black
 
-    return black
+def command_version(name: str) -> Optional[str]:
+    """Identify an executable by its location and modification time.
+
+    Asking the tool itself (``--version``) would cost a process spawn.
+    """
+    path = shutil.which(name)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+# Modules of formatters imported by import_module_once
+_IMPORTED: Set[str] = set()
+_IMPORT_LOCK = threading.Lock()
+
+
+def import_module_once(name: str) -> Any:
+    """Import a formatter's module, letting a single thread do the first import.
+
+    Threads importing a compiled module (e.g. isort or black) while another one does
+    can get it half initialized, with attributes missing.
+    """
+    if name not in _IMPORTED:
+        with _IMPORT_LOCK, timed_phase("import"):
+            module = importlib.import_module(name)
+            _IMPORTED.add(name)
+            return module
+    return importlib.import_module(name)
+
+
+def import_black():
+    return import_module_once("black")
 
 
 def import_blue():
-    """Import blue and perform monkey patch."""
+    """Import blue and perform monkey patch.
+
+    Patching black affects the whole process, it is only done in the worker process
+    blue runs in, see ``BlueFormatter``.
+    """
     global BLUE_MONKEY_PATCHED
     import blue
 
@@ -260,42 +631,126 @@ def import_blue():
     return blue
 
 
+@memoize_options
+def _blue_mode(**options: Any) -> Any:
+    return import_blue().black.FileMode(**options)
+
+
+def _format_with_blue(
+    code: List[str], options: Dict[str, Any]
+) -> List[Union[str, Exception]]:
+    """Run in the blue worker process, format cells with blue."""
+    blue = import_blue()
+    mode = _blue_mode(**options)
+    results: List[Union[str, Exception]] = []
+    for cell in code:
+        try:
+            results.append(blue.black.format_str(cell, mode=mode))
+        except Exception as e:
+            # the original exception may not survive a round trip through pickle
+            results.append(FormatterError(str(e)))
+    return results
+
+
 class BlueFormatter(BaseFormatter):
+    """Blue monkey patches black, it runs in its own process to leave black alone.
+
+    Switching between both formatters in a single process meant reloading every
+    black module each time, and requests formatting with black while another was
+    formatting with blue could get the wrong one.
+    """
+
     label = "Apply Blue Formatter"
+    languages = ("python",)
+    package = "blue"
+    handles_magics = True
+    # it already runs in a process of its own
+    execution = "thread"
 
-    @property
-    def importable(self) -> bool:
-        return is_importable("blue")
+    _pool: Optional[ProcessPoolExecutor] = None
+    _pool_lock = threading.Lock()
 
-    @staticmethod
-    def handle_options(**options):
-        blue = import_blue()
+    @property
+    def version(self) -> Optional[str]:
+        # blue formats through a monkey patched black
+        return f"{package_version('blue')}+black{package_version('black')}"
+
+    @classmethod
+    def pool(cls) -> ProcessPoolExecutor:
+        with cls._pool_lock:
+            if cls._pool is None:
+                # forking a server process that already runs threads is unsafe
+                cls._pool = ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=import_blue,
+                )
+            return cls._pool
 
-        return {"mode": blue.black.FileMode(**options)}
+    def _format_in_worker(
+        self, code: List[str], options: Dict[str, Any]
+    ) -> List[Union[str, Exception]]:
+        check_cancelled()
+        pool = self.pool()
+        try:
+            future = pool.submit(_format_with_blue, code, options)
+        except BrokenProcessPool:
+            # the worker died, e.g. killed by the OOM killer, start a new one
+            with self._pool_lock:
+                if BlueFormatter._pool is pool:
+                    BlueFormatter._pool = None
+            future = self.pool().submit(_format_with_blue, code, options)
+
+        scope = current_cancel_scope()
+        if scope is not None:
+            scope.add_callback(future.cancel)
+        try:
+            return future.result()
+        except CancelledError:
+            check_cancelled()
+            raise
+        finally:
+            if scope is not None:
+                scope.remove_callback(future.cancel)
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        blue = import_blue()
+        (result,) = self._format_in_worker([code], options)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def format_batch(
+        self, code: List[str], notebook: bool, **options
+    ) -> List[Union[str, Exception]]:
+        return _format_escaped_batch(
+            code,
+            notebook,
+            lambda escaped: self.format_escaped_batch(escaped, notebook, **options),
+        )
 
-        code = blue.black.format_str(code, **self.handle_options(**options))
-        return code
+    def format_escaped_batch(
+        self, code: List[str], notebook: bool, **options
+    ) -> List[Union[str, Exception]]:
+        # a single round trip to the worker for all the cells
+        return self._format_in_worker(code, options)
 
 
 class BlackFormatter(BaseFormatter):
     label = "Apply Black Formatter"
+    languages = ("python",)
+    package = "black"
+    handles_magics = True
 
     @property
-    def importable(self) -> bool:
-        return is_importable("black")
+    def version(self) -> Optional[str]:
+        return package_version("black")
 
     @staticmethod
+    @memoize_options
     def handle_options(**options):
-        black = import_black()
-
-        file_mode_change_version = version.parse("19.3b0")
-        current_black_version = version.parse(black.__version__)
-        if current_black_version >= file_mode_change_version:
-            return {"mode": black.FileMode(**options)}
+        if black_version_at_least("19.3b0"):
+            return {"mode": import_black().FileMode(**options)}
         else:
             return options
 
@@ -306,86 +761,145 @@ class BlackFormatter(BaseFormatter):
         code = black.format_str(code, **self.handle_options(**options))
         return code
 
+    def format_range(
+        self, code: str, notebook: bool, line_ranges: List[LineRange], **options
+    ) -> str:
+        # only black 23.11 and later can format some lines of a file
+        if not black_version_at_least("23.11"):
+            return super().format_range(code, notebook, line_ranges, **options)
+        black = import_black()
+        return _format_escaped(
+            code,
+            notebook,
+            lambda escaped: black.format_str(
+                escaped, lines=line_ranges, **self.handle_options(**options)
+            ),
+        )
+
 
 class Autopep8Formatter(BaseFormatter):
     label = "Apply Autopep8 Formatter"
+    languages = ("python",)
+    package = "autopep8"
+    handles_magics = True
 
     @property
-    def importable(self) -> bool:
-        return is_importable("autopep8")
+    def version(self) -> Optional[str]:
+        return package_version("autopep8")
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        from autopep8 import fix_code
+        autopep8 = import_module_once("autopep8")
 
-        return fix_code(code, options=options)
+        return autopep8.fix_code(code, options=options)
 
 
 class YapfFormatter(BaseFormatter):
     label = "Apply YAPF Formatter"
+    languages = ("python",)
+    package = "yapf"
+    handles_magics = True
 
     @property
-    def importable(self) -> bool:
-        return is_importable("yapf")
+    def version(self) -> Optional[str]:
+        return package_version("yapf")
+
+    def config_state(self, options: Dict[str, Any]) -> str:
+        # the style may be a file, which yapf reads rather than the ones of the
+        # working directory
+        style_config = options.get("style_config")
+        if isinstance(style_config, str):
+            return file_state(style_config) or ""
+        return ""
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        from yapf.yapflib.yapf_api import FormatCode
+        yapf_api = import_module_once("yapf.yapflib.yapf_api")
 
-        return FormatCode(code, **options)[0]
+        return yapf_api.FormatCode(code, **options)[0]
 
 
 class IsortFormatter(BaseFormatter):
     label = "Apply Isort Formatter"
+    languages = ("python",)
+    package = "isort"
+    handles_magics = True
+    config_files = (
+        ".isort.cfg",
+        "pyproject.toml",
+        "setup.cfg",
+        "tox.ini",
+        ".editorconfig",
+    )
 
     @property
-    def importable(self) -> bool:
-        return is_importable("isort")
+    def version(self) -> Optional[str]:
+        return package_version("isort")
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        try:
-            from isort import SortImports
-
-            return SortImports(file_contents=code, **options).output
-        except ImportError:
-            import isort
+        isort = import_module_once("isort")
 
+        if hasattr(isort, "code"):
             return isort.code(code=code, **options)
+        # isort < 5
+        return isort.SortImports(file_contents=code, **options).output
+
+
+# R packages imported through rpy2, importing them again is slow
+R_PACKAGES: Dict[str, Any] = {}
+# the embedded R interpreter is not thread safe
+R_LOCK = threading.RLock()
 
 
 class RFormatter(BaseFormatter):
+    # the embedded R interpreter must only ever be used from one thread
+    execution = "serial"
+    languages = ("r",)
+    package = "rpy2"
+    handles_magics = True
+    importr_options: Dict[str, Any] = {}
+
     @property
     @abc.abstractmethod
     def package_name(self) -> str:
         pass
 
-    @property
-    def importable(self) -> bool:
-        if not command_exist("Rscript"):
-            return False
-
-        package_location = subprocess.run(
-            ["Rscript", "-e", f"cat(system.file(package='{self.package_name}'))"],
-            capture_output=True,
-            text=True,
-        )
-        return package_location != ""
+    def r_package(self):
+        """The R package, imported in the embedded R interpreter on first use.
+
+        Availability only checks for rpy2: asking R about the package would start
+        the embedded interpreter outside of the thread formatting R code, so a
+        missing package is only reported when formatting.
+        """
+        package = R_PACKAGES.get(self.package_name)
+        if package is None:
+            import rpy2.robjects.packages as rpackages
+
+            try:
+                with timed_phase("import"):
+                    package = rpackages.importr(
+                        self.package_name, **self.importr_options
+                    )
+            except rpackages.PackageNotInstalledError:
+                raise FormatterError(
+                    f"R package {self.package_name} is not installed"
+                ) from None
+            R_PACKAGES[self.package_name] = package
+        return package
 
 
 class FormatRFormatter(RFormatter):
     label = "Apply FormatR Formatter"
     package_name = "formatR"
+    importr_options = {"robject_translations": {".env": "env"}}
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        import rpy2.robjects.packages as rpackages
         from rpy2.robjects import conversion, default_converter
 
-        with conversion.localconverter(default_converter):
-            format_r = rpackages.importr(
-                self.package_name, robject_translations={".env": "env"}
-            )
+        with R_LOCK, conversion.localconverter(default_converter):
+            format_r = self.r_package()
             formatted_code = format_r.tidy_source(text=code, output=False, **options)
             return "\n".join(formatted_code[0])
 
@@ -396,11 +910,10 @@ class StylerFormatter(RFormatter):
 
     @handle_line_ending_and_magic
     def format_code(self, code: str, notebook: bool, **options) -> str:
-        import rpy2.robjects.packages as rpackages
         from rpy2.robjects import conversion, default_converter
 
-        with conversion.localconverter(default_converter):
-            styler_r = rpackages.importr(self.package_name)
+        with R_LOCK, conversion.localconverter(default_converter):
+            styler_r = self.r_package()
             formatted_code = styler_r.style_text(
                 code, **self._transform_options(styler_r, options)
             )
@@ -438,10 +951,33 @@ class FormatterError(Exception):
 
 
 class CommandLineFormatter(BaseFormatter):
-    command: List[str]
+    """Formatter reading code from stdin and writing the result to stdout.
+
+    When ``batch_command`` is given, several cells are formatted with a single
+    invocation instead: each cell is written to a file of a temporary directory,
+    ``batch_command`` is expected to format the files passed as arguments in place.
+    """
 
-    def __init__(self, command: List[str]):
+    command: List[str]
+    batch_command: Optional[List[str]] = None
+    file_extension: str = ""
+    handles_magics = True
+    # starts a process per call, worker processes would only hand the work over
+    execution = "thread"
+
+    def __init__(
+        self,
+        command: List[str],
+        batch_command: Optional[List[str]] = None,
+        file_extension: str = "",
+        languages: Sequence[str] = (),
+        config_files: Sequence[str] = (),
+    ):
         self.command = command
+        self.batch_command = batch_command
+        self.file_extension = file_extension
+        self.languages = tuple(languages)
+        self.config_files = tuple(config_files)
 
     @property
     def label(self) -> str:
@@ -451,62 +987,501 @@ class CommandLineFormatter(BaseFormatter):
     def importable(self) -> bool:
         return command_exist(self.command[0])
 
+    @classmethod
+    def available(cls, command: Optional[List[str]] = None, **kwargs: Any) -> bool:
+        return command_exist((command or cls.command)[0])
+
+    @classmethod
+    def describe(
+        cls,
+        command: Optional[List[str]] = None,
+        batch_command: Optional[List[str]] = None,
+        languages: Sequence[str] = (),
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        if command is None:
+            return super().describe(**kwargs)
+        # created from its arguments, e.g. by SERVER_FORMATTERS
+        return {
+            "label": f"Apply {command[0]} Formatter",
+            "languages": list(languages),
+            "batch": batch_command is not None,
+            "execution": cls.execution,
+        }
+
+    @property
+    def version(self) -> Optional[str]:
+        return command_version(self.command[0])
+
+    @property
+    def supports_batch(self) -> bool:
+        return self.batch_command is not None
+
+    def config_state(self, options: Dict[str, Any]) -> str:
+        states = [super().config_state(options)]
+        # files given as arguments, e.g. ``--config=ruff.toml``
+        for arg in options.get("args", []):
+            state = file_state(str(arg).split("=", 1)[-1])
+            if state is not None:
+                states.append(state)
+        return ";".join(states)
+
     @handle_line_ending_and_magic
     def format_code(
         self, code: str, notebook: bool, args: List[str] = [], **options
     ) -> str:
-        try:
-            process = subprocess.run(
-                self.command + args,
-                input=code,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                check=True,
-            )
-        except subprocess.CalledProcessError as err:
-            msg = f"Formatter `{self.command[0]}` exited with status {err.returncode}"
-            raise FormatterError(msg) from err
+        return self._format_stdin(code, args)
+
+    def format_batch(
+        self, code: List[str], notebook: bool, args: List[str] = [], **options
+    ) -> List[Union[str, Exception]]:
+        if self.batch_command is None or len(code) < 2:
+            return super().format_batch(code, notebook, args=args, **options)
+        return _format_escaped_batch(
+            code, notebook, lambda escaped: self._format_files(escaped, args)
+        )
+
+    def format_escaped_batch(
+        self, code: List[str], notebook: bool, args: List[str] = [], **options
+    ) -> List[Union[str, Exception]]:
+        if self.batch_command is None or len(code) < 2:
+            return super().format_escaped_batch(code, notebook, args=args, **options)
+        return self._format_files(code, args)
 
+    def _error(self, returncode: int) -> FormatterError:
+        return FormatterError(
+            f"Formatter `{self.command[0]}` exited with status {returncode}"
+        )
+
+    def _format_stdin(self, code: str, args: List[str]) -> str:
+        process = run_process(self.command + args, input=code)
+        if process.returncode != 0:
+            raise self._error(process.returncode)
         return process.stdout
 
+    def _batch_arguments(self, args: List[str], paths: List[str]) -> List[str]:
+        return [*self.batch_command, *args, *paths]
+
+    def _format_files(
+        self, code: List[str], args: List[str]
+    ) -> List[Union[str, Exception]]:
+        with tempfile.TemporaryDirectory(prefix="jupyterlab_code_formatter_") as tmp:
+            paths = []
+            for index, cell in enumerate(code):
+                # fixed width names, so that no path is a prefix of another one
+                path = os.path.join(tmp, f"cell{index:06d}{self.file_extension}")
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(cell)
+                paths.append(path)
+
+            process = run_process(self._batch_arguments(args, paths))
+            # tools may print paths relative to their working directory
+            failed = [
+                process.returncode != 0 and os.path.basename(path) in process.stdout
+                for path in paths
+            ]
+            if process.returncode != 0 and not any(failed):
+                # the failure can't be pinned on some cells, format them one by one
+                return self._format_one_by_one(code, args)
+
+            results: List[Union[str, Exception]] = []
+            for path, path_failed in zip(paths, failed):
+                if path_failed:
+                    results.append(self._error(process.returncode))
+                else:
+                    with open(path, encoding="utf-8") as f:
+                        results.append(f.read())
+            return results
+
+    def _format_one_by_one(
+        self, code: List[str], args: List[str]
+    ) -> List[Union[str, Exception]]:
+        results: List[Union[str, Exception]] = []
+        for cell in code:
+            check_cancelled()
+            try:
+                results.append(self._format_stdin(cell, args))
+            except FormatterError as e:
+                results.append(e)
+        return results
+
+
+def find_config_file(names: List[str], start: str) -> Optional[str]:
+    """Look for the first of ``names`` in ``start`` and its parent directories."""
+    directory = os.path.abspath(start)
+    while True:
+        for name in names:
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate):
+                return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+class RustfmtFormatter(CommandLineFormatter):
+    label = "Apply rustfmt Formatter"
+    command = ["rustfmt"]
+    batch_command = ["rustfmt"]
+    file_extension = ".rs"
+    languages = ("rust",)
+    config_files = ("rustfmt.toml", ".rustfmt.toml")
+
+    def __init__(self):
+        # all set by the class, which describes the formatter without creating it
+        pass
+
+    def _batch_arguments(self, args: List[str], paths: List[str]) -> List[str]:
+        # on stdin rustfmt looks for its configuration from the working directory,
+        # on files from their own location: keep the former behaviour
+        config = find_config_file(["rustfmt.toml", ".rustfmt.toml"], os.getcwd())
+        config_args = [] if config is None else ["--config-path", config]
+        return [*self.batch_command, *config_args, *args, *paths]
+
+
+def find_ruff_config(start: str) -> Optional[str]:
+    """Find the configuration ruff would use for a file in ``start``."""
+    directory = os.path.abspath(start)
+    while True:
+        for name in (".ruff.toml", "ruff.toml"):
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate):
+                return candidate
+        candidate = os.path.join(directory, "pyproject.toml")
+        if os.path.isfile(candidate):
+            try:
+                with open(candidate, encoding="utf-8") as f:
+                    if "[tool.ruff" in f.read():
+                        return candidate
+            except OSError:
+                pass
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+
+def _has_ruff_config_file(args: List[str]) -> bool:
+    """Whether user arguments already select a configuration file."""
+    if "--isolated" in args:
+        return True
+    for index, arg in enumerate(args):
+        if arg == "--config" and index + 1 < len(args):
+            value = args[index + 1]
+        elif arg.startswith("--config="):
+            value = arg[len("--config=") :]
+        else:
+            continue
+        if value.endswith(".toml") or os.path.isfile(value):
+            return True
+    return False
+
 
 class RuffFixFormatter(CommandLineFormatter):
+    label = "Apply ruff fix"
     ruff_args = ["check", "-eq", "--fix-only", "-"]
+    ruff_batch_args = ["check", "-eq", "--fix-only", "--no-cache"]
+    file_extension = ".py"
+    languages = ("python",)
+    config_files = (".ruff.toml", "ruff.toml", "pyproject.toml")
+
+    def __init__(self):
+        self._ruff_command: Optional[str] = None
+
+    @classmethod
+    def available(cls, **kwargs: Any) -> bool:
+        # the binary of the ruff package, else one on the PATH
+        return is_importable("ruff") or command_exist("ruff")
 
     @property
-    def label(self) -> str:
-        return "Apply ruff fix"
+    def ruff_command(self) -> str:
+        # looked up on first use, ruff may well never be used
+        if self._ruff_command is None:
+            try:
+                from ruff.__main__ import find_ruff_bin
 
-    def __init__(self):
-        try:
-            from ruff.__main__ import find_ruff_bin
+                self._ruff_command = find_ruff_bin()
+            except (ImportError, FileNotFoundError):
+                self._ruff_command = "ruff"
+        return self._ruff_command
+
+    @property
+    def command(self) -> List[str]:
+        return [self.ruff_command, *self.ruff_args]
+
+    @property
+    def batch_command(self) -> List[str]:
+        return [self.ruff_command, *self.ruff_batch_args]
 
-            ruff_command = find_ruff_bin()
-        except (ImportError, FileNotFoundError):
-            ruff_command = "ruff"
-        self.command = [ruff_command, *self.ruff_args]
+    def _batch_arguments(self, args: List[str], paths: List[str]) -> List[str]:
+        # on stdin ruff picks its configuration from the working directory, files
+        # in a temporary directory would not see it
+        config = None if _has_ruff_config_file(args) else find_ruff_config(os.getcwd())
+        config_args = [] if config is None else ["--config", config]
+        return [*self.batch_command, *config_args, *args, *paths]
 
 
 class RuffFormatFormatter(RuffFixFormatter):
+    label = "Apply ruff formatter"
+    ruff_args = ["format", "-"]
+    ruff_batch_args = ["format", "--no-cache"]
+
+    def __init__(self):
+        super().__init__()
+        self._supports_range: Dict[Optional[str], bool] = {}
+
     @property
-    def label(self) -> str:
-        return "Apply ruff formatter"
+    def supports_range(self) -> bool:
+        """Whether this ruff accepts ``--range``, which appeared in ruff 0.3."""
+        ruff_version = self.version
+        if ruff_version not in self._supports_range:
+            try:
+                process = subprocess.run(
+                    [self.command[0], "format", "--help"],
+                    capture_output=True,
+                    text=True,
+                )
+            except OSError:
+                return False
+            self._supports_range[ruff_version] = "--range" in process.stdout
+        return self._supports_range[ruff_version]
+
+    def format_range(
+        self,
+        code: str,
+        notebook: bool,
+        line_ranges: List[LineRange],
+        args: List[str] = [],
+        **options,
+    ) -> str:
+        if not line_ranges or not self.supports_range:
+            return super().format_range(
+                code, notebook, line_ranges, args=args, **options
+            )
+        # ruff takes a single range, cover them all; it ends at the start of a line
+        start = min(start for start, _ in line_ranges)
+        end = max(end for _, end in line_ranges) + 1
+        return _format_escaped(
+            code,
+            notebook,
+            lambda escaped: self._format_stdin(
+                escaped, [f"--range={start}-{end}", *args]
+            ),
+        )
 
-    ruff_args = ["format", "-"]
 
+class PluginErrorFormatter(BaseFormatter):
+    """Stands for a formatter whose plugin failed to load, it is never available."""
 
-SERVER_FORMATTERS = {
-    "black": BlackFormatter(),
-    "blue": BlueFormatter(),
-    "autopep8": Autopep8Formatter(),
-    "yapf": YapfFormatter(),
-    "isort": IsortFormatter(),
-    "ruff": RuffFixFormatter(),
-    "ruffformat": RuffFormatFormatter(),
-    "formatR": FormatRFormatter(),
-    "styler": StylerFormatter(),
-    "scalafmt": CommandLineFormatter(command=["scalafmt", "--stdin"]),
-    "rustfmt": CommandLineFormatter(command=["rustfmt"]),
-    "astyle": CommandLineFormatter(command=["astyle"]),
-}
+    importable = False
+
+    def __init__(self, name: str, error: Exception):
+        self.name = name
+        self.error = error
+
+    @property
+    def label(self) -> str:
+        return f"Apply {self.name} Formatter"
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        raise FormatterError(f"Formatter {self.name} failed to load: {self.error}")
+
+
+def _load_entry_point(entry_point: importlib.metadata.EntryPoint) -> BaseFormatter:
+    try:
+        loaded = entry_point.load()
+        formatter = loaded() if callable(loaded) else loaded
+    except Exception as e:
+        logger.warning(
+            "Unable to load formatter %s from %s: %s",
+            entry_point.name,
+            entry_point.value,
+            e,
+        )
+        return PluginErrorFormatter(entry_point.name, e)
+    if formatter.execution not in (None, *EXECUTION_MODES):
+        logger.warning(
+            "Formatter %s has an unknown execution mode %r, ignoring it",
+            entry_point.name,
+            formatter.execution,
+        )
+        formatter.execution = None
+    return formatter
+
+
+class LazyFormatters(MutableMapping):
+    """Formatters by name, each one only created when first looked up.
+
+    Creating some formatters is not free (e.g. ruff looks for its binary), the server
+    would otherwise pay for it on start for formatters maybe never used. Formatters
+    can be registered as instances, like in a dict, or as factories.
+    """
+
+    def __init__(self, factories: Optional[Dict[str, Callable[[], Any]]] = None):
+        self._factories: Dict[str, Callable[[], Any]] = dict(factories or {})
+        self._formatters: Dict[str, Any] = {}
+        self._entry_points: Dict[str, importlib.metadata.EntryPoint] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any]) -> None:
+        """Register a formatter created by ``factory`` when first looked up."""
+        self._formatters.pop(name, None)
+        self._factories[name] = factory
+
+    def load_entry_points(self, group: str = ENTRY_POINT_GROUP) -> List[str]:
+        """Register the formatters other packages declare in the entry point ``group``.
+
+        Entry points name a formatter class, or a callable returning a formatter, by
+        the name of the formatter. Their modules are only imported when the formatter
+        is first looked up; formatters already registered under the same name, e.g.
+        from a config file, are kept.
+        """
+        names = []
+        for entry_point in importlib.metadata.entry_points(group=group):
+            known = self._entry_points.get(entry_point.name)
+            if known is not None and known == entry_point:
+                # already loaded, e.g. by a previous server of the same process
+                continue
+            if entry_point.name in self:
+                logger.warning(
+                    "Formatter %s from %s is already registered, ignoring it",
+                    entry_point.name,
+                    entry_point.value,
+                )
+                continue
+            self.register(entry_point.name, partial(_load_entry_point, entry_point))
+            self._entry_points[entry_point.name] = entry_point
+            names.append(entry_point.name)
+        return names
+
+    def loaded(self) -> List[str]:
+        """Names of the formatters created so far."""
+        return [name for name in self if name in self._formatters]
+
+    def available(self, name: str) -> Optional[bool]:
+        """Whether formatter ``name`` can be used, checked without creating it.
+
+        None when only the formatter itself can tell, e.g. for plugins: they are
+        left alone until a request uses them.
+        """
+        formatter = self._formatters.get(name)
+        if formatter is not None:
+            return bool(formatter.importable)
+        created = self._formatter_class(name)
+        if created is None:
+            return None
+        cls, kwargs = created
+        return cls.available(**kwargs)
+
+    def describe(self, name: str) -> Dict[str, Any]:
+        """Label and metadata of formatter ``name``, without creating it."""
+        formatter = self._formatters.get(name)
+        if formatter is not None:
+            return _describe(formatter)
+        created = self._formatter_class(name)
+        if created is None:
+            # described by its class once loaded, which it's not worth loading for
+            return _generic_description(name)
+        cls, kwargs = created
+        try:
+            return cls.describe(**kwargs)
+        except Exception:
+            logger.exception("Could not describe formatter %s", name)
+            return _generic_description(name)
+
+    def _formatter_class(
+        self, name: str
+    ) -> Optional[Tuple[Type[BaseFormatter], Dict[str, Any]]]:
+        """Class and keyword arguments formatter ``name`` is created with, if known."""
+        factory = self._factories[name]
+        kwargs: Dict[str, Any] = {}
+        if isinstance(factory, partial) and not factory.args:
+            factory, kwargs = factory.func, factory.keywords
+        if isinstance(factory, type) and issubclass(factory, BaseFormatter):
+            return factory, kwargs
+        return None
+
+    def __getitem__(self, name: str) -> Any:
+        try:
+            return self._formatters[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._formatters:
+                formatter = self._factories[name]()
+                self._formatters[name] = formatter
+            return self._formatters[name]
+
+    def __setitem__(self, name: str, formatter: Any) -> None:
+        if name not in self._factories:
+            self._factories[name] = lambda: formatter
+        self._formatters[name] = formatter
+
+    def __delitem__(self, name: str) -> None:
+        del self._factories[name]
+        self._formatters.pop(name, None)
+        self._entry_points.pop(name, None)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._factories))
+
+    def __len__(self) -> int:
+        return len(self._factories)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._factories
+
+    def clear(self) -> None:
+        # MutableMapping.clear would create each formatter to pop it
+        self._factories.clear()
+        self._formatters.clear()
+        self._entry_points.clear()
+
+    def copy(self) -> "LazyFormatters":
+        copied = LazyFormatters(self._factories)
+        copied._formatters = dict(self._formatters)
+        copied._entry_points = dict(self._entry_points)
+        return copied
+
+    def update(self, other: Any = (), /, **kwargs: Any) -> None:
+        if isinstance(other, LazyFormatters):
+            # e.g. restoring a copy, without creating all the formatters
+            self._factories.update(other._factories)
+            self._formatters.update(other._formatters)
+            self._entry_points.update(other._entry_points)
+            other = ()
+        super().update(other, **kwargs)
+
+    def __repr__(self) -> str:
+        return f"LazyFormatters({list(self)!r}, loaded={self.loaded()!r})"
+
+
+SERVER_FORMATTERS = LazyFormatters({
+    "black": BlackFormatter,
+    "blue": BlueFormatter,
+    "autopep8": Autopep8Formatter,
+    "yapf": YapfFormatter,
+    "isort": IsortFormatter,
+    "ruff": RuffFixFormatter,
+    "ruffformat": RuffFormatFormatter,
+    "formatR": FormatRFormatter,
+    "styler": StylerFormatter,
+    "scalafmt": partial(
+        CommandLineFormatter,
+        command=["scalafmt", "--stdin"],
+        batch_command=["scalafmt", "--non-interactive", "--quiet"],
+        file_extension=".scala",
+        languages=("scala",),
+        config_files=(".scalafmt.conf",),
+    ),
+    "rustfmt": RustfmtFormatter,
+    "astyle": partial(
+        CommandLineFormatter,
+        command=["astyle"],
+        batch_command=["astyle", "--quiet", "--suffix=none"],
+        file_extension=".cpp",
+        languages=("c", "c++", "c++11", "c++14", "c++17", "c++20", "c#", "java"),
+        config_files=(".astylerc", "_astylerc"),
+    ),
+})
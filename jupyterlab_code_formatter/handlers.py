@@ -1,66 +1,365 @@
 import json
+import time
+import uuid
+from typing import Any, Dict, List, Optional
 
 import tornado
+from jupyter_core.utils import ensure_async
 from jupyter_server.base.handlers import APIHandler
 from jupyter_server.utils import url_path_join
+from tornado.iostream import StreamClosedError
 
+from jupyterlab_code_formatter.availability import FormatterRegistry
+from jupyterlab_code_formatter.executor import (
+    ExecutorBusyError,
+    FormatExecutor,
+    Stage,
+    stages_name,
+)
 from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+from jupyterlab_code_formatter.jobs import FormatJobManager
+from jupyterlab_code_formatter.metrics import CONTENT_TYPE_LATEST
+from jupyterlab_code_formatter.notebooks import format_notebook, notebook_stages
+from jupyterlab_code_formatter.settings import read_user_settings
 
 
 class FormattersAPIHandler(APIHandler):
+    def initialize(self, registry: FormatterRegistry) -> None:
+        self.registry = registry
+
     @tornado.web.authenticated
     def get(self) -> None:
         """Show what formatters are installed and available."""
-        use_cache = self.get_query_argument("cached", default=None)
         self.finish(
             json.dumps({
                 "formatters": {
                     name: {
-                        "enabled": formatter.cached_importable
-                        if use_cache
-                        else formatter.importable,
-                        "label": formatter.label,
+                        "enabled": self.registry.is_available(name),
+                        **SERVER_FORMATTERS.describe(name),
                     }
-                    for name, formatter in SERVER_FORMATTERS.items()
+                    for name in SERVER_FORMATTERS
                 }
             })
         )
 
 
 class FormatAPIHandler(APIHandler):
+    # label of the requests in metrics
+    endpoint = "format"
+
+    def initialize(self, executor: FormatExecutor, registry: FormatterRegistry) -> None:
+        self.executor = executor
+        self.registry = registry
+        self.request_id: Optional[str] = None
+        self.stages: Optional[List[Stage]] = None
+        self.cells = 0
+
+    def on_connection_close(self) -> None:
+        # nobody is waiting for the result anymore
+        if self.request_id is not None:
+            self.executor.cancel(self.request_id)
+
+    def on_finish(self) -> None:
+        self.executor.metrics.observe_request(
+            self.endpoint,
+            self.get_status(),
+            self.request.request_time(),
+            formatters=stages_name(self.stages) if self.stages else None,
+            cells=self.cells,
+            request_id=self.request_id,
+        )
+
     @tornado.web.authenticated
-    def post(self) -> None:
+    async def post(self) -> None:
+        """Format code with one formatter, or with a chain of formatters.
+
+        A chain is given as ``formatters``, a list of ``{"formatter", "options"}``
+        objects, and is applied to each cell in a single round trip.
+
+        With ``"response": "edits"``, each formatted cell is replied as the line
+        ``edits`` to apply to it, or as ``{"unchanged": true}``, rather than as its
+        whole formatted ``code``.
+
+        The request can be cancelled with the ``request_id`` it comes with, see
+        ``CancelAPIHandler``.
+        """
         data = json.loads(self.request.body.decode("utf-8"))
-        formatter_instance = SERVER_FORMATTERS.get(data["formatter"])
-        use_cache = self.get_query_argument("cached", default=None)
-
-        if formatter_instance is None or not (
-            formatter_instance.cached_importable
-            if use_cache
-            else formatter_instance.importable
-        ):
-            self.set_status(404, f"Formatter {data['formatter']} not found!")
+        stages = self.get_stages(data)
+        if stages is None:
+            return
+        self.request_id = data.get("request_id") or uuid.uuid4().hex
+
+        try:
+            formatted_code = await self.executor.format_pipeline(
+                stages, data["code"], data["notebook"], self.request_id
+            )
+        except ExecutorBusyError as e:
+            self.set_status(503, str(e))
             self.finish()
+            return
+        if data.get("response") == "edits":
+            formatted_code = await self.executor.as_edits(data["code"], formatted_code)
+        self.finish(self.encode({"code": formatted_code}))
+
+    def encode(self, reply: Any, lines: bool = False) -> str:
+        """``reply`` in JSON, or each of its items on a line with ``lines``.
+
+        Timed as the ``encode`` phase of the request.
+        """
+        start = time.perf_counter()
+        if lines:
+            encoded = "".join(json.dumps(item) + "\n" for item in reply)
+        else:
+            encoded = json.dumps(reply)
+        self.executor.metrics.observe_phases(
+            stages_name(self.stages) if self.stages else "",
+            {"encode": time.perf_counter() - start},
+        )
+        return encoded
+
+    def get_stages(self, data: Dict[str, Any]) -> Optional[List[Stage]]:
+        """Formatters requested, or None after replying 404 if one is unavailable."""
+        if "formatters" in data:
+            stages = [
+                (stage["formatter"], stage.get("options") or {})
+                for stage in data["formatters"]
+            ]
+        else:
+            stages = [(data["formatter"], data.get("options") or {})]
+        code = data.get("code")
+        self.cells = len(code) if isinstance(code, list) else 1
+        return self.check_available(stages)
+
+    def check_available(self, stages: List[Stage]) -> Optional[List[Stage]]:
+        self.stages = stages
+        for name, _ in stages:
+            if not self.registry.is_available(name):
+                self.set_status(404, f"Formatter {name} not found!")
+                self.finish()
+                return None
+        return stages
+
+
+class FormatStreamAPIHandler(FormatAPIHandler):
+    endpoint = "format_stream"
+
+    @tornado.web.authenticated
+    async def post(self) -> None:
+        """Same as ``FormatAPIHandler``, replying as cells get formatted.
+
+        The reply is a stream of JSON lines, one per cell, each being the result of
+        the cell with its ``index`` in the request. Closing the connection stops
+        formatting the cells not yet started.
+        """
+        data = json.loads(self.request.body.decode("utf-8"))
+        stages = self.get_stages(data)
+        if stages is None:
+            return
+        self.request_id = data.get("request_id") or uuid.uuid4().hex
+
+        code = data["code"]
+        chunks = self.executor.format_pipeline_stream(
+            stages, code, data["notebook"], self.request_id
+        )
+        try:
+            async for start, results in chunks:
+                if data.get("response") == "edits":
+                    results = await self.executor.as_edits(
+                        code[start : start + len(results)], results
+                    )
+                self.set_header("Content-Type", "application/x-ndjson")
+                self.write(
+                    self.encode(
+                        [
+                            {"index": start + offset, **result}
+                            for offset, result in enumerate(results)
+                        ],
+                        lines=True,
+                    )
+                )
+                await self.flush()
+        except ExecutorBusyError as e:
+            self.set_status(503, str(e))
+        except StreamClosedError:
+            self.log.debug("Format stream closed by the client")
+            return
+        finally:
+            await chunks.aclose()
+        self.finish(set_content_type="application/x-ndjson")
+
+
+class FormatRangeAPIHandler(FormatAPIHandler):
+    endpoint = "format_range"
+
+    @tornado.web.authenticated
+    async def post(self) -> None:
+        """Format some lines of a file.
+
+        ``line_ranges`` is a list of ``[first, last]`` line numbers (1-based,
+        inclusive), the whole file is formatted when omitted. The reply has the
+        formatted ``code`` and the ``edits`` to apply to the original code, or an
+        ``error``.
+        """
+        data = json.loads(self.request.body.decode("utf-8"))
+        stages = self.get_stages(data)
+        if stages is None:
+            return
+        self.request_id = data.get("request_id") or uuid.uuid4().hex
+        line_ranges = data.get("line_ranges")
+        if line_ranges is not None:
+            line_ranges = [(int(start), int(end)) for start, end in line_ranges]
+
+        try:
+            result = await self.executor.format_range(
+                stages, data["code"], line_ranges, self.request_id
+            )
+        except ExecutorBusyError as e:
+            self.set_status(503, str(e))
+            self.finish()
+            return
+        self.finish(self.encode(result))
+
+
+class FormatNotebookAPIHandler(FormatAPIHandler):
+    endpoint = "format_notebook"
+
+    @tornado.web.authenticated
+    async def post(self) -> None:
+        """Format the code cells of a notebook of the server, given by ``path``.
+
+        The notebook is read and saved through the contents manager, so its code
+        doesn't travel to the client and back. Formatters are picked from the
+        notebook's language as the lab extension does, unless given as
+        ``formatters`` like for ``FormatAPIHandler``. With ``"dry_run": true``, the
+        notebook is left unchanged. The reply tells how many code ``cells`` were
+        formatted, how many ``changed`` and which could not be formatted.
+        """
+        data = json.loads(self.request.body.decode("utf-8"))
+        path = data["path"]
+        model = await ensure_async(
+            self.contents_manager.get(path, content=True, type="notebook")
+        )
+        notebook = model["content"]
+        if "formatters" in data or "formatter" in data:
+            stages = self.get_stages(data)
         else:
-            notebook = data["notebook"]
-            options = data.get("options", {})
-            formatted_code = []
-            for code in data["code"]:
-                try:
-                    formatted_code.append({
-                        "code": formatter_instance.format_code(
-                            code, notebook, **options
-                        )
-                    })
-                except Exception as e:
-                    formatted_code.append({"error": str(e)})
-            self.finish(json.dumps({"code": formatted_code}))
-
-
-def setup_handlers(web_app):
+            stages = notebook_stages(notebook, read_user_settings())
+            if stages is None:
+                self.set_status(400, f"Unable to find the language of {path}")
+                self.finish()
+                return
+            stages = self.check_available(stages)
+        if stages is None:
+            return
+        self.request_id = data.get("request_id") or uuid.uuid4().hex
+
+        try:
+            summary = await format_notebook(
+                self.executor, notebook, stages, self.request_id
+            )
+        except ExecutorBusyError as e:
+            self.set_status(503, str(e))
+            self.finish()
+            return
+        self.cells = summary["cells"]
+        if summary["changed"] and not data.get("dry_run"):
+            # written atomically unless disabled in the contents manager
+            await ensure_async(
+                self.contents_manager.save(
+                    {"type": "notebook", "format": "json", "content": notebook}, path
+                )
+            )
+        self.finish(
+            json.dumps({
+                "path": path,
+                "formatters": [name for name, _ in stages],
+                **summary,
+            })
+        )
+
+
+class CancelAPIHandler(APIHandler):
+    def initialize(self, executor: FormatExecutor) -> None:
+        self.executor = executor
+
+    @tornado.web.authenticated
+    def post(self) -> None:
+        """Cancel the format request with the given ``request_id``."""
+        data = json.loads(self.request.body.decode("utf-8"))
+        self.finish(json.dumps({"cancelled": self.executor.cancel(data["request_id"])}))
+
+
+class JobsAPIHandler(APIHandler):
+    def initialize(self, jobs: FormatJobManager) -> None:
+        self.jobs = jobs
+
+    @tornado.web.authenticated
+    def get(self, job_id: Optional[str] = None) -> None:
+        """Progress of a formatting job, or of all of them."""
+        if job_id is None:
+            jobs = [self.jobs.summary(job) for job in self.jobs.jobs.values()]
+            self.finish(json.dumps({"jobs": jobs}))
+            return
+        job = self.jobs.jobs.get(job_id)
+        if job is None:
+            self.set_status(404, f"Job {job_id} not found!")
+            self.finish()
+            return
+        self.finish(json.dumps(self.jobs.summary(job)))
+
+    @tornado.web.authenticated
+    def post(self, job_id: Optional[str] = None) -> None:
+        """Start formatting the files of the directory at ``path``.
+
+        ``formatters`` may give the formatters to use by language, e.g.
+        ``{"python": ["isort", "black"]}``, rather than those of the user settings.
+        The reply is the job, whose progress can then be polled.
+        """
+        data = json.loads(self.request.body.decode("utf-8"))
+        try:
+            job = self.jobs.submit(
+                data.get("path", ""), data.get("formatters"), read_user_settings()
+            )
+        except ValueError as e:
+            self.set_status(400, str(e))
+            self.finish()
+            return
+        self.set_status(202)
+        self.finish(json.dumps(job))
+
+    @tornado.web.authenticated
+    def delete(self, job_id: Optional[str] = None) -> None:
+        """Cancel a formatting job, files already formatted stay formatted."""
+        self.finish(json.dumps({"cancelled": self.jobs.cancel(job_id or "")}))
+
+
+class MetricsAPIHandler(APIHandler):
+    def initialize(self, executor: FormatExecutor) -> None:
+        self.executor = executor
+
+    @tornado.web.authenticated
+    def get(self) -> None:
+        """Expose the metrics of the formatting work in the Prometheus text format."""
+        self.write(self.executor.metrics.exposition())
+        self.finish(set_content_type=CONTENT_TYPE_LATEST)
+
+
+def setup_handlers(
+    web_app,
+    executor: Optional[FormatExecutor] = None,
+    registry: Optional[FormatterRegistry] = None,
+    jobs: Optional[FormatJobManager] = None,
+):
     host_pattern = ".*$"
 
     base_url = web_app.settings["base_url"]
+    if executor is None:
+        executor = FormatExecutor()
+    if registry is None:
+        registry = FormatterRegistry()
+        registry.start()
+    if jobs is None:
+        jobs = FormatJobManager(root_dir=web_app.settings["server_root_dir"])
 
     web_app.add_handlers(
         host_pattern,
@@ -68,6 +367,7 @@ def setup_handlers(web_app):
             (
                 url_path_join(base_url, "jupyterlab_code_formatter/formatters"),
                 FormattersAPIHandler,
+                {"registry": registry},
             )
         ],
     )
@@ -78,6 +378,42 @@ def setup_handlers(web_app):
             (
                 url_path_join(base_url, "/jupyterlab_code_formatter/format"),
                 FormatAPIHandler,
-            )
+                {"executor": executor, "registry": registry},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/format_stream"),
+                FormatStreamAPIHandler,
+                {"executor": executor, "registry": registry},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/cancel"),
+                CancelAPIHandler,
+                {"executor": executor},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/format_range"),
+                FormatRangeAPIHandler,
+                {"executor": executor, "registry": registry},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/format_notebook"),
+                FormatNotebookAPIHandler,
+                {"executor": executor, "registry": registry},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/jobs"),
+                JobsAPIHandler,
+                {"jobs": jobs},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/jobs/(\\w+)"),
+                JobsAPIHandler,
+                {"jobs": jobs},
+            ),
+            (
+                url_path_join(base_url, "/jupyterlab_code_formatter/metrics"),
+                MetricsAPIHandler,
+                {"executor": executor},
+            ),
         ],
     )
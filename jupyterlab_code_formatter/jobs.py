@@ -0,0 +1,534 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import time
+import uuid
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from jupyter_core.paths import jupyter_data_dir
+from traitlets import Enum, Float, Integer, Unicode, default
+from traitlets.config import LoggingConfigurable
+
+from jupyterlab_code_formatter.cache import canonical_options
+from jupyterlab_code_formatter.formatters import (
+    SERVER_FORMATTERS,
+    BaseFormatter,
+    format_batch_with_pipeline,
+    format_with_pipeline,
+)
+from jupyterlab_code_formatter.notebooks import notebook_language
+from jupyterlab_code_formatter.settings import (
+    all_default_formatters,
+    default_formatters,
+    formatter_stages,
+)
+
+# Languages of the files formatted by jobs, by extension
+FILE_LANGUAGES = {".ipynb": None, ".py": "python", ".r": "R"}
+
+
+def job_files(root: str) -> Iterator[str]:
+    """Files a job formats in ``root``, leaving hidden directories alone.
+
+    Symbolic links are not followed, they may lead out of the server root.
+    """
+    for directory, subdirectories, files in os.walk(root):
+        # e.g. .ipynb_checkpoints or .git
+        subdirectories[:] = sorted(d for d in subdirectories if not d.startswith("."))
+        for name in sorted(files):
+            path = os.path.join(directory, name)
+            if (
+                not name.startswith(".")
+                and _extension(name) in FILE_LANGUAGES
+                and not os.path.islink(path)
+            ):
+                yield path
+
+
+def _extension(path: str) -> str:
+    return os.path.splitext(path)[1].lower()
+
+
+def _write_atomically(path: str, content: bytes) -> None:
+    # keep the permissions of the file being replaced
+    mode = os.stat(path).st_mode
+    temp_path = os.path.join(
+        os.path.dirname(path), f".~{os.path.basename(path)}.{uuid.uuid4().hex}"
+    )
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _names(names: Union[str, List[str]]) -> List[str]:
+    # a single formatter may be given by name, as in the settings
+    return [names] if isinstance(names, str) else list(names)
+
+
+def _checked_formatters(formatters: Any) -> Dict[str, List[str]]:
+    """Formatter names by language of a job, raising ValueError if not valid."""
+    if not isinstance(formatters, dict):
+        raise ValueError("Formatters must be lists of names by language!")
+    checked = {}
+    for language, names in formatters.items():
+        if not isinstance(names, (str, list)) or not all(
+            isinstance(name, str) for name in _names(names)
+        ):
+            raise ValueError(f"Formatters of {language} must be a list of names!")
+        for name in _names(names):
+            if name not in SERVER_FORMATTERS and name not in ("noop", "skip"):
+                raise ValueError(f"Formatter {name} not found!")
+        checked[language] = _names(names)
+    return checked
+
+
+def _stages_for(
+    language: Optional[str],
+    formatters: Dict[str, Union[str, List[str]]],
+    settings: Dict[str, Any],
+    registry: Dict[str, BaseFormatter],
+) -> List[Tuple[BaseFormatter, Dict[str, Any]]]:
+    if language is None:
+        return []
+    names = next(
+        (names for key, names in formatters.items() if key.lower() == language.lower()),
+        None,
+    )
+    names = default_formatters(settings, language) if names is None else _names(names)
+    stages = formatter_stages(settings, names)
+    for name, _ in stages:
+        formatter = registry.get(name)
+        if formatter is None or not formatter.importable:
+            raise ValueError(f"Formatter {name} not found!")
+    return [(registry[name], options) for name, options in stages]
+
+
+@lru_cache(maxsize=4)
+def _unpickle_registry(pickled: bytes) -> Dict[str, BaseFormatter]:
+    # each worker process unpickles the formatters of a job once
+    return pickle.loads(pickled)
+
+
+def _format_file_in_process(
+    path: str,
+    previous_hash: Optional[str],
+    formatters: Dict[str, List[str]],
+    settings: Dict[str, Any],
+    pickled_registry: bytes,
+) -> Dict[str, Any]:
+    return format_file(
+        path, previous_hash, formatters, settings, _unpickle_registry(pickled_registry)
+    )
+
+
+def format_file(
+    path: str,
+    previous_hash: Optional[str],
+    formatters: Dict[str, List[str]],
+    settings: Dict[str, Any],
+    registry: Dict[str, BaseFormatter],
+) -> Dict[str, Any]:
+    """Format a file in place, unless its content hash is ``previous_hash``.
+
+    Run by the workers of ``FormatJobManager``, given the ``SERVER_FORMATTERS`` of
+    the server as ``registry`` since workers don't load its configuration. Returns
+    the ``status`` of the file (skipped, unchanged, formatted or error) and the
+    ``hash`` of its content once formatted, if formatted without errors.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    content_hash = hashlib.sha256(content).hexdigest()
+    if content_hash == previous_hash:
+        return {"status": "skipped", "hash": content_hash}
+
+    try:
+        text = content.decode("utf-8")
+        errors: List[str] = []
+        if _extension(path) == ".ipynb":
+            import nbformat
+
+            notebook = nbformat.reads(text, as_version=nbformat.NO_CONVERT)
+            cells = [cell for cell in notebook.cells if cell.cell_type == "code"]
+            stages = _stages_for(
+                notebook_language(notebook), formatters, settings, registry
+            )
+            results = (
+                format_batch_with_pipeline(stages, [c.source for c in cells], True)
+                if stages and cells
+                else []
+            )
+            changed = False
+            for index, (cell, result) in enumerate(zip(cells, results)):
+                if isinstance(result, Exception):
+                    errors.append(f"code cell {index + 1}: {result}")
+                elif result != cell.source:
+                    cell.source = result
+                    changed = True
+            # the notebook is written as JupyterLab does only if a cell changed
+            formatted = (
+                nbformat.writes(notebook, version=nbformat.NO_CONVERT) + "\n"
+                if changed
+                else text
+            )
+        else:
+            stages = _stages_for(
+                FILE_LANGUAGES[_extension(path)], formatters, settings, registry
+            )
+            formatted = format_with_pipeline(stages, text, False) if stages else text
+    except Exception as e:
+        return {"status": "error", "errors": [str(e)]}
+
+    if formatted == text:
+        status = "unchanged"
+    else:
+        content = formatted.encode("utf-8")
+        _write_atomically(path, content)
+        status = "formatted"
+    if errors:
+        return {"status": "error", "errors": errors}
+    return {"status": status, "hash": hashlib.sha256(content).hexdigest()}
+
+
+class FormatJobManager(LoggingConfigurable):
+    """Jobs formatting every notebook, Python and R file of a directory.
+
+    Files are formatted by a pool of worker processes. Jobs and the content hash of
+    the files they formatted are saved in ``state_path``: files unchanged since they
+    were formatted with the same formatters and settings are skipped, and jobs still
+    running when the server stopped are resumed when it starts again.
+    """
+
+    mode = Enum(
+        ["process", "thread"],
+        default_value="process",
+        config=True,
+        help="Format files in worker processes, or in threads.",
+    )
+
+    max_workers = Integer(
+        config=True, help="Number of files formatted at once by a job."
+    )
+
+    @default("max_workers")
+    def _default_max_workers(self) -> int:
+        # leave room for interactive formatting
+        return max(1, (os.cpu_count() or 2) // 2)
+
+    state_path = Unicode(
+        config=True, help="File where jobs and hashes of formatted files are saved."
+    )
+
+    @default("state_path")
+    def _default_state_path(self) -> str:
+        # servers of different directories don't share their jobs
+        root = hashlib.sha256(os.path.abspath(self.root_dir).encode()).hexdigest()
+        return os.path.join(
+            jupyter_data_dir(), "jupyterlab_code_formatter", f"jobs-{root[:16]}.json"
+        )
+
+    save_interval = Float(
+        2.0, config=True, help="Seconds between two saves of the progress of jobs."
+    )
+
+    def __init__(self, root_dir: str, **kwargs: Any) -> None:
+        self.root_dir = root_dir
+        super().__init__(**kwargs)
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        # content hash of formatted files, by path and formatting configuration
+        self.hashes: Dict[str, Dict[str, str]] = {}
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+        self._thread_pool: Optional[Executor] = None
+        self._process_pool: Optional[Executor] = None
+        self._saved_at = 0.0
+        # the state is written by a single thread, in the order it is saved
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="jupyterlab_code_formatter_job_state"
+        )
+        self._saving: Optional["Future[None]"] = None
+        self._closed = False
+        self._load()
+
+    @property
+    def thread_pool(self) -> Executor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="jupyterlab_code_formatter_job",
+            )
+        return self._thread_pool
+
+    @property
+    def process_pool(self) -> Executor:
+        if self._process_pool is None:
+            # forking a server process that already runs threads is unsafe
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._process_pool
+
+    def resolve(self, path: str) -> str:
+        """Real path of a directory given relative to the server root."""
+        root = os.path.realpath(self.root_dir)
+        # symbolic links must not lead out of the root either
+        directory = os.path.realpath(os.path.join(root, path.strip("/")))
+        if os.path.commonpath([root, directory]) != root:
+            raise ValueError(f"{path} is outside of the server root")
+        if not os.path.isdir(directory):
+            raise ValueError(f"{path} is not a directory")
+        return directory
+
+    def submit(
+        self,
+        path: str,
+        formatters: Optional[Dict[str, Union[str, List[str]]]] = None,
+        settings: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """Start formatting the files of a directory, relative to the server root.
+
+        ``formatters`` are lists of formatter names by language (``python`` for
+        Python files and notebooks, ``R`` for R ones...), defaulting to those of
+        ``settings``, the user settings of the lab extension. Raises ValueError
+        for paths out of the root or unknown formatters.
+        """
+        self.resolve(path)
+        formatters = _checked_formatters(formatters or {})
+        job = {
+            "id": uuid.uuid4().hex,
+            "path": path,
+            "formatters": formatters,
+            "settings": settings or {},
+            "status": "running",
+            "total": None,
+            "done": 0,
+            "formatted": 0,
+            "unchanged": 0,
+            "skipped": 0,
+            "errors": [],
+            "started": time.time(),
+            "finished": None,
+        }
+        self.jobs[job["id"]] = job
+        self._save(force=True)
+        self._start(job)
+        return self.summary(job)
+
+    def summary(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """Progress of a job, as replied to clients."""
+        return {key: value for key, value in job.items() if key != "settings"}
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job["status"] != "running":
+            return False
+        job["status"] = "cancelled"
+        job["finished"] = time.time()
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        self._save(force=True)
+        return True
+
+    def resume(self) -> None:
+        """Start again the jobs which were running when the server stopped."""
+        for job in self.jobs.values():
+            if job["status"] == "running" and job["id"] not in self._tasks:
+                self.log.info("Resuming formatting of %s", job["path"])
+                self._start(job)
+
+    async def wait(self, job_id: str) -> Dict[str, Any]:
+        task = self._tasks.get(job_id)
+        if task is not None:
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                pass
+        if self._saving is not None:
+            await asyncio.wrap_future(self._saving)
+        return self.summary(self.jobs[job_id])
+
+    def shutdown(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = None
+        self._process_pool = None
+        # jobs still running are resumed by the next server
+        self._save(force=True)
+        self._writer.shutdown(wait=True)
+        self._closed = True
+
+    def _start(self, job: Dict[str, Any]) -> None:
+        task = asyncio.ensure_future(self._run(job))
+        self._tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["id"], None))
+
+    def _registry(self, job: Dict[str, Any]) -> Dict[str, BaseFormatter]:
+        """Formatters a job may use, leaving the others uncreated."""
+        names = all_default_formatters(job["settings"])
+        for language_names in job["formatters"].values():
+            names.extend(_names(language_names))
+        return {
+            name: SERVER_FORMATTERS[name] for name in names if name in SERVER_FORMATTERS
+        }
+
+    def _config_key(
+        self, job: Dict[str, Any], registry: Dict[str, BaseFormatter]
+    ) -> str:
+        """Formatting configuration of a job, files are formatted again on changes."""
+        versions = {}
+        for name, formatter in registry.items():
+            options = job["settings"].get(name)
+            try:
+                versions[name] = [
+                    formatter.version,
+                    formatter.config_state(
+                        options if isinstance(options, dict) else {}
+                    ),
+                ]
+            except Exception:
+                versions[name] = None
+        return hashlib.sha256(
+            canonical_options([job["formatters"], job["settings"], versions]).encode()
+        ).hexdigest()
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            directory = self.resolve(job["path"])
+            files = await loop.run_in_executor(None, lambda: list(job_files(directory)))
+            registry = self._registry(job)
+            config = await loop.run_in_executor(None, self._config_key, job, registry)
+            job["total"] = len(files)
+            # a resumed job finds files it already formatted in the hashes
+            job["done"] = job["formatted"] = job["unchanged"] = job["skipped"] = 0
+            job["errors"] = []
+            pool, task, job_registry = self._worker_for(registry)
+            limit = asyncio.Semaphore(self.max_workers * 2)
+
+            async def format_one(path: str) -> None:
+                async with limit:
+                    known = self.hashes.get(path)
+                    previous = (
+                        known["hash"] if known and known["config"] == config else None
+                    )
+                    try:
+                        result = await loop.run_in_executor(
+                            pool,
+                            task,
+                            path,
+                            previous,
+                            job["formatters"],
+                            job["settings"],
+                            job_registry,
+                        )
+                    except Exception as e:
+                        result = {"status": "error", "errors": [str(e)]}
+                self._record(job, path, config, result)
+
+            await asyncio.gather(*(format_one(path) for path in files))
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            # either cancelled, or still running as the server is stopping: the job
+            # is then resumed when it starts again
+            self._save(force=True)
+            raise
+        except Exception as e:
+            self.log.error("Formatting %s failed: %s", job["path"], e)
+            job["status"] = "failed"
+            job["errors"].append({"path": job["path"], "error": str(e)})
+        job["finished"] = time.time()
+        self._save(force=True)
+
+    def _worker_for(
+        self, registry: Dict[str, BaseFormatter]
+    ) -> Tuple[Executor, Callable[..., Dict[str, Any]], Any]:
+        """Pool formatting the files of a job, with the task and formatters to send."""
+        if self.mode == "process":
+            try:
+                # pickled once for the whole job rather than for each file
+                pickled = pickle.dumps(registry)
+            except Exception:
+                # formatters defined in a config file can't be sent to processes
+                self.log.debug("Formatting files in threads")
+            else:
+                return self.process_pool, _format_file_in_process, pickled
+        return self.thread_pool, format_file, registry
+
+    def _record(
+        self, job: Dict[str, Any], path: str, config: str, result: Dict[str, Any]
+    ) -> None:
+        job["done"] += 1
+        status = result["status"]
+        if status == "error":
+            relative = os.path.relpath(path, self.root_dir)
+            job["errors"].extend(
+                {"path": relative, "error": error} for error in result["errors"]
+            )
+            self.hashes.pop(path, None)
+        else:
+            job[status] += 1
+            self.hashes[path] = {"hash": result["hash"], "config": config}
+        self._save()
+
+    def _load(self) -> None:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.warning(
+                "Unable to load formatting jobs from %s: %s", self.state_path, e
+            )
+            return
+        self.jobs = state.get("jobs", {})
+        self.hashes = state.get("hashes", {})
+
+    def _save(self, force: bool = False) -> None:
+        if self._closed:
+            return
+        if not force and time.monotonic() - self._saved_at < self.save_interval:
+            return
+        self._saved_at = time.monotonic()
+        # serialized and written by a thread, from a copy which jobs don't modify
+        state = {
+            "jobs": {
+                job_id: {**job, "errors": list(job["errors"])}
+                for job_id, job in self.jobs.items()
+            },
+            "hashes": dict(self.hashes),
+        }
+        self._saving = self._writer.submit(self._write, state)
+
+    def _write(self, state: Dict[str, Any]) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except OSError as e:
+            self.log.warning(
+                "Unable to save formatting jobs to %s: %s", self.state_path, e
+            )
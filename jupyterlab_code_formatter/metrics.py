@@ -0,0 +1,155 @@
+import json
+from typing import Any, Dict, List
+
+from traitlets import Bool
+from traitlets.config import LoggingConfigurable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PHASE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+class _NoMetric:
+    """Stands for the metrics when prometheus_client is not installed."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def labels(self, *labels: str) -> "_NoMetric":
+        return self
+
+    def observe(self, value: float) -> None:
+        pass
+
+    def inc(self, value: float = 1) -> None:
+        pass
+
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST,
+        CollectorRegistry,
+        Counter,
+        Histogram,
+        generate_latest,
+    )
+except ImportError:
+    # metrics are optional, see the ``metrics`` extra
+    CONTENT_TYPE_LATEST = "text/plain; version=0.0.4; charset=utf-8"
+    CollectorRegistry = None
+    Counter = Histogram = _NoMetric
+
+
+class FormatMetrics(LoggingConfigurable):
+    """Prometheus metrics of the formatting work, see ``MetricsAPIHandler``.
+
+    Metrics live in their own registry rather than in the server's global one, so
+    they are only served by the extension's own endpoint. Without prometheus_client
+    installed, metrics are not recorded and ``registry`` is None.
+    """
+
+    log_requests = Bool(
+        False,
+        config=True,
+        help="Log a line of JSON with the outcome and duration of each request.",
+    )
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.registry = None if CollectorRegistry is None else CollectorRegistry()
+        self.request_duration = Histogram(
+            "jupyterlab_code_formatter_request_duration_seconds",
+            "Time spent serving requests, including waiting for a worker.",
+            ["endpoint", "status"],
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+        self.format_duration = Histogram(
+            "jupyterlab_code_formatter_format_duration_seconds",
+            "Time spent by a worker running formatters on a batch of cells.",
+            ["formatter"],
+            buckets=LATENCY_BUCKETS,
+            registry=self.registry,
+        )
+        self.phase_duration = Histogram(
+            "jupyterlab_code_formatter_phase_duration_seconds",
+            "Time spent by requests in a phase of the formatting work: escaping "
+            "magics (escape), importing formatters (import), starting formatter "
+            "processes (spawn) or encoding replies in JSON (encode).",
+            ["formatter", "phase"],
+            buckets=PHASE_BUCKETS,
+            registry=self.registry,
+        )
+        self.cells = Counter(
+            "jupyterlab_code_formatter_cells",
+            "Cells sent to formatters, by outcome (formatted, error or cached).",
+            ["formatter", "outcome"],
+            registry=self.registry,
+        )
+        self.bytes_in = Counter(
+            "jupyterlab_code_formatter_bytes_in",
+            "Size of the code sent to formatters, in characters.",
+            ["formatter"],
+            registry=self.registry,
+        )
+        self.bytes_out = Counter(
+            "jupyterlab_code_formatter_bytes_out",
+            "Size of the code returned by formatters, in characters.",
+            ["formatter"],
+            registry=self.registry,
+        )
+        self.cache_lookups = Counter(
+            "jupyterlab_code_formatter_cache_lookups",
+            "Lookups in the format cache, by tier (memory or disk) and result.",
+            ["tier", "result"],
+            registry=self.registry,
+        )
+
+    def observe_format(
+        self,
+        formatter: str,
+        code: List[str],
+        results: List[Dict[str, str]],
+        duration: float,
+    ) -> None:
+        self.format_duration.labels(formatter).observe(duration)
+        self.bytes_in.labels(formatter).inc(sum(map(len, code)))
+        errors = sum("code" not in result for result in results)
+        if errors:
+            self.cells.labels(formatter, "error").inc(errors)
+        if len(results) > errors:
+            self.cells.labels(formatter, "formatted").inc(len(results) - errors)
+            self.bytes_out.labels(formatter).inc(
+                sum(len(result["code"]) for result in results if "code" in result)
+            )
+
+    def observe_phases(self, formatter: str, durations: Dict[str, float]) -> None:
+        for phase, duration in durations.items():
+            self.phase_duration.labels(formatter, phase).observe(duration)
+
+    def observe_cache(self, formatter: str, tier: str, hits: int, misses: int) -> None:
+        if hits:
+            self.cache_lookups.labels(tier, "hit").inc(hits)
+            self.cells.labels(formatter, "cached").inc(hits)
+        if misses:
+            self.cache_lookups.labels(tier, "miss").inc(misses)
+
+    def observe_request(
+        self, endpoint: str, status: int, duration: float, **details: Any
+    ) -> None:
+        self.request_duration.labels(endpoint, str(status)).observe(duration)
+        if self.log_requests:
+            self.log.info(
+                "jupyterlab_code_formatter request %s",
+                json.dumps({
+                    "endpoint": endpoint,
+                    "status": status,
+                    "duration": round(duration, 6),
+                    **details,
+                }),
+            )
+
+    def exposition(self) -> bytes:
+        if self.registry is None:
+            return b"# prometheus_client is not installed, no metrics are recorded\n"
+        return generate_latest(self.registry)
@@ -0,0 +1,69 @@
+from typing import Any, Dict, List, Optional
+
+from jupyterlab_code_formatter.executor import FormatExecutor, Stage
+from jupyterlab_code_formatter.settings import default_formatters, formatter_stages
+
+
+def notebook_language(notebook: Dict[str, Any]) -> Optional[str]:
+    """Language of the code cells of a notebook, found like the lab extension does."""
+    metadata = notebook.get("metadata") or {}
+    language = (metadata.get("kernelspec") or {}).get("language")
+    if isinstance(language, str) and language:
+        return language.lower()
+    language_info = metadata.get("language_info") or {}
+    mode = language_info.get("codemirror_mode")
+    if isinstance(mode, dict):
+        mode = mode.get("name")
+    if isinstance(mode, str) and mode:
+        return mode.lower()
+    name = language_info.get("name")
+    if isinstance(name, str) and name:
+        return name.lower()
+    return None
+
+
+def notebook_stages(
+    notebook: Dict[str, Any], settings: Dict[str, Any]
+) -> Optional[List[Stage]]:
+    """Default formatters for the notebook's language, None if it is unknown."""
+    language = notebook_language(notebook)
+    if language is None:
+        return None
+    return formatter_stages(settings, default_formatters(settings, language))
+
+
+def _source(cell: Dict[str, Any]) -> str:
+    source = cell.get("source", "")
+    # sources may be split in lines in the JSON of the notebook
+    return source if isinstance(source, str) else "".join(source)
+
+
+async def format_notebook(
+    executor: FormatExecutor,
+    notebook: Dict[str, Any],
+    stages: List[Stage],
+    request_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Format the code cells of a notebook in place.
+
+    Returns the number of ``cells`` formatted, how many were ``changed`` and the
+    ``errors`` of the cells which could not be formatted, by index in the notebook.
+    """
+    cells = [
+        (index, cell)
+        for index, cell in enumerate(notebook.get("cells") or [])
+        if cell.get("cell_type") == "code"
+    ]
+    code = [_source(cell) for _, cell in cells]
+    summary: Dict[str, Any] = {"cells": len(cells), "changed": 0, "errors": []}
+    if not stages or not cells:
+        return summary
+
+    results = await executor.format_pipeline(stages, code, True, request_id)
+    for (index, cell), original, result in zip(cells, code, results):
+        if "code" not in result:
+            summary["errors"].append({"cell": index, "error": result["error"]})
+        elif result["code"] != original:
+            cell["source"] = result["code"]
+            summary["changed"] += 1
+    return summary
@@ -0,0 +1,37 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+_local = threading.local()
+
+
+@contextmanager
+def timed_phase(phase: str) -> Iterator[None]:
+    """Add the time spent in the block to ``phase``, when run by ``collect_phases``.
+
+    Phases are parts of the formatting work worth watching on their own, e.g.
+    ``escape`` for escaping magics or ``spawn`` for starting subprocesses.
+    """
+    durations = getattr(_local, "phases", None)
+    if durations is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        durations[phase] = durations.get(phase, 0.0) + time.perf_counter() - start
+
+
+def collect_phases(
+    func: Callable, *args: Any, **kwargs: Any
+) -> Tuple[Any, Dict[str, float]]:
+    """Call ``func``, returning its result and the time it spent in each phase."""
+    previous = getattr(_local, "phases", None)
+    durations: Dict[str, float] = {}
+    _local.phases = durations
+    try:
+        return func(*args, **kwargs), durations
+    finally:
+        _local.phases = previous
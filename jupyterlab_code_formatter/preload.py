@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from traitlets import Bool, Unicode, default
+from traitlets import List as ListTrait
+from traitlets.config import LoggingConfigurable
+
+from jupyterlab_code_formatter.executor import FormatExecutor, Stage
+from jupyterlab_code_formatter.settings import (
+    default_formatters,
+    formatter_stages,
+    read_user_settings,
+    user_settings_path,
+)
+
+R_FORMATTERS = ("formatR", "styler")
+
+# Code exercising the formatters of each language, formatters of other languages
+# are command line tools with nothing to load in the server process
+WARM_UP_CODE = {
+    "python": "import os\nimport sys\n\n\ndef f(a, b):\n    return [a, b]\n",
+    "R": "f <- function(a, b) {\n  c(a, b)\n}\n",
+}
+
+
+class FormatterPreloader(LoggingConfigurable):
+    """Loads the formatters users format with as the server starts.
+
+    Importing black, isort or yapf, or starting the embedded R interpreter, takes
+    up to a few seconds which would otherwise be felt on the first format. It is
+    done in the background, without delaying the server start.
+    """
+
+    enabled = Bool(
+        False,
+        config=True,
+        help="Load the default formatters in the background when the server starts.",
+    )
+
+    formatters = ListTrait(
+        Unicode(),
+        default_value=None,
+        allow_none=True,
+        config=True,
+        help=(
+            "Python or R formatters to load. Defaults to the default_formatter "
+            "preferences of the lab extension's user settings."
+        ),
+    )
+
+    settings_path = Unicode(
+        config=True,
+        help="User settings of the lab extension, to read preferences from.",
+    )
+
+    @default("settings_path")
+    def _default_settings_path(self) -> str:
+        return user_settings_path()
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self._thread: Optional[threading.Thread] = None
+
+    def stages(self) -> Dict[str, List[Stage]]:
+        """Formatters to load with their options from the settings, by language."""
+        settings = read_user_settings(self.settings_path)
+        stages: Dict[str, List[Stage]] = {}
+        for language in WARM_UP_CODE:
+            if self.formatters is None:
+                names = default_formatters(settings, language)
+            else:
+                names = [
+                    name
+                    for name in self.formatters
+                    if (name in R_FORMATTERS) == (language == "R")
+                ]
+            stages[language] = formatter_stages(settings, names)
+        return stages
+
+    def start(self, executor: FormatExecutor) -> None:
+        """Load the formatters in the background, if enabled."""
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._preload,
+            args=(executor,),
+            name="jupyterlab_code_formatter_preload",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _preload(self, executor: FormatExecutor) -> None:
+        for language, stages in self.stages().items():
+            start = time.perf_counter()
+            futures = executor.warm_up(stages, WARM_UP_CODE[language])
+            for name, future in futures.items():
+                try:
+                    if future.result():
+                        self.log.info(
+                            "Preloaded formatter %s in %.2fs",
+                            name,
+                            time.perf_counter() - start,
+                        )
+                except Exception as e:
+                    self.log.warning("Unable to preload formatter %s: %s", name, e)
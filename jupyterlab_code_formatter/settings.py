@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from jupyter_core.paths import jupyter_config_dir, jupyter_path
+
+logger = logging.getLogger(__name__)
+
+EXTENSION_NAME = "jupyterlab_code_formatter"
+
+
+def schema_paths() -> Iterator[str]:
+    """Where the settings schema of the lab extension may be, first found wins."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    schema = os.path.join("schemas", EXTENSION_NAME, "settings.json")
+    # built along the package, e.g. by an editable install
+    yield os.path.join(package_dir, "labextension", schema)
+    # source checkout
+    yield os.path.join(os.path.dirname(package_dir), "schema", "settings.json")
+    for labextensions_dir in jupyter_path("labextensions"):
+        yield os.path.join(labextensions_dir, EXTENSION_NAME, schema)
+
+
+@lru_cache(maxsize=1)
+def schema_defaults() -> Dict[str, Any]:
+    """Default value of each setting of the lab extension, from its schema."""
+    for path in schema_paths():
+        try:
+            with open(path, encoding="utf-8") as f:
+                schema = json.load(f)
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            logger.warning("Unable to read the settings schema %s: %s", path, e)
+            continue
+        return {
+            name: prop["default"]
+            for name, prop in schema.get("properties", {}).items()
+            if "default" in prop
+        }
+    logger.warning("Unable to find the settings schema of %s", EXTENSION_NAME)
+    return {}
+
+
+def setting(settings: Dict[str, Any], name: str) -> Any:
+    """A setting as JupyterLab composes it: the user's value, else the default."""
+    if name in settings:
+        return settings[name]
+    return schema_defaults().get(name)
+
+
+def user_settings_path() -> str:
+    """Where JupyterLab stores the user settings of the lab extension."""
+    settings_dir = os.environ.get("JUPYTERLAB_SETTINGS_DIR") or os.path.join(
+        jupyter_config_dir(), "lab", "user-settings"
+    )
+    return os.path.join(
+        settings_dir, "jupyterlab_code_formatter", "settings.jupyterlab-settings"
+    )
+
+
+def read_user_settings(path: Optional[str] = None) -> Dict[str, Any]:
+    """User settings of the lab extension, empty if there are none or they are invalid."""
+    path = path or user_settings_path()
+    try:
+        with open(path, encoding="utf-8") as f:
+            content = f.read()
+    except FileNotFoundError:
+        return {}
+    except OSError as e:
+        logger.warning("Unable to read %s: %s", path, e)
+        return {}
+    try:
+        # settings edited in JupyterLab may have comments
+        import json5 as parser
+    except ImportError:
+        parser = json
+    try:
+        settings = parser.loads(content)
+    except ValueError as e:
+        logger.warning("Unable to parse %s: %s", path, e)
+        return {}
+    return settings if isinstance(settings, dict) else {}
+
+
+def _lookup(by_language: Dict[str, Any], language: str) -> Any:
+    if language in by_language:
+        return by_language[language]
+    # notebooks name their language in lower case, e.g. "r"
+    for key, value in by_language.items():
+        if key.lower() == language.lower():
+            return value
+    return None
+
+
+def default_formatters(settings: Dict[str, Any], language: str) -> List[str]:
+    """Formatters to apply to code in ``language``, as the lab extension would."""
+    names = _lookup(_default_formatter(settings), language)
+    if names is None:
+        return []
+    return [names] if isinstance(names, str) else list(names)
+
+
+def _default_formatter(settings: Dict[str, Any]) -> Dict[str, Any]:
+    preferences = setting(settings, "preferences")
+    if not isinstance(preferences, dict):
+        return {}
+    return preferences.get("default_formatter") or {}
+
+
+def all_default_formatters(settings: Dict[str, Any]) -> List[str]:
+    """Formatters applied to code of any language, by default or as set in ``settings``."""
+    names: Dict[str, None] = {}
+    for language in _default_formatter(settings):
+        names.update(dict.fromkeys(default_formatters(settings, language)))
+    return list(names)
+
+
+def formatter_stages(
+    settings: Dict[str, Any], names: List[str]
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """Formatters with their options from the settings, ``noop`` ones left out."""
+    stages = []
+    for name in names:
+        if name in ("noop", "skip"):
+            continue
+        options = setting(settings, name)
+        stages.append((name, options if isinstance(options, dict) else {}))
+    return stages
@@ -14,25 +14,19 @@ def jcf_serverapp(jp_serverapp: ServerApp) -> ServerApp:
     return jp_serverapp
 
 
-@pytest.fixture
-def request_format(jp_fetch):  # type: ignore[no-untyped-def]
+def post_request(jp_fetch, endpoint: str):  # type: ignore[no-untyped-def]
+    """Send a JSON body to an endpoint of the extension."""
+
     def do_request(
-        formatter: str,
-        code: t.List[str],
-        options: t.Dict[str, t.Any],
+        body: t.Dict[str, t.Any],
         headers: t.Optional[t.Dict[str, t.Any]] = None,
         **kwargs: t.Any,
     ) -> HTTPResponse:
         return jp_fetch(  # type: ignore[no-any-return]
             "jupyterlab_code_formatter",
-            "format",
+            endpoint,
             method="POST",
-            body=json.dumps({
-                "code": code,
-                "options": options,
-                "notebook": True,
-                "formatter": formatter,
-            }),
+            body=json.dumps(body),
             headers=headers,
             **kwargs,
         )
@@ -40,6 +34,60 @@ def request_format(jp_fetch):  # type: ignore[no-untyped-def]
     return do_request
 
 
+def pipeline_request(jp_fetch, endpoint: str):  # type: ignore[no-untyped-def]
+    """Format cells of a notebook with a chain of formatters."""
+    post = post_request(jp_fetch, endpoint)
+
+    def do_request(
+        formatters: t.List[t.Dict[str, t.Any]],
+        code: t.List[str],
+        headers: t.Optional[t.Dict[str, t.Any]] = None,
+        response: str = "code",
+        **kwargs: t.Any,
+    ) -> HTTPResponse:
+        body = {
+            "code": code,
+            "notebook": True,
+            "formatters": formatters,
+            "response": response,
+        }
+        return post(body, headers, **kwargs)
+
+    return do_request
+
+
+@pytest.fixture
+def request_format(jp_fetch):  # type: ignore[no-untyped-def]
+    post = post_request(jp_fetch, "format")
+
+    def do_request(
+        formatter: str,
+        code: t.List[str],
+        options: t.Dict[str, t.Any],
+        headers: t.Optional[t.Dict[str, t.Any]] = None,
+        **kwargs: t.Any,
+    ) -> HTTPResponse:
+        body = {
+            "code": code,
+            "options": options,
+            "notebook": True,
+            "formatter": formatter,
+        }
+        return post(body, headers, **kwargs)
+
+    return do_request
+
+
+@pytest.fixture
+def request_format_pipeline(jp_fetch):  # type: ignore[no-untyped-def]
+    return pipeline_request(jp_fetch, "format")
+
+
+@pytest.fixture
+def request_format_stream(jp_fetch):  # type: ignore[no-untyped-def]
+    return pipeline_request(jp_fetch, "format_stream")
+
+
 @pytest.fixture
 def request_list_formatters(jp_fetch):  # type: ignore[no-untyped-def]
     def do_request(
@@ -55,3 +103,20 @@ def request_list_formatters(jp_fetch):  # type: ignore[no-untyped-def]
         )
 
     return do_request
+
+
+@pytest.fixture
+def request_format_range(jp_fetch):  # type: ignore[no-untyped-def]
+    post = post_request(jp_fetch, "format_range")
+
+    def do_request(
+        formatters: t.List[t.Dict[str, t.Any]],
+        code: str,
+        line_ranges: t.Optional[t.List[t.List[int]]] = None,
+        headers: t.Optional[t.Dict[str, t.Any]] = None,
+        **kwargs: t.Any,
+    ) -> HTTPResponse:
+        body = {"code": code, "formatters": formatters, "line_ranges": line_ranges}
+        return post(body, headers, **kwargs)
+
+    return do_request
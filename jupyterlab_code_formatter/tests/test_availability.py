@@ -0,0 +1,120 @@
+from functools import partial
+from unittest import mock
+
+import pytest
+
+from jupyterlab_code_formatter import availability
+from jupyterlab_code_formatter.availability import FormatterRegistry
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS, BaseFormatter
+
+
+class ProbedFormatter(BaseFormatter):
+    label = "Apply Probed Formatter"
+
+    def __init__(self) -> None:
+        self.installed = True
+        self.probes = 0
+
+    @property
+    def importable(self) -> bool:
+        self.probes += 1
+        return self.installed
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code
+
+
+@pytest.fixture
+def probed_formatter():
+    formatter = ProbedFormatter()
+    with mock.patch.dict(SERVER_FORMATTERS, {"probed": formatter}):
+        yield formatter
+
+
+def test_availability_is_probed_once(probed_formatter):
+    registry = FormatterRegistry()
+    # registries of servers started by other tests may probe the formatter too
+    with mock.patch.object(registry, "_probe", wraps=registry._probe) as probe:
+        assert registry.is_available("probed")
+        assert registry.is_available("probed")
+    assert probe.call_count == 1
+    assert not registry.is_available("missing")
+
+
+def test_refresh_probes_again(probed_formatter):
+    registry = FormatterRegistry()
+    registry.refresh()
+    probed_formatter.installed = False
+    assert registry.is_available("probed")
+    registry.refresh(["probed"])
+    assert not registry.is_available("probed")
+
+
+def test_watch_refreshes_when_search_path_changes(probed_formatter):
+    registry = FormatterRegistry(watch_interval=0.01)
+    signatures = iter([("before",), ("before",), ("after",)])
+    with mock.patch.object(
+        availability, "search_path_signature", lambda: next(signatures, ("after",))
+    ):
+        registry.start()
+        try:
+            for _ in range(500):
+                if probed_formatter.probes >= 2:
+                    break
+                registry._stopped.wait(0.01)
+        finally:
+            registry.stop()
+    assert probed_formatter.probes >= 2
+
+
+def test_probe_leaves_formatters_uncreated():
+    plugin = mock.Mock()
+    registry = FormatterRegistry()
+    with (
+        mock.patch.object(SERVER_FORMATTERS, "_formatters", {}),
+        mock.patch.dict(SERVER_FORMATTERS),
+    ):
+        SERVER_FORMATTERS.register("plugin", plugin)
+        registry.refresh()
+        # plugins are only loaded by the first request using them
+        assert registry.is_available("plugin")
+        described = {
+            name: SERVER_FORMATTERS.describe(name) for name in SERVER_FORMATTERS
+        }
+        assert SERVER_FORMATTERS.loaded() == []
+    plugin.assert_not_called()
+    assert described["black"]["label"] == "Apply Black Formatter"
+    assert described["scalafmt"]["languages"] == ["scala"]
+    assert described["rustfmt"]["batch"]
+    assert described["plugin"]["label"] == "Apply plugin Formatter"
+
+
+class NamedFormatter(BaseFormatter):
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    @property
+    def label(self) -> str:
+        return f"Apply {self.name.title()} Formatter"
+
+    @property
+    def languages(self):
+        return [self.name]
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code
+
+
+def test_describe_formatter_with_properties():
+    with (
+        mock.patch.object(SERVER_FORMATTERS, "_formatters", {}),
+        mock.patch.dict(SERVER_FORMATTERS),
+    ):
+        SERVER_FORMATTERS.register("named", partial(NamedFormatter, name="cobol"))
+        described = SERVER_FORMATTERS.describe("named")
+    assert described == {
+        "label": "Apply Cobol Formatter",
+        "languages": ["cobol"],
+        "batch": False,
+        "execution": None,
+    }
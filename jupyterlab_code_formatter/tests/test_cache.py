@@ -0,0 +1,125 @@
+from unittest import mock
+
+import pytest
+from traitlets.config import Config
+
+from jupyterlab_code_formatter.cache import DiskFormatCache, FormatCache, make_cache_key
+from jupyterlab_code_formatter.executor import FormatExecutor
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS, BaseFormatter
+
+
+class CountingFormatter(BaseFormatter):
+    label = "Apply Counting Formatter"
+    importable = True
+
+    def __init__(self) -> None:
+        self.calls = []
+        self.current_version = "1.0"
+
+    @property
+    def version(self):
+        return self.current_version
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        self.calls.append(code)
+        if code == "fail":
+            raise ValueError("cannot format")
+        return code.strip()
+
+
+@pytest.fixture
+def counting_formatter():
+    formatter = CountingFormatter()
+    with mock.patch.dict(SERVER_FORMATTERS, {"counting": formatter}):
+        yield formatter
+
+
+def test_cache_key_canonicalizes_options():
+    assert make_cache_key("black", "22.1.0", {"a": 1, "b": 2}, True, "x") == (
+        make_cache_key("black", "22.1.0", {"b": 2, "a": 1}, True, "x")
+    )
+    assert make_cache_key("black", "22.1.0", {}, True, "x") != (
+        make_cache_key("black", "22.1.0", {}, False, "x")
+    )
+
+
+def test_cache_evicts_least_recently_used():
+    cache = FormatCache(max_entries=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+
+
+def test_cache_respects_byte_limit():
+    cache = FormatCache(max_bytes=8)
+    cache.put("a", "1234")
+    cache.put("b", "5678")
+    assert len(cache) == 1
+    assert cache.size <= 8
+    cache.put("c", "way too large to be cached")
+    assert cache.get("c") is None
+
+
+async def test_executor_serves_unchanged_cells_from_cache(counting_formatter):
+    executor = FormatExecutor(cache=FormatCache())
+    first = await executor.format("counting", [" a ", "fail"], True, {})
+    assert first == [{"code": "a"}, {"error": "cannot format"}]
+
+    second = await executor.format("counting", [" a ", "fail", "a"], True, {})
+    assert second == first + [{"code": "a"}]
+    # errors are not cached and the formatted output maps to itself
+    assert counting_formatter.calls == [" a ", "fail", "fail"]
+
+
+async def test_executor_cache_invalidated_by_version_change(counting_formatter):
+    cache = FormatCache()
+    await FormatExecutor(cache=cache).format("counting", [" a "], True, {})
+    counting_formatter.current_version = "2.0"
+    # versions are looked up once by an executor, i.e. as the server starts
+    await FormatExecutor(cache=cache).format("counting", [" a "], True, {})
+    assert counting_formatter.calls == [" a ", " a "]
+
+
+def test_disk_cache_persists_across_instances(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    DiskFormatCache(enabled=True, path=path).put_many([("a", "1"), ("b", "2")])
+    assert DiskFormatCache(enabled=True, path=path).get_many(["a", "b", "c"]) == {
+        "a": "1",
+        "b": "2",
+    }
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskFormatCache(enabled=True, path=str(tmp_path / "cache.sqlite"))
+    cache.max_bytes = 10
+    cache.put_many([("a", "1234")])
+    cache.put_many([("b", "5678")])
+    cache.get_many(["a"])
+    cache.put_many([("c", "9")])
+    assert cache.get_many(["a", "b", "c"]) == {"a": "1234", "c": "9"}
+
+
+def test_disk_cache_failures_are_misses(tmp_path):
+    cache = DiskFormatCache(enabled=True, path=str(tmp_path))
+    cache.put_many([("a", "1")])
+    assert cache.get_many(["a"]) == {}
+
+
+async def test_executor_reads_through_disk_cache(counting_formatter, tmp_path):
+    config = {"DiskFormatCache": {"enabled": True, "path": str(tmp_path / "c.db")}}
+    executor = FormatExecutor(cache=FormatCache(config=Config(config)))
+    await executor.format("counting", [" a "], True, {})
+    # the cache write is not awaited by format
+    executor.thread_pool.shutdown(wait=True)
+
+    restarted = FormatExecutor(cache=FormatCache(config=Config(config)))
+    assert await restarted.format("counting", [" a ", "a"], True, {}) == [
+        {"code": "a"},
+        {"code": "a"},
+    ]
+    assert counting_formatter.calls == [" a "]
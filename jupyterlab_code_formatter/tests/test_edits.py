@@ -0,0 +1,42 @@
+import pytest
+
+from jupyterlab_code_formatter.edits import line_edits, shift_line_ranges, split_lines
+
+
+def apply_edits(code: str, edits) -> str:
+    lines = split_lines(code)
+    for edit in reversed(edits):
+        lines[edit["start"] : edit["end"]] = [edit["text"]]
+    return "".join(lines)
+
+
+def test_split_lines_only_on_line_feeds():
+    assert split_lines("a\r\nb\x0cc\n\nd") == ["a\r\n", "b\x0cc\n", "\n", "d"]
+    assert split_lines("a\n") == ["a\n"]
+    assert split_lines("") == []
+
+
+@pytest.mark.parametrize(
+    "before,after",
+    [
+        ("x=1\ny=2\n", "x = 1\ny=2\n"),
+        ("a\nb\nc", "a\nc"),
+        ("a\nc\n", "a\nb\nc\n"),
+        ("a\nb", "a\nb\n"),
+        ("", "a\n"),
+        ("same\n", "same\n"),
+    ],
+)
+def test_line_edits_turn_before_into_after(before, after):
+    edits = line_edits(before, after)
+    assert apply_edits(before, edits) == after
+    if before == after:
+        assert edits == []
+
+
+def test_shift_line_ranges():
+    before = "x=1\ny  =  2\n"
+    after = "x = 1\n\ny  =  2\n"
+    assert shift_line_ranges(before, after, [(2, 2)]) == [(3, 3)]
+    # lines which were rewritten map to where the rewrite landed
+    assert shift_line_ranges(before, after, [(1, 1)]) == [(1, 2)]
@@ -0,0 +1,361 @@
+import asyncio
+import subprocess
+import sys
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from jupyterlab_code_formatter.cache import FormatCache
+from jupyterlab_code_formatter.executor import ExecutorBusyError, FormatExecutor
+from jupyterlab_code_formatter.formatters import (
+    SERVER_FORMATTERS,
+    BaseFormatter,
+    CommandLineFormatter,
+)
+
+
+class BlockingFormatter(BaseFormatter):
+    label = "Apply Blocking Formatter"
+    importable = True
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.formatted = []
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        self.formatted.append(code)
+        if code == "fail":
+            raise ValueError("cannot format")
+        self.release.wait(timeout=5)
+        return code.upper()
+
+
+@pytest.fixture
+def blocking_formatter():
+    formatter = BlockingFormatter()
+    with mock.patch.dict(SERVER_FORMATTERS, {"blocking": formatter}):
+        yield formatter
+
+
+async def test_format_keeps_per_cell_errors(blocking_formatter):
+    blocking_formatter.release.set()
+    executor = FormatExecutor()
+    result = await executor.format("blocking", ["a", "fail", "b"], True, {})
+    assert result == [{"code": "A"}, {"error": "cannot format"}, {"code": "B"}]
+
+
+async def test_format_does_not_block_event_loop(blocking_formatter):
+    executor = FormatExecutor()
+    task = asyncio.ensure_future(executor.format("blocking", ["a"], True, {}))
+    # the event loop is free to run other callbacks while the cell is formatting
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    blocking_formatter.release.set()
+    assert await task == [{"code": "A"}]
+
+
+async def test_format_rejects_when_too_many_pending(blocking_formatter):
+    executor = FormatExecutor(max_workers=1, max_pending_requests=1)
+    task = asyncio.ensure_future(executor.format("blocking", ["a"], True, {}))
+    await asyncio.sleep(0)
+    with pytest.raises(ExecutorBusyError):
+        await executor.format("blocking", ["b"], True, {})
+    blocking_formatter.release.set()
+    await task
+    assert executor.pending == 0
+
+
+async def test_process_mode_keeps_cell_order():
+    executor = FormatExecutor(mode="process", max_workers=2, cells_per_task=2)
+    code = [f"x{i}= {i}" for i in range(5)] + ["this_is_bad = 'hihi"]
+    try:
+        result = await executor.format("black", code, True, {})
+    finally:
+        executor.shutdown()
+    assert result[:5] == [{"code": f"x{i} = {i}"} for i in range(5)]
+    assert result[5] == {"error": "Cannot parse: 1:13: this_is_bad = 'hihi"}
+
+
+async def test_process_mode_falls_back_to_threads(blocking_formatter):
+    # BlockingFormatter holds a threading.Event, so it can't be pickled
+    blocking_formatter.release.set()
+    executor = FormatExecutor(mode="process")
+    result = await executor.format("blocking", ["a"], True, {})
+    assert result == [{"code": "A"}]
+    assert executor._process_pool is None
+
+
+class ThreadNameFormatter(BaseFormatter):
+    label = "Apply Thread Name Formatter"
+    importable = True
+    execution = "serial"
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return threading.current_thread().name
+
+
+async def test_formatters_not_thread_safe_run_on_dedicated_thread():
+    executor = FormatExecutor(mode="process")
+    with mock.patch.dict(SERVER_FORMATTERS, {"serial": ThreadNameFormatter()}):
+        first = await executor.format("serial", ["a"], True, {})
+        second = await executor.format("serial", ["b", "c"], True, {})
+    executor.shutdown()
+    names = {result["code"] for result in first + second}
+    assert len(names) == 1
+    assert names.pop().startswith("jupyterlab_code_formatter_serial")
+
+
+async def test_stream_stops_with_iteration(blocking_formatter):
+    blocking_formatter.release.set()
+    executor = FormatExecutor(cells_per_task=2)
+    chunks = executor.format_pipeline_stream(
+        [("blocking", {})], ["a", "b", "c", "d", "e"], True
+    )
+    assert await chunks.__anext__() == (0, [{"code": "A"}, {"code": "B"}])
+    assert await chunks.__anext__() == (2, [{"code": "C"}, {"code": "D"}])
+    await chunks.aclose()
+    assert blocking_formatter.formatted == ["a", "b", "c", "d"]
+    assert executor.pending == 0
+
+
+async def test_cancel_stops_pending_cells(blocking_formatter):
+    executor = FormatExecutor()
+    task = asyncio.ensure_future(
+        executor.format_pipeline([("blocking", {})], ["a", "b", "c"], True, "request")
+    )
+    await asyncio.sleep(0.05)
+    assert executor.cancel("request")
+    blocking_formatter.release.set()
+    assert await task == [
+        {"code": "A"},
+        {"error": "Format request cancelled"},
+        {"error": "Format request cancelled"},
+    ]
+    assert blocking_formatter.formatted == ["a"]
+    assert not executor.cancel("request")
+
+
+async def test_cancel_kills_subprocess():
+    sleeper = CommandLineFormatter(
+        command=[sys.executable, "-c", "import time; time.sleep(30)"]
+    )
+    executor = FormatExecutor()
+    with mock.patch.dict(SERVER_FORMATTERS, {"sleeper": sleeper}):
+        task = asyncio.ensure_future(
+            executor.format_pipeline([("sleeper", {})], ["a", "b"], True, "request")
+        )
+        await asyncio.sleep(0.5)
+        start = time.monotonic()
+        executor.cancel("request")
+        result = await task
+    assert time.monotonic() - start < 10
+    assert result == [{"error": "Format request cancelled"}] * 2
+
+
+async def test_metrics_count_cells_and_cache_hits(blocking_formatter):
+    pytest.importorskip("prometheus_client")
+    blocking_formatter.release.set()
+    executor = FormatExecutor(cache=FormatCache())
+    # only formatters with a version are cached
+    with mock.patch.object(BlockingFormatter, "version", "1.0"):
+        await executor.format_pipeline([("blocking", {})], ["a", "fail"], True)
+        await executor.format_pipeline([("blocking", {})], ["a"], True)
+    registry = executor.metrics.registry
+
+    def cells(outcome):
+        return registry.get_sample_value(
+            "jupyterlab_code_formatter_cells_total",
+            {"formatter": "blocking", "outcome": outcome},
+        )
+
+    assert (cells("formatted"), cells("error"), cells("cached")) == (1, 1, 1)
+    assert registry.get_sample_value(
+        "jupyterlab_code_formatter_bytes_in_total", {"formatter": "blocking"}
+    ) == len("a") + len("fail")
+    assert (
+        registry.get_sample_value(
+            "jupyterlab_code_formatter_format_duration_seconds_count",
+            {"formatter": "blocking"},
+        )
+        == 1
+    )
+    assert (
+        registry.get_sample_value(
+            "jupyterlab_code_formatter_cache_lookups_total",
+            {"tier": "memory", "result": "miss"},
+        )
+        == 2
+    )
+
+
+async def test_metrics_time_phases():
+    pytest.importorskip("prometheus_client")
+    echo = CommandLineFormatter(
+        command=[sys.executable, "-c", "import sys; print(sys.stdin.read(), end='')"]
+    )
+    executor = FormatExecutor(mode="process")
+    try:
+        with mock.patch.dict(SERVER_FORMATTERS, {"echo": echo}):
+            result = await executor.format_pipeline([("echo", {})], ["%time x"], True)
+            await executor.format_pipeline([("black", {})], ["%time x"], True)
+    finally:
+        executor.shutdown()
+    assert result == [{"code": "%time x"}]
+
+    def count(formatter, phase):
+        return executor.metrics.registry.get_sample_value(
+            "jupyterlab_code_formatter_phase_duration_seconds_count",
+            {"formatter": formatter, "phase": phase},
+        )
+
+    assert (count("echo", "escape"), count("echo", "spawn")) == (1, 1)
+    # phases are timed by worker processes too
+    assert count("black", "escape") == 1
+
+
+async def test_metrics_of_format_range():
+    pytest.importorskip("prometheus_client")
+    echo = CommandLineFormatter(
+        command=[sys.executable, "-c", "import sys; print(sys.stdin.read(), end='')"]
+    )
+    executor = FormatExecutor()
+    try:
+        with mock.patch.dict(SERVER_FORMATTERS, {"echo": echo}):
+            result = await executor.format_range([("echo", {})], "x = 1\n", None)
+    finally:
+        executor.shutdown()
+    assert result["code"] == "x = 1\n"
+    registry = executor.metrics.registry
+    assert (
+        registry.get_sample_value(
+            "jupyterlab_code_formatter_cells_total",
+            {"formatter": "echo", "outcome": "formatted"},
+        )
+        == 1
+    )
+    assert registry.get_sample_value(
+        "jupyterlab_code_formatter_bytes_in_total", {"formatter": "echo"}
+    ) == len("x = 1\n")
+    assert (
+        registry.get_sample_value(
+            "jupyterlab_code_formatter_phase_duration_seconds_count",
+            {"formatter": "echo", "phase": "spawn"},
+        )
+        == 1
+    )
+
+
+def test_metrics_without_prometheus_client():
+    code = "; ".join([
+        "import sys",
+        "sys.modules['prometheus_client'] = None",
+        "from jupyterlab_code_formatter.metrics import FormatMetrics",
+        "metrics = FormatMetrics()",
+        "metrics.observe_format('black', ['a'], [{'code': 'a'}], 0.1)",
+        "metrics.observe_phases('black', {'escape': 0.1})",
+        "print(metrics.exposition().decode())",
+    ])
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.startswith("# prometheus_client is not installed")
+
+
+class InProcessFormatter(ThreadNameFormatter):
+    execution = "in_process"
+
+
+class ThreadFormatter(InProcessFormatter):
+    execution = "thread"
+
+
+async def test_formatters_run_where_they_ask():
+    executor = FormatExecutor(mode="process")
+    formatters = {"in_process": InProcessFormatter(), "thread": ThreadFormatter()}
+    with mock.patch.dict(SERVER_FORMATTERS, formatters):
+        in_process = await executor.format("in_process", ["a"], True, {})
+        thread = await executor.format("thread", ["a"], True, {})
+        # a pipeline mixing them runs in the worker threads
+        mixed = await executor.format_pipeline(
+            [("in_process", {}), ("thread", {})], ["a"], True
+        )
+    executor.shutdown()
+    assert in_process == [{"code": threading.current_thread().name}]
+    assert thread[0]["code"].startswith("jupyterlab_code_formatter")
+    assert mixed[0]["code"].startswith("jupyterlab_code_formatter")
+    # nothing was sent to worker processes
+    assert executor._process_pool is None
+
+
+def test_subprocess_formatters_run_in_threads():
+    executor = FormatExecutor(mode="process")
+    # starting a process from a worker process would only add a hop
+    assert executor._execution("astyle") == "thread"
+    assert executor._execution("blue") == "thread"
+    assert executor._execution("black") == "process"
+    assert FormatExecutor()._execution("black") == "thread"
+
+
+async def test_cache_follows_configuration_files(blocking_formatter, tmp_path):
+    blocking_formatter.release.set()
+    executor = FormatExecutor(cache=FormatCache())
+    with (
+        mock.patch.object(BlockingFormatter, "version", "1.0"),
+        mock.patch.object(BlockingFormatter, "config_files", ("blocking.toml",)),
+        mock.patch("os.getcwd", return_value=str(tmp_path)),
+    ):
+        for _ in range(2):
+            await executor.format_pipeline([("blocking", {})], ["a"], True)
+        assert blocking_formatter.formatted == ["a"]
+        (tmp_path / "blocking.toml").write_text("line-length = 40")
+        await executor.format_pipeline([("blocking", {})], ["a"], True)
+    executor.shutdown()
+    assert blocking_formatter.formatted == ["a", "a"]
+
+
+async def test_process_mode_recovers_from_dead_worker():
+    executor = FormatExecutor(mode="process", max_workers=1)
+    try:
+        assert await executor.format("black", ["x=1"], True, {}) == [{"code": "x = 1"}]
+        for process in list(executor._process_pool._processes.values()):
+            process.kill()
+            process.join()
+        # cells sent to the dead worker get an error, if any
+        for result in await executor.format("black", ["x=2"], True, {}):
+            assert result in ({"code": "x = 2"}, {"error": mock.ANY})
+        assert await executor.format("black", ["x=3"], True, {}) == [{"code": "x = 3"}]
+    finally:
+        executor.shutdown()
+
+
+class BatchFormatter(BaseFormatter):
+    label = "Apply Batch Formatter"
+    importable = True
+
+    def __init__(self) -> None:
+        self.batches = []
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code.upper()
+
+    def format_batch(self, code, notebook, **options):
+        self.batches.append(code)
+        return [cell.upper() for cell in code]
+
+
+async def test_stream_formats_batches_at_once():
+    formatter = BatchFormatter()
+    executor = FormatExecutor(cells_per_task=2)
+    code = [f"x{i}" for i in range(5)]
+    with mock.patch.dict(SERVER_FORMATTERS, {"batch": formatter}):
+        chunks = [
+            chunk
+            async for chunk in executor.format_pipeline_stream(
+                [("batch", {})], code, True
+            )
+        ]
+    executor.shutdown()
+    assert chunks == [(0, [{"code": cell.upper()} for cell in code])]
+    assert formatter.batches == [code]
@@ -1,12 +1,25 @@
+import functools
+import importlib.metadata
 import json
 import os
+import subprocess
 import sys
 from subprocess import run
 from unittest import mock
 
 import pytest
 
-from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+from jupyterlab_code_formatter.formatters import (
+    ESCAPERS,
+    SERVER_FORMATTERS,
+    BaseFormatter,
+    BaseLineEscaper,
+    CommandLineFormatter,
+    FormatterError,
+    LineEscaperRegistry,
+    format_batch_with_pipeline,
+    format_with_pipeline,
+)
 
 
 def test_env_pollution_on_import():
@@ -42,3 +55,313 @@ def test_env_pollution_on_importable_check(name):
             pytest.skip(
                 f"{name} formatter was not importable, the test may yield false negatives"
             )
+
+
+@pytest.mark.parametrize(
+    "code",
+    [
+        "%%timeit\nimport sys,os\nx='abc'",
+        "!ls\nimport os\nos?\nx=1;",
+        "%%html\n<h1>Hi</h1>",
+    ],
+)
+def test_pipeline_matches_formatting_one_by_one(code):
+    black = SERVER_FORMATTERS["black"]
+    isort = SERVER_FORMATTERS["isort"]
+    if not (black.importable and isort.importable):
+        pytest.skip("black and isort are needed for this test")
+    expected = black.format_code(isort.format_code(code, True), True)
+    assert format_with_pipeline([(isort, {}), (black, {})], code, True) == expected
+
+
+def counted(func):
+    @functools.wraps(func)
+    def wrapped(self, code: str, notebook: bool, **options) -> str:
+        self.calls += 1
+        return func(self, code, notebook, **options)
+
+    return wrapped
+
+
+class CountedFormatter(BaseFormatter):
+    label = "Apply Counted Formatter"
+    importable = True
+
+    def __init__(self) -> None:
+        self.calls = 0
+
+    @counted
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        return code.upper()
+
+
+def test_pipeline_keeps_decorators_of_formatters_not_handling_magics():
+    black = SERVER_FORMATTERS["black"]
+    if not black.importable:
+        pytest.skip("black is needed for this test")
+    counted_formatter = CountedFormatter()
+    assert (
+        format_with_pipeline(
+            [(black, {}), (counted_formatter, {})], "%time x\ny=1", True
+        )
+        == "%TIME X\nY = 1"
+    )
+    assert counted_formatter.calls == 1
+
+
+UPPERCASE_FILES_SCRIPT = """
+import sys
+status = 0
+for path in sys.argv[1:]:
+    with open(path) as f:
+        code = f.read()
+    if "fail" in code:
+        print(f"error: cannot format {path}")
+        status = 1
+        continue
+    with open(path, "w") as f:
+        f.write("\\n".join(
+            line if line.startswith("#") else line.upper()
+            for line in code.splitlines()
+        ))
+sys.exit(status)
+"""
+
+
+@pytest.fixture
+def uppercase_formatter():
+    return CommandLineFormatter(
+        command=[sys.executable, "-c", "import sys; print(sys.stdin.read().upper())"],
+        batch_command=[sys.executable, "-c", UPPERCASE_FILES_SCRIPT],
+        file_extension=".txt",
+    )
+
+
+def test_batch_formats_cells_in_one_invocation(uppercase_formatter):
+    code = ["a = 1", "%%html\n<b>b</b>", "!ls\nc = 3;", "fail"]
+    with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen_mock:
+        results = uppercase_formatter.format_batch(code, True)
+    assert popen_mock.call_count == 1
+    assert results[:3] == ["A = 1", "%%html\n<b>b</b>", "!ls\nC = 3;"]
+    assert isinstance(results[3], FormatterError)
+
+
+def test_batch_falls_back_when_errors_cannot_be_attributed(uppercase_formatter):
+    uppercase_formatter.batch_command = [sys.executable, "-c", "exit(2)"]
+    assert uppercase_formatter.format_batch(["a", "b"], True) == ["A", "B"]
+
+
+def test_batch_chain_formats_cells_in_one_invocation_per_formatter(
+    uppercase_formatter,
+):
+    code = [f"x{i} = {i}" for i in range(8)] + ["%%html\n<b>b</b>", "!ls\nfail"]
+    with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen_mock:
+        results = format_batch_with_pipeline(
+            [(uppercase_formatter, {}), (uppercase_formatter, {})], code, True
+        )
+    assert popen_mock.call_count == 2
+    assert results[:9] == [f"X{i} = {i}" for i in range(8)] + ["%%html\n<b>b</b>"]
+    assert isinstance(results[9], FormatterError)
+
+
+def test_batch_chain_skips_cells_failed_by_a_previous_formatter(uppercase_formatter):
+    counted_formatter = CountedFormatter()
+    code = ["a = 1", "fail", "b = 2"]
+    with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen_mock:
+        results = format_batch_with_pipeline(
+            [(uppercase_formatter, {}), (counted_formatter, {})], code, True
+        )
+    assert popen_mock.call_count == 1
+    assert counted_formatter.calls == 2
+    assert results[0] == "A = 1" and results[2] == "B = 2"
+    assert isinstance(results[1], FormatterError)
+
+
+def test_rustfmt_batch():
+    rustfmt = SERVER_FORMATTERS["rustfmt"]
+    if (
+        not rustfmt.importable
+        or run(["rustfmt"], input=b"", capture_output=True).returncode
+    ):
+        pytest.skip("rustfmt is not installed or not working")
+    results = rustfmt.format_batch(["fn main(){let a=1;}", "fn x( {"], True)
+    assert results[0] == "fn main() {\n    let a = 1;\n}"
+    assert isinstance(results[1], FormatterError)
+
+
+@pytest.mark.parametrize("name", ("ruff", "ruffformat"))
+def test_ruff_batch_uses_working_directory_config(name, tmp_path, monkeypatch):
+    formatter = SERVER_FORMATTERS[name]
+    if not formatter.importable:
+        pytest.skip("ruff is not installed")
+    (tmp_path / "pyproject.toml").write_text(
+        '[tool.ruff]\nline-length = 20\n[tool.ruff.lint]\nselect = ["I001"]\n'
+    )
+    monkeypatch.chdir(tmp_path)
+    code = ["import sys,os\nsome_function(argument_one, argument_two)"] * 2
+    expected = [formatter.format_code(cell, True) for cell in code]
+    with mock.patch("subprocess.Popen", wraps=subprocess.Popen) as popen_mock:
+        assert formatter.format_batch(code, True) == expected
+    assert popen_mock.call_count == 1
+
+
+@pytest.mark.parametrize("name", ["formatR", "styler"])
+def test_r_formatter_importable(name):
+    formatter = SERVER_FORMATTERS[name]
+    with mock.patch(
+        "jupyterlab_code_formatter.formatters.is_importable", return_value=False
+    ):
+        assert not formatter.importable
+    # R itself is left alone, it would start the embedded interpreter
+    with (
+        mock.patch(
+            "jupyterlab_code_formatter.formatters.is_importable", return_value=True
+        ),
+        mock.patch.dict(sys.modules, {"rpy2.robjects.packages": None}),
+    ):
+        assert formatter.importable
+
+
+def test_escapers_roundtrip():
+    code = "%time x\n!ls\nx?\n?x\n#| echo: false\nrun foo\ny = 1  # why?\n"
+    escaped = ESCAPERS.escape(code)
+    assert escaped.splitlines() == [
+        "# \x01 %time x",
+        "# \x01 !ls",
+        "# \x01 x?",
+        "# \x01 ?x",
+        "# \x01 #| echo: false",
+        "# \x01 run foo",
+        "y = 1  # why?",
+    ]
+    assert ESCAPERS.unescape(escaped) == code
+    # formatters indent the escaped lines of a block like comments
+    indented = "if True:\n    !ls\n    x = 1\n"
+    escaped = ESCAPERS.escape(indented)
+    assert escaped == "if True:\n# \x01     !ls\n    x = 1"
+    assert ESCAPERS.unescape(escaped.replace("\n#", "\n    #")) == indented
+
+
+@pytest.mark.parametrize("name", ["black", "yapf", "autopep8"])
+def test_indented_magic_is_unescaped(name):
+    formatter = SERVER_FORMATTERS[name]
+    if not formatter.importable:
+        pytest.skip(f"{name} is not installed")
+    code = "if True:\n    !ls\n    x=1"
+    assert formatter.format_code(code, True) == "if True:\n    !ls\n    x = 1"
+
+
+def test_registered_escaper_joins_matcher():
+    class ShellEscaper(BaseLineEscaper):
+        langs = ["python"]
+        pattern = r"\s*\$ "
+
+    registry = LineEscaperRegistry(ESCAPERS)
+    assert registry.escape("$ ls") == "$ ls"
+    registry.register(ShellEscaper)
+    assert registry.escape("$ ls\n%time x") == "# \x01 $ ls\n# \x01 %time x"
+    # the global registry is left alone
+    assert ESCAPERS.escape("$ ls") == "$ ls"
+
+
+def test_blue_leaves_black_alone():
+    black, blue = SERVER_FORMATTERS["black"], SERVER_FORMATTERS["blue"]
+    if not (black.importable and blue.importable):
+        pytest.skip("black and blue are needed for this test")
+    import black as black_module
+
+    for _ in range(2):
+        assert blue.format_code('x = "a"', True) == "x = 'a'"
+        assert black.format_code("x = 'a'", True) == 'x = "a"'
+    # black was neither patched nor reloaded in this process
+    assert sys.modules["black"] is black_module
+    results = blue.format_batch(['x = "a"', "def (", "!ls"], True)
+    assert results[0] == "x = 'a'" and results[2] == "!ls"
+    assert isinstance(results[1], FormatterError)
+
+
+def test_black_mode_is_built_once_per_options():
+    black = SERVER_FORMATTERS["black"]
+    if not black.importable:
+        pytest.skip("black is not installed")
+    first = black.handle_options(line_length=100, is_pyi=False)
+    assert black.handle_options(is_pyi=False, line_length=100)["mode"] is first["mode"]
+    assert black.handle_options(line_length=80)["mode"] is not first["mode"]
+    assert black.format_code("x = f(a,b)", True, line_length=100) == "x = f(a, b)"
+
+
+def test_import_is_lazy():
+    code = "; ".join([
+        "import sys",
+        "import jupyterlab_code_formatter",
+        "assert jupyterlab_code_formatter.__version__",
+        "loaded = set(sys.modules)",
+        "from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS",
+        "print(json.dumps([sorted(loaded), sorted(sys.modules), SERVER_FORMATTERS.loaded()]))",
+    ])
+    result = run(
+        [sys.executable, "-c", f"import json; {code}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    package, formatters, created = json.loads(result.stdout)
+    assert "jupyterlab_code_formatter.handlers" not in package
+    assert "tornado" not in package
+    assert {"packaging", "ruff", "prometheus_client"}.isdisjoint(formatters)
+    assert created == []
+
+
+def test_formatters_are_created_on_lookup():
+    factory = mock.Mock(return_value="formatter")
+    formatters = SERVER_FORMATTERS.copy()
+    formatters.register("lazy", factory)
+    assert "lazy" in formatters and "lazy" not in formatters.loaded()
+    factory.assert_not_called()
+    assert formatters["lazy"] == formatters["lazy"] == "formatter"
+    factory.assert_called_once()
+    assert "lazy" not in SERVER_FORMATTERS
+    with mock.patch.dict(SERVER_FORMATTERS, {"lazy": "other"}):
+        assert SERVER_FORMATTERS["lazy"] == "other"
+    assert "lazy" not in SERVER_FORMATTERS
+
+
+PLUGIN_MODULE = """
+from jupyterlab_code_formatter.formatters import BaseFormatter
+
+
+class UpperFormatter(BaseFormatter):
+    label = "Apply Upper Formatter"
+    importable = True
+    languages = ("sql",)
+    execution = "in_process"
+
+    def format_code(self, code, notebook, **options):
+        return code.upper()
+"""
+
+
+def test_entry_point_formatters_load_on_first_use(tmp_path, monkeypatch):
+    (tmp_path / "upper_plugin.py").write_text(PLUGIN_MODULE)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    group = "jupyterlab_code_formatter.formatters"
+    entry_points = [
+        importlib.metadata.EntryPoint("upper", "upper_plugin:UpperFormatter", group),
+        importlib.metadata.EntryPoint("broken", "missing_plugin:Formatter", group),
+        importlib.metadata.EntryPoint("black", "upper_plugin:UpperFormatter", group),
+    ]
+    formatters = SERVER_FORMATTERS.copy()
+    with mock.patch("importlib.metadata.entry_points", return_value=entry_points):
+        assert formatters.load_entry_points() == ["upper", "broken"]
+        # loading again, e.g. for another server, is a no-op
+        assert formatters.load_entry_points() == []
+    assert "upper_plugin" not in sys.modules
+    upper = formatters["upper"]
+    assert upper.format_code("select 1", False) == "SELECT 1"
+    assert (upper.languages, upper.execution) == (("sql",), "in_process")
+    assert not upper.supports_batch
+    # built-in formatters are not replaced by plugins
+    assert formatters["black"] is SERVER_FORMATTERS["black"]
+    assert not formatters["broken"].importable
+    with pytest.raises(FormatterError, match="broken failed to load"):
+        formatters["broken"].format_code("x", False)
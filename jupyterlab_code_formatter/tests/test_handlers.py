@@ -1,3 +1,4 @@
+import asyncio
 import json
 import sys
 import typing as t
@@ -7,10 +8,12 @@ if sys.version_info >= (3, 8):
 else:
     from importlib_metadata import version
 
+import nbformat
 import pytest
 from jsonschema import validate
 from tornado.httpclient import HTTPResponse
 
+from jupyterlab_code_formatter import _unload_jupyter_server_extension
 from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
 
 try:
@@ -19,7 +22,7 @@ except ImportError:
     MISSING_RPY2 = True
 else:
     MISSING_RPY2 = False
-skip_if_missing_rpy2 = pytest.mark.skipif(MISSING_RPY2, reason='missing rpy2')
+skip_if_missing_rpy2 = pytest.mark.skipif(MISSING_RPY2, reason="missing rpy2")
 
 
 def _generate_list_formaters_entry_json_schema(
@@ -31,10 +34,21 @@ def _generate_list_formaters_entry_json_schema(
         "properties": {
             formatter_name: {
                 "type": "object",
-                "required": ["enabled", "label"],
+                "required": [
+                    "enabled",
+                    "label",
+                    "languages",
+                    "batch",
+                    "execution",
+                ],
                 "properties": {
                     "enabled": {"type": "boolean"},
                     "label": {"type": "string"},
+                    "languages": {"type": "array", "items": {"type": "string"}},
+                    "batch": {"type": "boolean"},
+                    "execution": {
+                        "enum": [None, "in_process", "thread", "serial", "process"],
+                    },
                 },
             }
         },
@@ -158,6 +172,37 @@ async def test_return_error_if_any(request_format):  # type: ignore[no-untyped-d
     assert json_result["code"][0]["error"] == "Cannot parse: 1:13: this_is_bad = 'hihi"
 
 
+async def test_can_apply_formatter_pipeline(request_format_pipeline):  # type: ignore[no-untyped-def]
+    """Check that a chain of formatters is applied in a single request."""
+    given = "%%timeit\nimport sys,os\nsome_string='abc'"
+    expected = '%%timeit\nimport os\nimport sys\n\nsome_string = "abc"'
+
+    response: HTTPResponse = await request_format_pipeline(
+        formatters=[
+            {"formatter": "isort", "options": {}},
+            {"formatter": "black", "options": {"line_length": 88}},
+        ],
+        code=[given, SIMPLE_VALID_PYTHON_CODE],
+    )
+    json_result = _check_http_code_and_schema(
+        response=response,
+        expected_code=200,
+        expected_schema=EXPECTED_FROMAT_SCHEMA,
+    )
+    assert json_result["code"][0]["code"] == expected
+    assert json_result["code"][1]["code"] == "x = 22\ne = 1"
+
+
+async def test_404_on_unknown_in_pipeline(request_format_pipeline):  # type: ignore[no-untyped-def]
+    """Check that it 404 correctly if any formatter of the chain is unknown."""
+    response: HTTPResponse = await request_format_pipeline(
+        formatters=[{"formatter": "isort"}, {"formatter": "UNKNOWN"}],
+        code=[SIMPLE_VALID_PYTHON_CODE],
+        raise_error=False,
+    )
+    assert response.code == 404
+
+
 @pytest.mark.parametrize("formatter", ("black", "yapf", "isort"))
 async def test_can_handle_magic(request_format, formatter):  # type: ignore[no-untyped-def]
     """Check that it's fine to run formatters for code with magic."""
@@ -667,3 +712,197 @@ async def test_can_apply_ruff_fix_unsafe(request_format):  # type: ignore[no-unt
         expected_schema=EXPECTED_FROMAT_SCHEMA,
     )
     assert json_result["code"][0]["code"] == expected
+
+
+async def test_can_apply_ruff_formatter_to_many_cells(request_format):  # type: ignore[no-untyped-def]
+    """Check that ruff reports errors on the right cells when formatting many."""
+    response: HTTPResponse = await request_format(
+        formatter="ruffformat",
+        code=[SIMPLE_VALID_PYTHON_CODE, "this_is_bad = 'hihi", "%%timeit\nx= 1"],
+        options={},
+    )
+    json_result = _check_http_code_and_schema(
+        response=response,
+        expected_code=200,
+        expected_schema=EXPECTED_FROMAT_SCHEMA,
+    )
+    assert json_result["code"][0]["code"] == "x = 22\ne = 1"
+    assert "error" in json_result["code"][1]
+    assert json_result["code"][2]["code"] == "%%timeit\nx = 1"
+
+
+async def test_can_format_range_of_file(request_format_range):  # type: ignore[no-untyped-def]
+    """Check that only the requested lines are formatted when ruff can do it."""
+    response: HTTPResponse = await request_format_range(
+        formatters=[{"formatter": "ruffformat", "options": {}}],
+        code="x  =  1\ny  =  2\nz  =  3\n",
+        line_ranges=[[2, 2]],
+    )
+    json_result = json.loads(response.body.decode("utf-8"))
+    assert json_result["code"] == "x  =  1\ny = 2\nz  =  3\n"
+    assert json_result["edits"] == [{"start": 1, "end": 2, "text": "y = 2\n"}]
+
+
+async def test_format_range_of_whole_file(request_format_range):  # type: ignore[no-untyped-def]
+    """Check that the whole file is formatted when no range is given."""
+    response: HTTPResponse = await request_format_range(
+        formatters=[{"formatter": "black", "options": {}}],
+        code="x  =  1\ny = 2\n",
+    )
+    json_result = json.loads(response.body.decode("utf-8"))
+    assert json_result["code"] == "x = 1\ny = 2\n"
+    assert json_result["edits"] == [{"start": 0, "end": 1, "text": "x = 1\n"}]
+
+
+async def test_can_reply_with_edits(request_format_pipeline):  # type: ignore[no-untyped-def]
+    """Check that cells are replied as edits, or as unchanged."""
+    response: HTTPResponse = await request_format_pipeline(
+        formatters=[{"formatter": "black", "options": {}}],
+        code=["x = 1\ny= 2\nz = 3", "x = 1", "this_is_bad = 'hihi"],
+        response="edits",
+    )
+    json_result = json.loads(response.body.decode("utf-8"))
+    assert json_result["code"] == [
+        {"edits": [{"start": 1, "end": 2, "text": "y = 2\n"}]},
+        {"unchanged": True},
+        {"error": "Cannot parse: 1:13: this_is_bad = 'hihi"},
+    ]
+
+
+async def test_can_stream_results(request_format_stream):  # type: ignore[no-untyped-def]
+    """Check that every cell gets one JSON line with its index."""
+    code = [f"x{i}= {i}" for i in range(20)] + ["this_is_bad = 'hihi"]
+    response: HTTPResponse = await request_format_stream(
+        formatters=[{"formatter": "black", "options": {}}],
+        code=code,
+    )
+    assert response.code == 200
+    assert response.headers["Content-Type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.body.decode("utf-8").splitlines()]
+    assert [line["index"] for line in lines] == list(range(21))
+    assert lines[3] == {"index": 3, "code": "x3 = 3"}
+    assert lines[20] == {
+        "index": 20,
+        "error": "Cannot parse: 1:13: this_is_bad = 'hihi",
+    }
+
+
+async def test_cancel_unknown_request(jp_fetch):  # type: ignore[no-untyped-def]
+    """Check that cancelling a request which isn't running is harmless."""
+    response: HTTPResponse = await jp_fetch(
+        "jupyterlab_code_formatter",
+        "cancel",
+        method="POST",
+        body=json.dumps({"request_id": "unknown"}),
+    )
+    assert json.loads(response.body.decode("utf-8")) == {"cancelled": False}
+
+
+async def test_metrics(request_format, jp_fetch):  # type: ignore[no-untyped-def]
+    """Check that formatting shows up in the metrics."""
+    pytest.importorskip("prometheus_client")
+    await request_format(formatter="black", code=[SIMPLE_VALID_PYTHON_CODE], options={})
+    response: HTTPResponse = await jp_fetch("jupyterlab_code_formatter", "metrics")
+    assert response.headers["Content-Type"].startswith("text/plain")
+    metrics = response.body.decode("utf-8")
+    assert 'jupyterlab_code_formatter_cells_total{formatter="black"' in metrics
+    assert (
+        'jupyterlab_code_formatter_request_duration_seconds_count{endpoint="format",status="200"} 1.0'
+        in metrics
+    )
+    for phase in ("escape", "encode"):
+        assert (
+            f'jupyterlab_code_formatter_phase_duration_seconds_count{{formatter="black",phase="{phase}"}} 1.0'
+            in metrics
+        )
+
+
+async def test_format_notebook(jp_fetch, jp_root_dir, monkeypatch):  # type: ignore[no-untyped-def]
+    """Check that notebooks of the server are formatted in place."""
+    monkeypatch.setenv("JUPYTERLAB_SETTINGS_DIR", str(jp_root_dir / "settings"))
+    notebook = nbformat.v4.new_notebook()
+    notebook.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    notebook.cells = [nbformat.v4.new_code_cell(SIMPLE_VALID_PYTHON_CODE)]
+    nbformat.write(notebook, str(jp_root_dir / "notebook.ipynb"))
+
+    async def format_notebook(**data):
+        response = await jp_fetch(
+            "jupyterlab_code_formatter",
+            "format_notebook",
+            method="POST",
+            body=json.dumps({"path": "notebook.ipynb", **data}),
+        )
+        return json.loads(response.body.decode("utf-8"))
+
+    summary = await format_notebook(formatters=[{"formatter": "black"}], dry_run=True)
+    assert summary == {
+        "path": "notebook.ipynb",
+        "formatters": ["black"],
+        "cells": 1,
+        "changed": 1,
+        "errors": [],
+    }
+    assert nbformat.read(str(jp_root_dir / "notebook.ipynb"), 4) == notebook
+
+    summary = await format_notebook()
+    assert summary["formatters"] == ["isort", "black"]
+    assert summary["changed"] == 1
+    formatted = nbformat.read(str(jp_root_dir / "notebook.ipynb"), 4)
+    assert formatted.cells[0].source == "x = 22\ne = 1"
+
+
+async def test_format_job(jp_fetch, jp_root_dir):  # type: ignore[no-untyped-def]
+    """Check that files of a directory are formatted by a job, polled until done."""
+    (jp_root_dir / "project").mkdir()
+    (jp_root_dir / "project" / "module.py").write_text(SIMPLE_VALID_PYTHON_CODE)
+    response: HTTPResponse = await jp_fetch(
+        "jupyterlab_code_formatter",
+        "jobs",
+        method="POST",
+        body=json.dumps({"path": "project", "formatters": {"python": ["black"]}}),
+    )
+    assert response.code == 202
+    job = json.loads(response.body.decode("utf-8"))
+    for _ in range(200):
+        response = await jp_fetch("jupyterlab_code_formatter", "jobs", job["id"])
+        job = json.loads(response.body.decode("utf-8"))
+        if job["status"] != "running":
+            break
+        await asyncio.sleep(0.05)
+    assert (job["status"], job["total"], job["formatted"]) == ("done", 1, 1)
+    assert (jp_root_dir / "project" / "module.py").read_text() == "x = 22\ne = 1\n"
+
+    response = await jp_fetch("jupyterlab_code_formatter", "jobs")
+    assert [job["id"] for job in json.loads(response.body)["jobs"]] == [job["id"]]
+    response = await jp_fetch(
+        "jupyterlab_code_formatter", "jobs", job["id"], method="DELETE"
+    )
+    assert json.loads(response.body) == {"cancelled": False}
+
+
+@pytest.mark.parametrize(
+    "formatters", ({"python": ["black", "UNKNOWN"]}, {"python": [1]}, ["black"])
+)
+async def test_format_job_with_invalid_formatters(jp_fetch, jp_root_dir, formatters):  # type: ignore[no-untyped-def]
+    """Check that jobs with unknown formatters are refused."""
+    (jp_root_dir / "project").mkdir()
+    response: HTTPResponse = await jp_fetch(
+        "jupyterlab_code_formatter",
+        "jobs",
+        method="POST",
+        body=json.dumps({"path": "project", "formatters": formatters}),
+        raise_error=False,
+    )
+    assert response.code == 400
+
+
+def test_unload_stops_workers(jcf_serverapp):  # type: ignore[no-untyped-def]
+    """Check that unloading the extension shuts down what it started."""
+    state = jcf_serverapp.web_app.settings["jupyterlab_code_formatter"]
+    _unload_jupyter_server_extension(jcf_serverapp)
+    assert "jupyterlab_code_formatter" not in jcf_serverapp.web_app.settings
+    assert state["registry"]._stopped.is_set()
+    assert state["jobs"]._closed
+    assert state["executor"]._thread_pool is None
+    # unloading again is harmless
+    _unload_jupyter_server_extension(jcf_serverapp)
@@ -0,0 +1,153 @@
+import json
+
+import nbformat
+import pytest
+
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+from jupyterlab_code_formatter.jobs import FormatJobManager, job_files
+
+FORMATTERS = {"python": ["black"]}
+
+
+@pytest.fixture(autouse=True)
+def require_black():
+    if not SERVER_FORMATTERS["black"].importable:
+        pytest.skip("black is needed for these tests")
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = tmp_path / "root"
+    (root / "src" / ".ipynb_checkpoints").mkdir(parents=True)
+    (root / "src" / "module.py").write_text("x=1\n")
+    (root / "src" / ".ipynb_checkpoints" / "module.py").write_text("x=1\n")
+    (root / "src" / "bad.py").write_text("def (\n")
+    (root / "notes.txt").write_text("x=1\n")
+    notebook = nbformat.v4.new_notebook()
+    notebook.metadata["kernelspec"] = {"name": "python3", "language": "python"}
+    notebook.cells = [
+        nbformat.v4.new_code_cell("y=2"),
+        nbformat.v4.new_code_cell("z = 3"),
+    ]
+    nbformat.write(notebook, str(root / "notebook.ipynb"))
+    return root
+
+
+def make_manager(tmp_path, project, **kwargs):
+    return FormatJobManager(
+        root_dir=str(project),
+        state_path=str(tmp_path / "jobs.json"),
+        mode="thread",
+        **kwargs,
+    )
+
+
+def test_job_files(project):
+    assert [path[len(str(project)) + 1 :] for path in job_files(str(project))] == [
+        "notebook.ipynb",
+        "src/bad.py",
+        "src/module.py",
+    ]
+
+
+async def test_job_formats_directory(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    job = manager.submit("", FORMATTERS)
+    assert job["status"] == "running"
+    job = await manager.wait(job["id"])
+    assert (job["status"], job["total"], job["formatted"]) == ("done", 3, 2)
+    assert job["errors"] == [
+        {"path": "src/bad.py", "error": "Cannot parse: 1:4: def ("}
+    ]
+    assert (project / "src" / "module.py").read_text() == "x = 1\n"
+    notebook = nbformat.read(str(project / "notebook.ipynb"), 4)
+    assert [cell.source for cell in notebook.cells] == ["y = 2", "z = 3"]
+
+    # formatted files are skipped until they change
+    (project / "src" / "module.py").write_text("x=2\n")
+    job = await manager.wait(manager.submit("src", FORMATTERS)["id"])
+    assert (job["formatted"], job["skipped"], len(job["errors"])) == (1, 0, 1)
+    job = await manager.wait(manager.submit("", FORMATTERS)["id"])
+    assert (job["formatted"], job["skipped"], len(job["errors"])) == (0, 2, 1)
+    # unless formatted differently
+    job = await manager.wait(manager.submit("", {"python": ["isort"]})["id"])
+    assert job["skipped"] == 0
+    manager.shutdown()
+
+
+async def test_job_resumes_after_restart(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    job = manager.submit("", FORMATTERS)
+    # the server stops before the job is over
+    manager.shutdown()
+    state = json.loads((tmp_path / "jobs.json").read_text())
+    assert state["jobs"][job["id"]]["status"] == "running"
+
+    manager = make_manager(tmp_path, project)
+    manager.resume()
+    job = await manager.wait(job["id"])
+    assert (job["status"], job["formatted"] + job["skipped"]) == ("done", 2)
+    assert (project / "src" / "module.py").read_text() == "x = 1\n"
+    manager.shutdown()
+
+
+async def test_job_in_processes(tmp_path, project):
+    manager = make_manager(tmp_path, project, max_workers=2)
+    manager.mode = "process"
+    job = await manager.wait(manager.submit("src", FORMATTERS)["id"])
+    manager.shutdown()
+    assert (job["status"], job["formatted"], len(job["errors"])) == ("done", 1, 1)
+
+
+def test_job_outside_of_root(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    with pytest.raises(ValueError):
+        manager.submit("..")
+    with pytest.raises(ValueError):
+        manager.submit("notes.txt")
+
+
+async def test_job_with_formatter_name(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    job = manager.submit("", {"python": "black"})
+    assert job["formatters"] == {"python": ["black"]}
+    job = await manager.wait(job["id"])
+    assert (job["status"], job["formatted"]) == ("done", 2)
+
+
+def test_job_with_unknown_formatter(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    with pytest.raises(ValueError, match="UNKNOWN"):
+        manager.submit("", {"python": ["black", "UNKNOWN"]})
+    assert manager.jobs == {}
+
+
+async def test_cancelled_job_is_not_resumed(tmp_path, project):
+    manager = make_manager(tmp_path, project)
+    job = manager.submit("", FORMATTERS)
+    assert manager.cancel(job["id"])
+    assert (await manager.wait(job["id"]))["status"] == "cancelled"
+    # saved right away, in case the server stops without shutting down the manager
+    state = json.loads((tmp_path / "jobs.json").read_text())
+    assert state["jobs"][job["id"]]["status"] == "cancelled"
+    manager.shutdown()
+
+    manager = make_manager(tmp_path, project)
+    manager.resume()
+    assert manager._tasks == {}
+    manager.shutdown()
+
+
+async def test_job_leaves_symbolic_links_alone(tmp_path, project):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "module.py").write_text("x=1\n")
+    (project / "link").symlink_to(outside, target_is_directory=True)
+    (project / "module.py").symlink_to(outside / "module.py")
+    manager = make_manager(tmp_path, project)
+    with pytest.raises(ValueError):
+        manager.submit("link")
+    job = await manager.wait(manager.submit("", FORMATTERS)["id"])
+    manager.shutdown()
+    assert job["total"] == 3
+    assert (outside / "module.py").read_text() == "x=1\n"
@@ -0,0 +1,100 @@
+import nbformat
+import pytest
+
+from jupyterlab_code_formatter.cli import CodeFormatApp
+from jupyterlab_code_formatter.executor import FormatExecutor
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS
+from jupyterlab_code_formatter.notebooks import (
+    format_notebook,
+    notebook_language,
+    notebook_stages,
+)
+
+
+def make_notebook(language="python", code=("import sys,os\nx=1", "x = 2")):
+    notebook = nbformat.v4.new_notebook()
+    notebook.metadata["kernelspec"] = {
+        "name": language,
+        "language": language,
+        "display_name": language,
+    }
+    notebook.cells = [nbformat.v4.new_markdown_cell("x=1")] + [
+        nbformat.v4.new_code_cell(source) for source in code
+    ]
+    return notebook
+
+
+@pytest.fixture
+def black_and_isort():
+    if not (
+        SERVER_FORMATTERS["black"].importable and SERVER_FORMATTERS["isort"].importable
+    ):
+        pytest.skip("black and isort are needed for this test")
+
+
+def test_notebook_language():
+    assert notebook_language(make_notebook("Python")) == "python"
+    assert notebook_language({"metadata": {"language_info": {"name": "R"}}}) == "r"
+    assert (
+        notebook_language({
+            "metadata": {"language_info": {"codemirror_mode": {"name": "ipython"}}}
+        })
+        == "ipython"
+    )
+    assert notebook_language({"metadata": {}}) is None
+
+
+def test_notebook_stages():
+    settings = {
+        "preferences": {"default_formatter": {"python": "black", "R": ["styler"]}},
+        "black": {"line_length": 100},
+    }
+    assert notebook_stages(make_notebook("python"), settings) == [
+        ("black", {"line_length": 100})
+    ]
+    assert notebook_stages(make_notebook("R"), settings) == [("styler", {})]
+    assert notebook_stages(make_notebook("rust"), {}) == [("rustfmt", {})]
+    # options default to those of the settings schema, as in JupyterLab
+    assert notebook_stages(make_notebook("python"), {})[1] == (
+        "black",
+        {"line_length": 88, "string_normalization": True},
+    )
+    assert notebook_stages({"metadata": {}}, {}) is None
+
+
+async def test_format_notebook(black_and_isort):
+    notebook = make_notebook(code=["import sys,os\nx=1", "x = 2", "def ("])
+    executor = FormatExecutor()
+    summary = await format_notebook(executor, notebook, [("isort", {}), ("black", {})])
+    executor.shutdown()
+    assert summary == {
+        "cells": 3,
+        "changed": 1,
+        "errors": [{"cell": 3, "error": "Cannot parse: 1:4: def ("}],
+    }
+    assert notebook.cells[0].source == "x=1"
+    assert notebook.cells[1].source == "import os\nimport sys\n\nx = 1"
+
+
+def test_cli(tmp_path, black_and_isort):
+    path = tmp_path / "sub" / "notebook.ipynb"
+    path.parent.mkdir()
+    nbformat.write(make_notebook(), str(path))
+    (tmp_path / "notes.txt").write_text("x=1")
+
+    def run(*args):
+        app = CodeFormatApp()
+        app.initialize([*args, f"--settings={tmp_path / 'missing'}", str(tmp_path)])
+        with pytest.raises(SystemExit) as exit_info:
+            app.start()
+        return exit_info.value.code
+
+    assert run("--check") == 1
+    assert (
+        nbformat.read(str(path), as_version=4).cells[1].source == "import sys,os\nx=1"
+    )
+    assert run() == 0
+    assert nbformat.read(str(path), as_version=4).cells[1].source == (
+        "import os\nimport sys\n\nx = 1"
+    )
+    assert run("--check") == 0
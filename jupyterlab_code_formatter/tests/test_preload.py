@@ -0,0 +1,75 @@
+import json
+from unittest import mock
+
+import pytest
+
+from jupyterlab_code_formatter.executor import FormatExecutor
+from jupyterlab_code_formatter.formatters import SERVER_FORMATTERS, BaseFormatter
+from jupyterlab_code_formatter.preload import FormatterPreloader
+from jupyterlab_code_formatter.settings import schema_defaults
+
+
+class RecordingFormatter(BaseFormatter):
+    label = "Apply Recording Formatter"
+    importable = True
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def format_code(self, code: str, notebook: bool, **options) -> str:
+        self.calls.append(options)
+        return code
+
+
+@pytest.fixture
+def settings_path(tmp_path):
+    path = tmp_path / "settings.jupyterlab-settings"
+    path.write_text(
+        json.dumps({
+            "preferences": {"default_formatter": {"python": "recording", "rust": "x"}},
+            "recording": {"line_length": 100},
+        })
+    )
+    return str(path)
+
+
+def test_stages_from_settings(settings_path):
+    preloader = FormatterPreloader(settings_path=settings_path)
+    assert preloader.stages() == {
+        "python": [("recording", {"line_length": 100})],
+        # preferences of the user replace the default ones, as in JupyterLab
+        "R": [],
+    }
+
+
+def test_stages_without_settings(tmp_path):
+    preloader = FormatterPreloader(settings_path=str(tmp_path / "missing"))
+    # with the default options of the settings schema
+    assert preloader.stages()["python"] == [
+        ("isort", schema_defaults()["isort"]),
+        ("black", {"line_length": 88, "string_normalization": True}),
+    ]
+    preloader.formatters = ["yapf", "styler"]
+    assert preloader.stages() == {
+        "python": [("yapf", {"style_config": "google"})],
+        "R": [("styler", {})],
+    }
+
+
+def test_preload_runs_in_background(settings_path):
+    formatter = RecordingFormatter()
+    executor = FormatExecutor()
+    preloader = FormatterPreloader(
+        settings_path=settings_path, formatters=["recording"], enabled=True
+    )
+    with mock.patch.dict(SERVER_FORMATTERS, {"recording": formatter}):
+        preloader.start(executor)
+        preloader.join(timeout=5)
+    executor.shutdown()
+    assert formatter.calls == [{"line_length": 100}]
+
+
+def test_preload_is_opt_in(settings_path):
+    executor = mock.Mock()
+    FormatterPreloader(settings_path=settings_path, enabled=False).start(executor)
+    assert not executor.warm_up.called
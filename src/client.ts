@@ -3,14 +3,20 @@ import { ServerConnection } from '@jupyterlab/services';
 import { Constants } from './constants';
 
 class JupyterlabCodeFormatterClient {
-  public request(path: string, method: string, body: any): Promise<any> {
+  public request(
+    path: string,
+    method: string,
+    body: any,
+    signal?: AbortSignal
+  ): Promise<any> {
     const settings = ServerConnection.makeSettings();
     const fullUrl = URLExt.join(settings.baseUrl, Constants.PLUGIN_NAME, path);
     return ServerConnection.makeRequest(
       fullUrl,
       {
         body,
-        method
+        method,
+        signal
       },
       settings
     ).then(response => {
@@ -26,8 +32,60 @@ class JupyterlabCodeFormatterClient {
     });
   }
 
-  public getAvailableFormatters(cache: boolean) {
-    return this.request('formatters' + (cache ? '?cached' : ''), 'GET', null);
+  /**
+   * Send a request replied with a stream of JSON lines, passing each of them to
+   * `onLine` as soon as it arrives.
+   */
+  public async requestStream(
+    path: string,
+    method: string,
+    body: any,
+    onLine: (line: any) => Promise<void> | void,
+    signal?: AbortSignal
+  ): Promise<void> {
+    const settings = ServerConnection.makeSettings();
+    const fullUrl = URLExt.join(settings.baseUrl, Constants.PLUGIN_NAME, path);
+    const response = await ServerConnection.makeRequest(
+      fullUrl,
+      {
+        body,
+        method,
+        signal
+      },
+      settings
+    );
+    if (response.status !== 200) {
+      await response.text();
+      throw new ServerConnection.ResponseError(response, response.statusText);
+    }
+    const reader = response.body!.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop()!;
+      for (const line of lines) {
+        if (signal?.aborted) {
+          await reader.cancel();
+          return;
+        }
+        if (line.trim()) {
+          await onLine(JSON.parse(line));
+        }
+      }
+    }
+    if (buffer.trim() && !signal?.aborted) {
+      await onLine(JSON.parse(buffer));
+    }
+  }
+
+  public getAvailableFormatters() {
+    return this.request('formatters', 'GET', null);
   }
 }
 
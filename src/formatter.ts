@@ -1,38 +1,278 @@
-import { Cell, CodeCell } from '@jupyterlab/cells';
+import { Cell, CodeCell, ICellModel } from '@jupyterlab/cells';
 import { INotebookTracker, Notebook } from '@jupyterlab/notebook';
 import JupyterlabCodeFormatterClient from './client';
 import { IEditorTracker } from '@jupyterlab/fileeditor';
+import { ISharedText } from '@jupyter/ydoc';
+import { UUID } from '@lumino/coreutils';
 import { Widget } from '@lumino/widgets';
-import { showErrorMessage, Dialog, showDialog } from '@jupyterlab/apputils';
+import {
+  showErrorMessage,
+  Dialog,
+  Notification,
+  showDialog
+} from '@jupyterlab/apputils';
 
 type Context = {
   saving: boolean;
 };
 
+/**
+ * Fast non-cryptographic 53-bit string hash (cyrb53).
+ */
+function hashString(text: string): string {
+  let h1 = 0xdeadbeef;
+  let h2 = 0x41c6ce57;
+  for (let i = 0; i < text.length; i++) {
+    const ch = text.charCodeAt(i);
+    h1 = Math.imul(h1 ^ ch, 2654435761);
+    h2 = Math.imul(h2 ^ ch, 1597334677);
+  }
+  h1 = Math.imul(h1 ^ (h1 >>> 16), 2246822507);
+  h1 ^= Math.imul(h2 ^ (h2 >>> 13), 3266489909);
+  h2 = Math.imul(h2 ^ (h2 >>> 16), 2246822507);
+  h2 ^= Math.imul(h1 ^ (h1 >>> 13), 3266489909);
+  return (4294967296 * (2097151 & h2) + (h1 >>> 0)).toString(36);
+}
+
+/**
+ * Replacement of lines `start` (included) to `end` (excluded), counted from 0.
+ */
+interface ILineEdit {
+  start: number;
+  end: number;
+  text: string;
+}
+
+/**
+ * Lines (1-based, inclusive) of `code` which differ from `previous`.
+ */
+function changedLineRange(previous: string, code: string): [number, number] {
+  const oldLines = previous.split('\n');
+  const newLines = code.split('\n');
+  let start = 0;
+  while (
+    start < oldLines.length &&
+    start < newLines.length &&
+    oldLines[start] === newLines[start]
+  ) {
+    start++;
+  }
+  let oldEnd = oldLines.length;
+  let newEnd = newLines.length;
+  while (
+    oldEnd > start &&
+    newEnd > start &&
+    oldLines[oldEnd - 1] === newLines[newEnd - 1]
+  ) {
+    oldEnd--;
+    newEnd--;
+  }
+  // a deletion leaves no line behind, format the line where it happened
+  return [start + 1, Math.max(start + 1, newEnd)];
+}
+
+/**
+ * Apply line edits computed by the server for `code`, the current source.
+ */
+function applyLineEdits(
+  sharedModel: ISharedText,
+  code: string,
+  edits: ILineEdit[]
+) {
+  const lineOffsets = [0];
+  for (let i = 0; i < code.length; i++) {
+    if (code[i] === '\n') {
+      lineOffsets.push(i + 1);
+    }
+  }
+  const offset = (line: number) =>
+    line < lineOffsets.length ? lineOffsets[line] : code.length;
+  sharedModel.transact(() => {
+    // edits are sorted, apply them from the end so that offsets stay valid
+    for (const edit of [...edits].reverse()) {
+      sharedModel.updateSource(
+        offset(edit.start),
+        offset(edit.end),
+        edit.text
+      );
+    }
+  });
+}
+
+/**
+ * Notification showing how many cells of a large notebook are formatted, with
+ * a button to stop formatting the remaining ones.
+ */
+class FormatProgress {
+  /**
+   * Notebooks with fewer cells are formatted without notification.
+   */
+  static minCells = 20;
+
+  private id: string | null = null;
+  private done = 0;
+  private total: number;
+
+  constructor(total: number, controller: AbortController) {
+    this.total = total;
+    if (total >= FormatProgress.minCells) {
+      this.id = Notification.emit(this.message(), 'in-progress', {
+        autoClose: false,
+        actions: [
+          {
+            label: 'Cancel',
+            callback: () => controller.abort()
+          }
+        ]
+      });
+    }
+  }
+
+  update() {
+    this.done++;
+    if (this.id !== null) {
+      Notification.update({ id: this.id, message: this.message() });
+    }
+  }
+
+  dismiss() {
+    if (this.id !== null) {
+      Notification.dismiss(this.id);
+      this.id = null;
+    }
+  }
+
+  private message(): string {
+    return `Formatting cells: ${this.done}/${this.total}`;
+  }
+}
+
+function withoutNoop(formatters: string[]): string[] {
+  return formatters.filter(
+    formatter => formatter !== 'noop' && formatter !== 'skip'
+  );
+}
+
+/**
+ * Hash of a chain of formatters and of their options, which both decide the
+ * formatted code.
+ */
+function chainHash(formatters: string[], config: any): string {
+  return hashString(
+    JSON.stringify(formatters.map(name => [name, config[name] ?? null]))
+  );
+}
+
+/**
+ * A format request, which the server can be asked to cancel by its id.
+ */
+interface IFormatRequest {
+  id: string;
+  controller: AbortController;
+  /**
+   * What the request formats, e.g. a notebook.
+   */
+  target: object;
+}
+
 class JupyterlabCodeFormatter {
-  working = false;
   protected client: JupyterlabCodeFormatterClient;
+  private currentRequests = new WeakMap<object, IFormatRequest>();
+
   constructor(client: JupyterlabCodeFormatterClient) {
     this.client = client;
   }
 
+  /**
+   * Start a new request formatting `target`, cancelling the one still running
+   * for it if any: it formats code that is about to be formatted again.
+   * Requests for other targets, e.g. other notebooks saved at once, go on.
+   */
+  protected startRequest(target: object): IFormatRequest {
+    this.cancelRequest(target);
+    const request = {
+      id: UUID.uuid4(),
+      controller: new AbortController(),
+      target
+    };
+    this.currentRequests.set(target, request);
+    return request;
+  }
+
+  protected finishRequest(request: IFormatRequest) {
+    if (this.currentRequests.get(request.target) === request) {
+      this.currentRequests.delete(request.target);
+    }
+  }
+
+  protected cancelRequest(target: object) {
+    const request = this.currentRequests.get(target);
+    if (request === undefined) {
+      return;
+    }
+    this.currentRequests.delete(target);
+    request.controller.abort();
+    this.client
+      .request('cancel', 'POST', JSON.stringify({ request_id: request.id }))
+      .catch(() => undefined);
+  }
+
+  /**
+   * Run the code through a chain of formatters in a single request. The
+   * result of each cell, the edits to apply to it or unchanged, is passed to
+   * `onResult` with the cell's `index` as soon as it's formatted.
+   */
   protected formatCode(
     code: string[],
-    formatter: string,
-    options: any,
+    formatters: string[],
+    config: any,
     notebook: boolean,
-    cache: boolean
+    onResult: (result: any) => Promise<void> | void,
+    request: IFormatRequest
+  ) {
+    return this.client.requestStream(
+      'format_stream',
+      'POST',
+      JSON.stringify({
+        code,
+        notebook,
+        request_id: request.id,
+        response: 'edits',
+        formatters: formatters.map(formatter => ({
+          formatter,
+          options: config[formatter]
+        }))
+      }),
+      onResult,
+      request.controller.signal
+    );
+  }
+
+  /**
+   * Run a file through a chain of formatters, only formatting the given lines
+   * when the formatters are able to. The reply comes with the edits to apply.
+   */
+  protected formatRange(
+    code: string,
+    formatters: string[],
+    config: any,
+    lineRanges: [number, number][] | null,
+    request: IFormatRequest
   ) {
     return this.client
       .request(
-        'format' + (cache ? '?cached' : ''),
+        'format_range',
         'POST',
         JSON.stringify({
           code,
-          notebook,
-          formatter,
-          options
-        })
+          line_ranges: lineRanges,
+          request_id: request.id,
+          formatters: formatters.map(formatter => ({
+            formatter,
+            options: config[formatter]
+          }))
+        }),
+        request.controller.signal
       )
       .then(resp => JSON.parse(resp));
   }
@@ -40,6 +280,11 @@ class JupyterlabCodeFormatter {
 
 export class JupyterlabNotebookCodeFormatter extends JupyterlabCodeFormatter {
   protected notebookTracker: INotebookTracker;
+  /**
+   * Hash of the formatters chain and of the source each cell had right after it was
+   * last formatted successfully, cells still matching it are not sent again.
+   */
+  private formattedHashes = new WeakMap<ICellModel, string>();
 
   constructor(
     client: JupyterlabCodeFormatterClient,
@@ -165,75 +410,104 @@ export class JupyterlabNotebookCodeFormatter extends JupyterlabCodeFormatter {
     return formattersToUse;
   }
 
+  private formattedHash(cell: CodeCell, chain: string): string {
+    return `${chain}:${hashString(cell.model.sharedModel.source)}`;
+  }
+
+  /**
+   * Apply the formatters to the cells, returning the cells that could not be
+   * formatted by all of them.
+   */
   private async applyFormatters(
     selectedCells: CodeCell[],
     formattersToUse: string[],
     config: any,
-    context: Context
-  ) {
-    for (const formatterToUse of formattersToUse) {
-      if (formatterToUse === 'noop' || formatterToUse === 'skip') {
-        continue;
-      }
-      const currentTexts = selectedCells.map(
-        cell => cell.model.sharedModel.source
-      );
-      const formattedTexts = await this.formatCode(
-        currentTexts,
-        formatterToUse,
-        config[formatterToUse],
-        true,
-        config.cacheFormatters
-      );
-      console.log(
-        config.suppressFormatterErrorsIFFAutoFormatOnSave,
+    context: Context,
+    request: IFormatRequest
+  ): Promise<Set<CodeCell>> {
+    const failedCells = new Set<CodeCell>();
+    const formatters = withoutNoop(formattersToUse);
+    if (formatters.length === 0) {
+      return failedCells;
+    }
+    const currentTexts = selectedCells.map(
+      cell => cell.model.sharedModel.source
+    );
+    const showErrors =
+      !(config.suppressFormatterErrors ?? false) &&
+      !(
+        (config.suppressFormatterErrorsIFFAutoFormatOnSave ?? false) &&
         context.saving
       );
 
-      const showErrors =
-        !(config.suppressFormatterErrors ?? false) &&
-        !(
-          (config.suppressFormatterErrorsIFFAutoFormatOnSave ?? false) &&
-          context.saving
-        );
-      for (let i = 0; i < selectedCells.length; ++i) {
-        const cell = selectedCells[i];
-        const currentText = currentTexts[i];
-        const formattedText = formattedTexts.code[i];
-        const cellValueHasNotChanged =
-          cell.model.sharedModel.source === currentText;
-        if (cellValueHasNotChanged) {
-          if (formattedText.error) {
-            if (showErrors) {
-              const result = await showDialog({
-                title: 'Jupyterlab Code Formatter Error',
-                body: formattedText.error,
-                buttons: [
-                  Dialog.createButton({
-                    label: 'Go to cell',
-                    actions: ['revealError']
-                  }),
-                  Dialog.okButton({ label: 'Dismiss' })
-                ]
-              });
-              if (result.button.actions.indexOf('revealError') !== -1) {
-                this.notebookTracker.currentWidget!.content.scrollToCell(cell);
-                break;
-              }
-            }
-          } else {
-            cell.model.sharedModel.source = formattedText.code;
-          }
-        } else {
+    // cells without a result once the request is over were never formatted
+    const unformattedCells = new Set(selectedCells);
+    const controller = request.controller;
+    const progress = new FormatProgress(selectedCells.length, controller);
+    const applyResult = async (formattedText: any) => {
+      const i: number = formattedText.index;
+      const cell = selectedCells[i];
+      const currentText = currentTexts[i];
+      unformattedCells.delete(cell);
+      progress.update();
+      const cellValueHasNotChanged =
+        cell.model.sharedModel.source === currentText;
+      if (cellValueHasNotChanged) {
+        if (formattedText.error) {
+          failedCells.add(cell);
           if (showErrors) {
-            await showErrorMessage(
-              'Jupyterlab Code Formatter Error',
-              `Cell value changed since format request was sent, formatting for cell ${i} skipped.`
-            );
+            const result = await showDialog({
+              title: 'Jupyterlab Code Formatter Error',
+              body: formattedText.error,
+              buttons: [
+                Dialog.createButton({
+                  label: 'Go to cell',
+                  actions: ['revealError']
+                }),
+                Dialog.okButton({ label: 'Dismiss' })
+              ]
+            });
+            if (result.button.actions.indexOf('revealError') !== -1) {
+              this.notebookTracker.currentWidget!.content.scrollToCell(cell);
+              controller.abort();
+            }
           }
+        } else if (!formattedText.unchanged) {
+          applyLineEdits(
+            cell.model.sharedModel,
+            currentText,
+            formattedText.edits
+          );
+        }
+      } else {
+        failedCells.add(cell);
+        if (showErrors) {
+          await showErrorMessage(
+            'Jupyterlab Code Formatter Error',
+            `Cell value changed since format request was sent, formatting for cell ${i} skipped.`
+          );
         }
       }
+    };
+
+    try {
+      await this.formatCode(
+        currentTexts,
+        formatters,
+        config,
+        true,
+        applyResult,
+        request
+      );
+    } catch (error) {
+      if (!controller.signal.aborted) {
+        throw error;
+      }
+    } finally {
+      progress.dismiss();
     }
+    unformattedCells.forEach(cell => failedCells.add(cell));
+    return failedCells;
   }
 
   private async formatCells(
@@ -243,28 +517,48 @@ export class JupyterlabNotebookCodeFormatter extends JupyterlabCodeFormatter {
     formatter?: string,
     notebook?: Notebook
   ) {
-    if (this.working) {
-      return;
-    }
+    const request = this.startRequest(
+      notebook ?? this.notebookTracker.currentWidget?.content ?? this
+    );
     try {
-      this.working = true;
       const selectedCells = this.getCodeCells(selectedOnly, notebook);
       if (selectedCells.length === 0) {
-        this.working = false;
         return;
       }
 
       const formattersToUse = await this.getFormattersToUse(config, formatter);
-      await this.applyFormatters(
-        selectedCells,
+      const chain = chainHash(formattersToUse, config);
+      const cellsToFormat = selectedCells.filter(
+        cell =>
+          this.formattedHashes.get(cell.model) !==
+          this.formattedHash(cell, chain)
+      );
+      if (cellsToFormat.length === 0) {
+        return;
+      }
+
+      const failedCells = await this.applyFormatters(
+        cellsToFormat,
         formattersToUse,
         config,
-        context
+        context,
+        request
       );
+      for (const cell of cellsToFormat) {
+        if (failedCells.has(cell)) {
+          this.formattedHashes.delete(cell.model);
+        } else {
+          this.formattedHashes.set(
+            cell.model,
+            this.formattedHash(cell, chain)
+          );
+        }
+      }
     } catch (error) {
       await showErrorMessage('Jupyterlab Code Formatter Error', `${error}`);
+    } finally {
+      this.finishRequest(request);
     }
-    this.working = false;
   }
 
   applicable(formatter: string, currentWidget: Widget) {
@@ -276,6 +570,15 @@ export class JupyterlabNotebookCodeFormatter extends JupyterlabCodeFormatter {
 
 export class JupyterlabFileEditorCodeFormatter extends JupyterlabCodeFormatter {
   protected editorTracker: IEditorTracker;
+  /**
+   * Source each editor had right after it was last formatted, and the hash of
+   * the formatters and options used, so that saving again only formats the
+   * lines edited since.
+   */
+  private formattedSources = new WeakMap<
+    object,
+    { chain: string; source: string }
+  >();
 
   constructor(
     client: JupyterlabCodeFormatterClient,
@@ -290,19 +593,18 @@ export class JupyterlabFileEditorCodeFormatter extends JupyterlabCodeFormatter {
   }
 
   public async formatEditor(config: any, context: Context, formatter?: string) {
-    if (this.working) {
-      return;
-    }
+    const request = this.startRequest(this.editorTracker.currentWidget ?? this);
     try {
-      this.working = true;
-
       const formattersToUse = await this.getFormattersToUse(config, formatter);
-      await this.applyFormatters(formattersToUse, config, context);
+      await this.applyFormatters(formattersToUse, config, context, request);
     } catch (error) {
-      const msg = error instanceof Error ? error : `${error}`;
-      await showErrorMessage('Jupyterlab Code Formatter Error', msg);
+      if (!request.controller.signal.aborted) {
+        const msg = error instanceof Error ? error : `${error}`;
+        await showErrorMessage('Jupyterlab Code Formatter Error', msg);
+      }
+    } finally {
+      this.finishRequest(request);
     }
-    this.working = false;
   }
 
   private getEditorType() {
@@ -355,50 +657,57 @@ export class JupyterlabFileEditorCodeFormatter extends JupyterlabCodeFormatter {
   private async applyFormatters(
     formattersToUse: string[],
     config: any,
-    context: Context
+    context: Context,
+    request: IFormatRequest
   ) {
-    for (const formatterToUse of formattersToUse) {
-      if (formatterToUse === 'noop' || formatterToUse === 'skip') {
-        continue;
+    const formatters = withoutNoop(formattersToUse);
+    if (formatters.length === 0) {
+      return;
+    }
+    const showErrors =
+      !(config.suppressFormatterErrors ?? false) &&
+      !(
+        (config.suppressFormatterErrorsIFFAutoFormatOnSave ?? false) &&
+        context.saving
+      );
+
+    const editorWidget = this.editorTracker.currentWidget;
+    const editor = editorWidget!.content.editor;
+    const sharedModel = editor.model.sharedModel;
+    const code = sharedModel.source;
+    const chain = chainHash(formatters, config);
+
+    let lineRanges: [number, number][] | null = null;
+    const previous = this.formattedSources.get(editor.model);
+    if (context.saving && previous && previous.chain === chain) {
+      if (previous.source === code) {
+        return;
       }
-      const showErrors =
-        !(config.suppressFormatterErrors ?? false) &&
-        !(
-          (config.suppressFormatterErrorsIFFAutoFormatOnSave ?? false) &&
-          context.saving
-        );
-
-      const editorWidget = this.editorTracker.currentWidget;
-      this.working = true;
-      const editor = editorWidget!.content.editor;
-      const code = editor.model.sharedModel.source;
-      this.formatCode(
-        [code],
-        formatterToUse,
-        config[formatterToUse],
-        false,
-        config.cacheFormatters
-      )
-        .then(data => {
-          if (data.code[0].error) {
-            if (showErrors) {
-              void showErrorMessage(
-                'Jupyterlab Code Formatter Error',
-                data.code[0].error
-              );
-            }
-            this.working = false;
-            return;
-          }
-          this.editorTracker.currentWidget!.content.editor.model.sharedModel.source =
-            data.code[0].code;
-          this.working = false;
-        })
-        .catch(error => {
-          const msg = error instanceof Error ? error : `${error}`;
-          void showErrorMessage('Jupyterlab Code Formatter Error', msg);
-        });
+      lineRanges = [changedLineRange(previous.source, code)];
+    }
+
+    const data = await this.formatRange(
+      code,
+      formatters,
+      config,
+      lineRanges,
+      request
+    );
+    if (data.error) {
+      if (showErrors) {
+        void showErrorMessage('Jupyterlab Code Formatter Error', data.error);
+      }
+      return;
     }
+    if (sharedModel.source !== code) {
+      // edited while formatting, the edits don't apply anymore
+      return;
+    }
+    applyLineEdits(sharedModel, code, data.edits);
+    this.formattedSources.set(editor.model, {
+      chain,
+      source: sharedModel.source
+    });
   }
 
   applicable(formatter: string, currentWidget: Widget) {
@@ -162,20 +162,18 @@ class JupyterLabCodeFormatter implements DocumentRegistry.IWidgetExtension<
   }
 
   private setupAllCommands() {
-    this.client
-      .getAvailableFormatters(this.config.cacheFormatters)
-      .then(data => {
-        const formatters = JSON.parse(data).formatters;
-        const menuGroup: Array<{ command: string }> = [];
-        Object.keys(formatters).forEach(formatter => {
-          if (formatters[formatter].enabled) {
-            const command = `${Constants.PLUGIN_NAME}:${formatter}`;
-            this.setupCommand(formatter, formatters[formatter].label, command);
-            menuGroup.push({ command });
-          }
-        });
-        this.menu.editMenu.addGroup(menuGroup);
+    this.client.getAvailableFormatters().then(data => {
+      const formatters = JSON.parse(data).formatters;
+      const menuGroup: Array<{ command: string }> = [];
+      Object.keys(formatters).forEach(formatter => {
+        if (formatters[formatter].enabled) {
+          const command = `${Constants.PLUGIN_NAME}:${formatter}`;
+          this.setupCommand(formatter, formatters[formatter].label, command);
+          menuGroup.push({ command });
+        }
       });
+      this.menu.editMenu.addGroup(menuGroup);
+    });
 
     this.app.commands.addCommand(Constants.FORMAT_COMMAND, {
       execute: async () => {